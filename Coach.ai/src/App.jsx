@@ -34,6 +34,7 @@ function App() {
         gradientAccumulation: balanced.gradient_accumulation,
         maxSeqLength: balanced.max_seq_length,
         learningRate: balanced.learning_rate,
+        gradCheckpoint: balanced.grad_checkpoint,
         framework: sysInfo.framework,
         isOptimized: true,
         optimizationReason: sysInfo.reason
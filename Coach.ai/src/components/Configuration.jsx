@@ -16,7 +16,8 @@ const Configuration = ({ config, setConfig, onNext, onPrev }) => {
             epochs: p.num_epochs,
             gradientAccumulation: p.gradient_accumulation,
             maxSeqLength: p.max_seq_length,
-            learningRate: p.learning_rate
+            learningRate: p.learning_rate,
+            gradCheckpoint: p.grad_checkpoint
         }));
     };
 
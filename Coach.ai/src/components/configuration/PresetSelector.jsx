@@ -5,7 +5,7 @@ const PresetSelector = ({ config, onSelect }) => {
 
     return (
         <div className="card-group" style={{ marginBottom: '2rem' }}>
-            {['conservative', 'balanced', 'aggressive'].map(level => (
+            {['conservative', 'balanced', 'aggressive', 'auto'].filter(level => config.presets[level]).map(level => (
                 <div
                     key={level}
                     className="card"
@@ -24,7 +24,7 @@ const PresetSelector = ({ config, onSelect }) => {
                         {config.presets[level].max_seq_length} ctx / {config.presets[level].batch_size} batch
                     </div>
                     <div className="metric-label">
-                        {level === 'conservative' ? 'Safe & Stable' : level === 'balanced' ? 'Recommended' : 'Max Performance'}
+                        {level === 'conservative' ? 'Safe & Stable' : level === 'balanced' ? 'Recommended' : level === 'auto' ? 'Measured' : 'Max Performance'}
                     </div>
                 </div>
             ))}
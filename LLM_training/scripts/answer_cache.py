@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Cache semântica de respostas: perguntas parafraseadas reutilizam a resposta já gerada.
+
+Uma cache exata falha paráfrases como "Quando nasceu o Farense?" e "Em que ano foi
+fundado o SC Farense?". Aqui cada pergunta respondida é codificada com o modelo de
+embeddings local (embeddings.py) e guardada numa matriz numpy; uma pergunta nova
+devolve a resposta guardada quando a semelhança cosseno com a pergunta mais próxima
+é >= ao limiar, sem passar pelo 7B.
+
+O limiar não tem valor por omissão: a média dos estados ocultos de um decoder é muito
+anisotrópica (perguntas sem relação passam facilmente de 0.9), pelo que tem de ser
+calibrado para cada modelo de embeddings com pares de perguntas rotulados
+(--calibrate pares.jsonl, que grava a medição em CACHE_DIR/calibration.json) ou
+indicado explicitamente. Sem limiar a cache fica desligada.
+
+A pesquisa é exata (força bruta) até IVF_MIN_ENTRIES perguntas; acima disso usa um
+índice IVF: k-means esférico sobre os vetores, e cada pesquisa só compara as perguntas
+das NPROBE listas com centróide mais próximo. O índice é retreinado quando o número de
+entradas duplica.
+
+A cache tem no máximo MAX_ENTRIES perguntas por partição; quando cheia, a entrada
+usada há mais tempo (LRU) é substituída. Há uma partição por modelo base + adaptador
+(model_loader.adapter_hash): um adaptador re-treinado começa com a cache vazia. Dentro
+da partição, cada formato de prompt e max_tokens (prompt_variant) tem a sua subpasta,
+para que respostas a prompts diferentes (ou truncadas) não sejam servidas umas pelas
+outras.
+
+A utilização (last_used, hits) é atualizada em memória e gravada no máximo a cada
+SAVE_INTERVAL_SEC, em store() e em close(); as pesquisas não reescrevem o entries.json.
+Vários processos podem abrir a mesma partição (o daemon e o interactive_inference.py):
+pesquisas e gravações fazem flock do ficheiro lock da partição, e cada processo relê o
+entries.json gravado por outro antes de pesquisar ou gravar, reaplicando a sua utilização
+ainda não gravada.
+
+Formato em disco (CACHE_DIR/<partição>/):
+    vectors.npy   matriz float16 (MAX_ENTRIES, dim), memory-mapped; uma linha por slot
+    entries.json  pergunta, resposta e utilização de cada slot ocupado, e estatísticas
+    lock          ficheiro de flock partilhado pelos processos que usam a partição
+
+Usage:
+    python scripts/answer_cache.py "Em que ano foi fundado o SC Farense?"
+    python scripts/answer_cache.py --stats
+    python scripts/answer_cache.py --clear
+    python scripts/answer_cache.py --calibrate data/paraphrase_pairs.jsonl
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+import model_loader
+
+CACHE_DIR = model_loader.BASE_DIR / "output/answer_cache"
+CALIBRATION_FILE = CACHE_DIR / "calibration.json"
+TARGET_PRECISION = 0.99  # Fração de pares não-paráfrase abaixo do limiar calibrado
+SAVE_INTERVAL_SEC = 30
+MAX_ENTRIES = 5000
+IVF_MIN_ENTRIES = 512    # Abaixo disto a pesquisa é exata
+NPROBE = 4               # Listas IVF visitadas por pesquisa
+KMEANS_ITERATIONS = 10
+
+
+_partition_keys = {}  # (modelo, adaptador, assinatura dos ficheiros) -> partição
+
+
+def _adapter_files_signature(adapter_path):
+    signature = []
+    for name in model_loader.ADAPTER_FILES:
+        path = Path(adapter_path) / name
+        if path.exists():
+            stat = path.stat()
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def partition_key(base_model, adapter_path):
+    """Partição da cache: hash do adaptador (ou só do modelo base, sem adaptador)"""
+    if not model_loader.has_adapter(adapter_path):
+        return "base_" + hashlib.sha256(str(base_model).encode("utf-8")).hexdigest()[:16]
+    # O hash lê o adaptador inteiro: calculado uma vez por processo enquanto os ficheiros não mudarem
+    key = (str(base_model), str(adapter_path), _adapter_files_signature(adapter_path))
+    if key not in _partition_keys:
+        _partition_keys[key] = model_loader.adapter_hash(base_model, adapter_path)
+    return _partition_keys[key]
+
+
+def prompt_variant(prompt, question, max_tokens):
+    """Subpartição para o formato do prompt e max_tokens; None se o prompt não for cacheável"""
+    if question not in prompt:
+        return None
+    template = prompt.replace(question, "{pergunta}")
+    # O contexto recuperado (--rag) depende da pergunta: a resposta não serve para paráfrases
+    if "### Contexto" in template:
+        return None
+    return hashlib.sha1(f"{template}|{max_tokens}".encode("utf-8")).hexdigest()[:8]
+
+
+def calibrated_threshold(embedding_name, calibration_file=CALIBRATION_FILE):
+    """Limiar calibrado para este modelo de embeddings (--calibrate); None se não existir"""
+    if not Path(calibration_file).exists():
+        return None
+    with open(calibration_file, 'r', encoding='utf-8') as f:
+        return json.load(f).get(embedding_name, {}).get("threshold")
+
+
+def spherical_kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Centróides normalizados e atribuição de cada vetor (semelhança cosseno)"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(k):
+            members = vectors[assignment == c]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class IVFIndex:
+    """Listas invertidas (centróide -> slots); a pesquisa compara só as listas mais próximas"""
+
+    def __init__(self, vectors, slots):
+        self.centroids, assignment = spherical_kmeans(vectors, int(np.sqrt(len(slots))))
+        self.lists = [set() for _ in self.centroids]
+        self.list_of = {}
+        for slot, c in zip(slots, assignment):
+            self.add(slot, c)
+        self.trained_size = len(slots)
+
+    def add(self, slot, centroid):
+        self.lists[centroid].add(slot)
+        self.list_of[slot] = centroid
+
+    def add_vector(self, slot, vector):
+        self.add(slot, int(np.argmax(self.centroids @ vector)))
+
+    def remove(self, slot):
+        self.lists[self.list_of.pop(slot)].discard(slot)
+
+    def candidates(self, vector, nprobe=NPROBE):
+        probe = np.argsort(-(self.centroids @ vector))[:nprobe]
+        return [slot for c in probe for slot in self.lists[c]]
+
+
+class SemanticCache:
+    """Perguntas já respondidas (por partição modelo + adaptador), pesquisadas por semelhança"""
+
+    def __init__(self, embedder, threshold, base_model=model_loader.BASE_MODEL,
+                 adapter_path=model_loader.DEFAULT_ADAPTER_PATH, variant=None, cache_dir=CACHE_DIR,
+                 max_entries=MAX_ENTRIES):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.partition = partition_key(base_model, adapter_path) + (f"/{variant}" if variant else "")
+        self.dir = Path(cache_dir) / self.partition
+        self.entries_file = self.dir / "entries.json"
+        self.vectors_file = self.dir / "vectors.npy"
+        self.lock_file = self.dir / "lock"
+        self.entries = {}   # slot -> {"question", "answer", "created", "last_used", "hits"}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._last = (None, None)  # (pergunta, vetor) da última pesquisa, reutilizado por store()
+        # Utilização e contadores ainda não gravados, reaplicados quando outro processo grava a partição
+        self._pending = {}  # (slot, pergunta) -> (last_used, hits)
+        self._pending_stats = dict.fromkeys(self.stats, 0)
+        self._loaded = None  # (inode, mtime) do entries.json lido
+        self._saved_at = time.time()
+        self.free = list(range(max_entries - 1, -1, -1))
+        self.ivf = None
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with self._locked(fcntl.LOCK_EX):
+            if self.vectors_file.exists():
+                self.vectors = np.load(self.vectors_file, mmap_mode='r+')
+                if self.vectors.shape != (max_entries, embedder.dim) or not self._same_embedder():
+                    print(f"[INFO] Cache semântica incompatível (modelo de embeddings/tamanho); a recomeçar: {self.dir}",
+                          file=sys.stderr)
+                    del self.vectors
+                    self.vectors_file.unlink()
+                    self.entries_file.unlink(missing_ok=True)
+            if not self.vectors_file.exists():
+                self.vectors = np.lib.format.open_memmap(self.vectors_file, mode='w+', dtype=np.float16,
+                                                         shape=(max_entries, embedder.dim))
+            self._sync()
+
+    @contextmanager
+    def _locked(self, operation):
+        """flock da partição: partilhado nas pesquisas, exclusivo ao gravar"""
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, operation)
+            yield
+
+    def _same_embedder(self):
+        if not self.entries_file.exists():
+            return True
+        with open(self.entries_file, 'r', encoding='utf-8') as f:
+            return json.load(f).get("model") == self.embedder.name
+
+    def _sync(self):
+        """Relê o entries.json se outro processo o gravou desde a última leitura (com o lock)"""
+        try:
+            stat = os.stat(self.entries_file)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) == self._loaded:
+            return
+        with open(self.entries_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self._loaded = (stat.st_ino, stat.st_mtime_ns)
+        self.entries = {int(slot): entry for slot, entry in data["entries"].items()}
+        self.stats = {key: data["stats"].get(key, 0) + count for key, count in self._pending_stats.items()}
+        for (slot, question), (last_used, hits) in self._pending.items():
+            entry = self.entries.get(slot)
+            if entry and entry["question"] == question:
+                entry["last_used"] = max(entry["last_used"], last_used)
+                entry["hits"] += hits
+        self.free = [slot for slot in range(self.max_entries - 1, -1, -1) if slot not in self.entries]
+        self._train_ivf()
+
+    def _count(self, key):
+        self.stats[key] += 1
+        self._pending_stats[key] += 1
+
+    def _train_ivf(self):
+        if len(self.entries) < IVF_MIN_ENTRIES:
+            self.ivf = None
+            return
+        slots = sorted(self.entries)
+        self.ivf = IVFIndex(self.vectors[slots].astype(np.float32), slots)
+
+    def _embed(self, question):
+        if self._last[0] != question:
+            self._last = (question, self.embedder.embed_one(question))
+        return self._last[1]
+
+    def nearest(self, vector):
+        """Slot mais semelhante e a sua semelhança cosseno (None, -1.0 com a cache vazia)"""
+        slots = self.ivf.candidates(vector) if self.ivf else list(self.entries)
+        if not slots:
+            return None, -1.0
+        similarities = self.vectors[slots].astype(np.float32) @ vector
+        best = int(np.argmax(similarities))
+        return slots[best], float(similarities[best])
+
+    def lookup(self, question):
+        """Resposta guardada (answer, question, similarity) se houver uma pergunta semelhante; senão None"""
+        vector = self._embed(question)
+        with self._locked(fcntl.LOCK_SH):
+            self._sync()
+            slot, similarity = self.nearest(vector)
+            entry = self.entries[slot] if slot is not None and similarity >= self.threshold else None
+        if entry is None:
+            self._count("misses")
+            return None
+        now = time.time()
+        entry["last_used"] = now
+        entry["hits"] += 1
+        _, hits = self._pending.get((slot, entry["question"]), (now, 0))
+        self._pending[(slot, entry["question"])] = (now, hits + 1)
+        self._count("hits")
+        if now - self._saved_at >= SAVE_INTERVAL_SEC:
+            self.save()
+        return {"answer": entry["answer"], "question": entry["question"], "similarity": similarity}
+
+    def store(self, question, answer):
+        """Guarda a resposta; substitui a entrada usada há mais tempo quando a cache está cheia"""
+        vector = self._embed(question)
+        with self._locked(fcntl.LOCK_EX):
+            self._sync()
+            slot, similarity = self.nearest(vector)
+            if slot is None or similarity < 0.999:
+                if self.free:
+                    slot = self.free.pop()
+                else:
+                    slot = min(self.entries, key=lambda s: self.entries[s]["last_used"])
+                    self._count("evictions")
+                if self.ivf and slot in self.ivf.list_of:
+                    self.ivf.remove(slot)
+                self.vectors[slot] = vector
+                if self.ivf:
+                    self.ivf.add_vector(slot, vector)
+            now = time.time()
+            self.entries[slot] = {"question": question, "answer": answer, "created": now, "last_used": now, "hits": 0}
+
+            if len(self.entries) >= max(IVF_MIN_ENTRIES, 2 * (self.ivf.trained_size if self.ivf else 0)):
+                self._train_ivf()
+            self._write()
+
+    def save(self):
+        with self._locked(fcntl.LOCK_EX):
+            self._sync()
+            self._write()
+
+    def _write(self):
+        """Grava os vetores e o entries.json (com o lock exclusivo)"""
+        self.vectors.flush()
+        tmp_file = self.entries_file.with_suffix(".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"model": self.embedder.name, "entries": self.entries, "stats": self.stats}, f,
+                      ensure_ascii=False)
+        os.replace(tmp_file, self.entries_file)
+        stat = os.stat(self.entries_file)
+        self._loaded = (stat.st_ino, stat.st_mtime_ns)
+        self._pending = {}
+        self._pending_stats = dict.fromkeys(self.stats, 0)
+        self._saved_at = time.time()
+
+    def close(self):
+        """Grava a utilização acumulada desde o último save()"""
+        if self._pending or any(self._pending_stats.values()):
+            self.save()
+
+    def info(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {"partition": self.partition, "threshold": self.threshold, "entries": len(self.entries), "max_entries": self.max_entries,
+                "ivf_lists": len(self.ivf.lists) if self.ivf else 0,
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0, **self.stats}
+
+
+def open_embedder(embedding_model=None, threshold=None):
+    """(Embedder, limiar) para a cache; None sem modelo de embeddings local ou sem limiar calibrado"""
+    from embeddings import EMBEDDING_MODEL
+
+    embedding_model = embedding_model or EMBEDDING_MODEL
+    if not Path(embedding_model).exists():
+        return None
+    threshold = threshold if threshold is not None else calibrated_threshold(Path(embedding_model).name)
+    if threshold is None:
+        print(f"[INFO] Cache semântica desligada: sem limiar calibrado para {embedding_model} "
+              f"(answer_cache.py --calibrate)", file=sys.stderr)
+        return None
+    from embeddings import Embedder
+
+    return Embedder(embedding_model), threshold
+
+
+def open_cache(base_model, adapter_path, embedding_model=None, threshold=None, variant=None):
+    """Cache da partição modelo + adaptador (+ variante do prompt); None se estiver desligada"""
+    opened = open_embedder(embedding_model, threshold)
+    if opened is None:
+        return None
+    embedder, threshold = opened
+    return SemanticCache(embedder, threshold, base_model, adapter_path, variant)
+
+
+def calibrate(pairs_file, embedding_model=None, calibration_file=CALIBRATION_FILE, target_precision=TARGET_PRECISION):
+    """
+    Mede a semelhança de pares rotulados (JSONL com question_a, question_b e paraphrase) e grava
+    como limiar o percentil target_precision das semelhanças dos pares que não são paráfrases.
+    """
+    from embeddings import EMBEDDING_MODEL, Embedder
+
+    embedding_model = embedding_model or EMBEDDING_MODEL
+    with open(pairs_file, 'r', encoding='utf-8') as f:
+        pairs = [json.loads(line) for line in f if line.strip()]
+    embedder = Embedder(embedding_model)
+    a = embedder.embed([p["question_a"] for p in pairs])
+    b = embedder.embed([p["question_b"] for p in pairs])
+    similarities = (a * b).sum(axis=1)
+    labels = np.array([bool(p["paraphrase"]) for p in pairs])
+    if labels.all() or not labels.any():
+        raise ValueError("São precisos pares de paráfrases e de não-paráfrases")
+
+    negatives, positives = similarities[~labels], similarities[labels]
+    # Ligeiramente acima do percentil observado: a pesquisa aceita semelhanças >= limiar
+    threshold = float(np.nextafter(np.quantile(negatives, target_precision, method="higher"), np.float32(1)))
+    measurement = {
+        "threshold": threshold,
+        "pairs": len(pairs),
+        "paraphrases": int(labels.sum()),
+        "paraphrase_recall": float((positives >= threshold).mean()),
+        "false_positive_rate": float((negatives >= threshold).mean()),
+        "paraphrase_similarity_mean": float(positives.mean()),
+        "non_paraphrase_similarity_mean": float(negatives.mean()),
+        "pairs_file": str(pairs_file),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    calibration = {}
+    if Path(calibration_file).exists():
+        with open(calibration_file, 'r', encoding='utf-8') as f:
+            calibration = json.load(f)
+    calibration[embedder.name] = measurement
+    Path(calibration_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(calibration_file, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, indent=2, ensure_ascii=False)
+    return measurement
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache semântica de respostas (pesquisa por semelhança)")
+    parser.add_argument("question", nargs="?", help="Pergunta a procurar na cache")
+    parser.add_argument("--base-model", default=model_loader.BASE_MODEL)
+    parser.add_argument("--adapter-path", default=model_loader.DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--embedding-model", default=None, help="Modelo de embeddings (default: models/embedding)")
+    parser.add_argument("--threshold", type=float, default=None, help="Limiar de semelhança (default: o calibrado)")
+    parser.add_argument("--calibrate", type=Path, metavar="PAIRS",
+                        help="Calibrar o limiar com pares rotulados (JSONL: question_a, question_b, paraphrase)")
+    parser.add_argument("--stats", action="store_true", help="Mostrar as estatísticas da partição")
+    parser.add_argument("--clear", action="store_true", help="Apagar a partição deste modelo/adaptador")
+    args = parser.parse_args()
+
+    if args.calibrate:
+        measurement = calibrate(args.calibrate, args.embedding_model)
+        print(json.dumps(measurement, indent=2, ensure_ascii=False))
+        print(f"\n✓ Limiar {measurement['threshold']:.3f} guardado em {CALIBRATION_FILE}")
+        return
+
+    if args.clear:
+        partition = CACHE_DIR / partition_key(args.base_model, args.adapter_path)
+        shutil.rmtree(partition, ignore_errors=True)
+        print(f"🧹 Cache apagada: {partition}")
+        return
+
+    cache = open_cache(args.base_model, args.adapter_path, args.embedding_model, args.threshold)
+    if cache is None:
+        print("❌ Cache semântica indisponível (modelo de embeddings ou limiar em falta)", file=sys.stderr)
+        sys.exit(1)
+    if args.question:
+        start = time.perf_counter()
+        hit = cache.lookup(args.question)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if hit:
+            print(f"{hit['answer']}\n\n[semelhança {hit['similarity']:.3f} com \"{hit['question']}\"; "
+                  f"{elapsed_ms:.1f} ms]", file=sys.stderr)
+        else:
+            print(f"(sem resposta em cache; {elapsed_ms:.1f} ms)", file=sys.stderr)
+    if args.stats or not args.question:
+        print(json.dumps(cache.info(), indent=2, ensure_ascii=False))
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
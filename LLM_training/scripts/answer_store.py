@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Respostas pré-calculadas para as perguntas conhecidas do dataset (SQLite).
+
+Cada prompt de train_v3_final_complete.jsonl e valid_v3_final_complete.jsonl é uma
+pergunta que os utilizadores provavelmente farão. O passo de build gera em lote
+(batch_generate, como batch_inference.py) as respostas de todo o banco de perguntas
+com o adaptador atual e guarda-as numa tabela SQLite com chave (adaptador, pergunta):
+    - adaptador: model_loader.adapter_hash (pesos + configuração), como answer_cache.py;
+    - pergunta: hash da pergunta normalizada (minúsculas, sem acentos nem pontuação).
+
+Voltar a correr o build só gera as perguntas que ainda não têm resposta para o
+adaptador atual (perguntas novas ou alteradas, ou um adaptador re-treinado) e apaga as
+que saíram do dataset; cada batch é gravado numa transação, pelo que um build
+interrompido retoma onde parou. Os scripts de inferência respondem às perguntas
+conhecidas com uma única consulta (answer()), antes de carregar o modelo.
+
+Usage:
+    python scripts/answer_store.py --build
+    python scripts/answer_store.py --build --adapter-path checkpoints_qlora/adapters --prune
+    python scripts/answer_store.py "Quem foi Hassan Nader?"
+    python scripts/answer_store.py --stats
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import model_loader
+from answer_cache import partition_key
+from match_query import normalize
+
+STORE_FILE = model_loader.BASE_DIR / "output/answer_store.sqlite"
+DATA_DIR = model_loader.BASE_DIR / "data"
+QUESTION_FILES = [DATA_DIR / "train_v3_final_complete.jsonl", DATA_DIR / "valid_v3_final_complete.jsonl"]
+BATCH_SIZE = 8
+MAX_TOKENS = 200
+
+
+def question_key(prompt):
+    return hashlib.sha1(normalize(prompt).encode("utf-8")).hexdigest()[:20]
+
+
+class AnswerStore:
+    """Tabela (adaptador, pergunta) -> resposta"""
+
+    def __init__(self, path=STORE_FILE):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")  # leituras dos scripts de inferência durante o build
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                adapter TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (adapter, question_key)
+            ) WITHOUT ROWID
+        """)
+
+    def lookup(self, prompt, adapter):
+        row = self.conn.execute("SELECT answer FROM answers WHERE adapter = ? AND question_key = ?",
+                                (adapter, question_key(prompt))).fetchone()
+        return row[0] if row else None
+
+    def keys(self, adapter):
+        return {key for key, in self.conn.execute("SELECT question_key FROM answers WHERE adapter = ?", (adapter,))}
+
+    def put_many(self, adapter, pairs):
+        """Grava (pergunta, resposta) numa única transação"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                                  [(adapter, question_key(q), q, a, now) for q, a in pairs])
+
+    def delete(self, adapter, keys):
+        with self.conn:
+            self.conn.executemany("DELETE FROM answers WHERE adapter = ? AND question_key = ?",
+                                  [(adapter, key) for key in keys])
+
+    def prune(self, adapter):
+        """Apaga as respostas dos outros adaptadores; devolve quantas"""
+        with self.conn:
+            return self.conn.execute("DELETE FROM answers WHERE adapter != ?", (adapter,)).rowcount
+
+    def stats(self):
+        return {adapter: count for adapter, count in
+                self.conn.execute("SELECT adapter, COUNT(*) FROM answers GROUP BY adapter")}
+
+
+def read_questions(files=QUESTION_FILES):
+    """Banco de perguntas: chave -> pergunta (sem repetições entre ficheiros)"""
+    bank = {}
+    for path in files:
+        if not Path(path).exists():
+            print(f"[WARN] Ficheiro de perguntas em falta: {path}", file=sys.stderr)
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    prompt = json.loads(line)["prompt"].strip()
+                    bank.setdefault(question_key(prompt), prompt)
+    return bank
+
+
+def build(base_model=model_loader.BASE_MODEL, adapter_path=model_loader.DEFAULT_ADAPTER_PATH, files=QUESTION_FILES,
+          store_file=STORE_FILE, batch_size=BATCH_SIZE, max_tokens=MAX_TOKENS, prune=False):
+    """Gera as respostas em falta para o adaptador atual e apaga as de perguntas removidas"""
+    from mlx_lm import batch_generate
+
+    from batch_inference import length_sorted_batches
+    from generation import cut_at_stop
+
+    store = AnswerStore(store_file)
+    adapter = partition_key(base_model, adapter_path)
+    bank = read_questions(files)
+    existing = store.keys(adapter)
+    stale = existing - set(bank)
+    missing = [(key, {"prompt": prompt}) for key, prompt in bank.items() if key not in existing]
+    store.delete(adapter, stale)
+    totals = {"adapter": adapter, "questions": len(bank), "reused": len(bank) - len(missing),
+              "generated": 0, "removed": len(stale), "pruned": store.prune(adapter) if prune else 0}
+    print(f"Adaptador {adapter}: {len(missing)} respostas a gerar, {totals['reused']} reutilizadas, "
+          f"{len(stale)} removidas", file=sys.stderr)
+    if not missing:
+        return totals
+
+    model, tokenizer, mode = model_loader.load_model(base_model, adapter_path)
+    start = time.perf_counter()
+    for batch in length_sorted_batches(missing, tokenizer, batch_size):
+        result = batch_generate(model, tokenizer, [tokens for _, _, tokens in batch], max_tokens=max_tokens)
+        answers = [(record["prompt"], cut_at_stop(text).strip()) for (_, record, _), text in zip(batch, result.texts)]
+        store.put_many(adapter, answers)
+        totals["generated"] += len(answers)
+        elapsed = time.perf_counter() - start
+        print(f"  {totals['generated']}/{len(missing)} respostas | {totals['generated'] / elapsed:.2f} perguntas/s",
+              file=sys.stderr)
+    totals["elapsed_sec"] = time.perf_counter() - start
+    return totals
+
+
+_store = None
+
+
+def answer(prompt, base_model, adapter_path, store_file=STORE_FILE):
+    """Resposta pré-calculada para uma pergunta conhecida com este adaptador; None se não existir"""
+    global _store
+    if not Path(store_file).exists():
+        return None
+    if _store is None:
+        _store = AnswerStore(store_file)
+    return _store.lookup(prompt, partition_key(base_model, adapter_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Respostas pré-calculadas para as perguntas do dataset (SQLite)")
+    parser.add_argument("question", nargs="?", help="Pergunta a procurar")
+    parser.add_argument("--build", action="store_true", help="Gerar as respostas em falta para o adaptador atual")
+    parser.add_argument("--prune", action="store_true", help="Com --build, apagar as respostas de outros adaptadores")
+    parser.add_argument("--stats", action="store_true", help="Respostas guardadas por adaptador")
+    parser.add_argument("--base-model", default=model_loader.BASE_MODEL)
+    parser.add_argument("--adapter-path", default=model_loader.DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--files", nargs="+", default=QUESTION_FILES, help="JSONL com o campo 'prompt'")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    args = parser.parse_args()
+
+    if args.build:
+        totals = build(args.base_model, args.adapter_path, args.files, batch_size=args.batch_size,
+                       max_tokens=args.max_tokens, prune=args.prune)
+        print(json.dumps(totals, indent=2))
+    if args.question:
+        start = time.perf_counter()
+        response = answer(args.question, args.base_model, args.adapter_path)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(response if response is not None else "(pergunta desconhecida)")
+        print(f"\n[consulta em {elapsed_ms:.1f} ms]", file=sys.stderr)
+    if args.stats or not (args.build or args.question):
+        print(json.dumps(AnswerStore().stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Inferência offline em lote sobre um JSONL de prompts (retomável)
+
+Lê o JSONL de entrada em streaming (uma janela de linhas de cada vez), ordena cada
+janela pelo comprimento do prompt e gera as respostas em batches com batch_generate
+do mlx_lm (prompts de comprimento semelhante -> pouco padding no prefill). Os
+resultados são acrescentados ao JSONL de saída no fim de cada batch, com o índice
+da linha de entrada: se o processo for interrompido, voltar a correr o mesmo comando
+salta as linhas que já têm resposta.
+
+Entrada: uma linha JSON por prompt com o campo "prompt" (os restantes campos,
+p.ex. "completion", são copiados para a saída).
+
+Usage:
+    python scripts/batch_inference.py data/valid_v3_final_complete.jsonl outputs/valid_answers.jsonl
+    python scripts/batch_inference.py perguntas.jsonl respostas.jsonl --batch-size 16 --max-tokens 200
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from mlx_lm import batch_generate
+
+import model_loader
+from generation import cut_at_stop
+from prompt_format import format_sample
+
+BATCH_SIZE = 8
+WINDOW = 256          # Linhas lidas de cada vez para ordenar por comprimento
+MAX_TOKENS = 200
+
+
+def read_prompts(input_path, done):
+    """Gera (índice, registo) das linhas de entrada que ainda não têm resposta"""
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for index, line in enumerate(f):
+            if line.strip() and index not in done:
+                yield index, json.loads(line)
+
+
+def completed_indices(output_path):
+    """Índices já escritos na saída; corta uma última linha incompleta deixada por um crash"""
+    done = set()
+    if not Path(output_path).exists():
+        return done
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["index"])
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return done
+
+
+def length_sorted_batches(records, tokenizer, batch_size=BATCH_SIZE, window=WINDOW):
+    """Agrupa as linhas por janelas, ordena cada janela pelo comprimento e devolve batches"""
+    records = iter(records)
+    while chunk := list(itertools.islice(records, window)):
+        encoded = [
+            (index, record, tokenizer.encode(format_sample({"prompt": record["prompt"], "completion": ""})))
+            for index, record in chunk
+        ]
+        encoded.sort(key=lambda item: len(item[2]))
+        for i in range(0, len(encoded), batch_size):
+            yield encoded[i:i + batch_size]
+
+
+def run(input_path, output_path, base_model=model_loader.BASE_MODEL, adapter_path=model_loader.DEFAULT_ADAPTER_PATH,
+        batch_size=BATCH_SIZE, max_tokens=MAX_TOKENS, window=WINDOW):
+    done = completed_indices(output_path)
+    if done:
+        print(f"A retomar: {len(done)} respostas já existentes em {output_path}", file=sys.stderr)
+
+    model, tokenizer, mode = model_loader.load_model(base_model, adapter_path)
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+
+    totals = {"prompts": 0, "prompt_tokens": 0, "generation_tokens": 0}
+    start = time.perf_counter()
+    with open(output_path, 'a', encoding='utf-8') as out:
+        for batch in length_sorted_batches(read_prompts(input_path, done), tokenizer, batch_size, window):
+            result = batch_generate(model, tokenizer, [tokens for _, _, tokens in batch],
+                                    max_tokens=max_tokens, return_token_ids=True)
+            for (index, record, _), text, token_ids in zip(batch, result.texts, result.token_ids):
+                # batch_generate só pára no EOS: corta um novo bloco "### Pergunta" inventado pelo modelo
+                out.write(json.dumps({"index": index, **record, "response": cut_at_stop(text).strip(),
+                                      "generation_tokens": len(token_ids), "model": mode},
+                                     ensure_ascii=False) + "\n")
+            # Checkpoint: o batch só conta como feito depois de estar em disco
+            out.flush()
+            os.fsync(out.fileno())
+
+            totals["prompts"] += len(batch)
+            totals["prompt_tokens"] += result.stats.prompt_tokens
+            totals["generation_tokens"] += result.stats.generation_tokens
+            elapsed = time.perf_counter() - start
+            print(f"  {totals['prompts']} prompts | {totals['generation_tokens'] / elapsed:.1f} tokens/s | "
+                  f"{totals['prompts'] / elapsed:.2f} prompts/s", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    totals.update(
+        elapsed_sec=elapsed,
+        prompts_per_sec=totals["prompts"] / elapsed if elapsed > 0 else 0.0,
+        generation_tps=totals["generation_tokens"] / elapsed if elapsed > 0 else 0.0,
+        skipped=len(done),
+    )
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inferência offline em lote sobre um JSONL de prompts")
+    parser.add_argument("input", help="JSONL de entrada (campo 'prompt')")
+    parser.add_argument("output", help="JSONL de saída (acrescentado; permite retomar)")
+    parser.add_argument("--base-model", default=model_loader.BASE_MODEL)
+    parser.add_argument("--adapter-path", default=model_loader.DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--window", type=int, default=WINDOW, help="Linhas ordenadas por comprimento de cada vez")
+    args = parser.parse_args()
+
+    totals = run(args.input, args.output, args.base_model, args.adapter_path,
+                 args.batch_size, args.max_tokens, args.window)
+    print(json.dumps(totals, indent=2))
+
+
+if __name__ == "__main__":
+    main()
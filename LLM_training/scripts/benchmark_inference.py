@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Benchmark de inferência (base vs LoRA vs QLoRA)
+
+Para cada modelo mede, com iterações de aquecimento e vários ensaios repetidos:
+    - time-to-first-token (TTFT) e latência total por pedido (p50/p95/p99)
+    - prefill tokens/s e decode tokens/s, com as contagens exatas do gerador
+      (stream_generate / BatchGenerator do mlx_lm, sem re-tokenizar a resposta)
+    - memória de pico (mx.get_peak_memory)
+    - throughput agregado com N pedidos em simultâneo (BatchGenerator, batching contínuo)
+
+Os resultados são guardados num JSON versionado (schema_version, commit, plataforma),
+como em benchmark_training.py.
+
+Usage:
+    python scripts/benchmark_inference.py
+    python scripts/benchmark_inference.py --models base qlora --trials 10 --concurrency 1 2 4 8
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import time
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+import mlx.core as mx
+from mlx_lm import stream_generate
+from mlx_lm.generate import BatchGenerator
+
+import model_loader
+from benchmark_training import BENCHMARKS_DIR, _git_commit
+from prompt_format import format_prompt
+
+SCHEMA_VERSION = 1
+
+# Modelos a comparar: nome -> (modelo base, adaptador ou None)
+MODELS = {
+    "base": (model_loader.BASE_MODEL, None),
+    "lora": (model_loader.BASE_MODEL, str(model_loader.BASE_DIR / "checkpoints/adapters")),
+    "qlora": (model_loader.BASE_MODEL, model_loader.DEFAULT_ADAPTER_PATH),
+}
+
+PROMPTS = [
+    "Qual foi a melhor classificação do Farense?",
+    "Conte-me sobre Hassan Nader",
+    "Qual é a história do Sporting Clube Farense?",
+    "Quando foi fundado o Farense?",
+]
+MAX_TOKENS = 128
+WARMUP = 2
+TRIALS = 5
+CONCURRENCY = [1, 2, 4]
+
+
+def summarize(values):
+    """Média, desvio-padrão e percentis de uma lista de medições"""
+    if not values:
+        return {}
+    return {
+        "mean": float(np.mean(values)),
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "n": len(values),
+    }
+
+
+def measure_request(model, tokenizer, prompt, max_tokens=MAX_TOKENS):
+    """Um pedido com stream_generate: TTFT, latência e contagens/velocidades do próprio gerador"""
+    start = time.perf_counter()
+    ttft = None
+    last = None
+    for last in stream_generate(model, tokenizer, prompt, max_tokens=max_tokens):
+        if ttft is None:
+            ttft = time.perf_counter() - start
+    latency = time.perf_counter() - start
+    return {
+        "ttft_ms": ttft * 1000,
+        "latency_ms": latency * 1000,
+        "prompt_tokens": last.prompt_tokens,
+        "prefill_tps": last.prompt_tps,
+        "generation_tokens": last.generation_tokens,
+        "decode_tps": last.generation_tps,
+        "peak_memory_gb": last.peak_memory,
+    }
+
+
+def bench_sequential(model, tokenizer, prompts, max_tokens=MAX_TOKENS, warmup=WARMUP, trials=TRIALS):
+    """Pedidos um a um: `warmup` passagens descartadas e `trials` passagens por todos os prompts"""
+    for _ in range(warmup):
+        for prompt in prompts:
+            measure_request(model, tokenizer, prompt, max_tokens)
+
+    mx.reset_peak_memory()
+    runs = [measure_request(model, tokenizer, prompt, max_tokens) for _ in range(trials) for prompt in prompts]
+    return {
+        "requests": len(runs),
+        "ttft_ms": summarize([r["ttft_ms"] for r in runs]),
+        "latency_ms": summarize([r["latency_ms"] for r in runs]),
+        "prefill_tps": summarize([r["prefill_tps"] for r in runs]),
+        "decode_tps": summarize([r["decode_tps"] for r in runs]),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in runs),
+        "generation_tokens": sum(r["generation_tokens"] for r in runs),
+        "peak_memory_gb": max(r["peak_memory_gb"] for r in runs),
+    }
+
+
+def _concurrent_round(model, tokenizer, prompt_tokens, max_tokens):
+    """Submete todos os pedidos ao mesmo tempo e mede TTFT/latência de cada um"""
+    gen = BatchGenerator(model, stop_tokens=[[t] for t in tokenizer.eos_token_ids],
+                         completion_batch_size=len(prompt_tokens), prefill_batch_size=len(prompt_tokens))
+    start = time.perf_counter()
+    uids = gen.insert(prompt_tokens, [max_tokens] * len(prompt_tokens))
+    first, done = {}, {}
+    with gen.stats() as stats:
+        while responses := gen.next_generated():
+            now = time.perf_counter() - start
+            for r in responses:
+                first.setdefault(r.uid, now)
+                if r.finish_reason is not None:
+                    done[r.uid] = now
+    gen.close()
+    return [first[u] * 1000 for u in uids], [done[u] * 1000 for u in uids], stats
+
+
+def bench_concurrency(model, tokenizer, prompts, level, max_tokens=MAX_TOKENS, warmup=WARMUP, trials=TRIALS):
+    """`level` pedidos em simultâneo (batching contínuo); throughput agregado e latências por pedido"""
+    prompt_tokens = [tokenizer.encode(prompts[i % len(prompts)]) for i in range(level)]
+    for _ in range(warmup):
+        _concurrent_round(model, tokenizer, prompt_tokens, max_tokens)
+
+    mx.reset_peak_memory()
+    ttfts, latencies, throughputs, peak = [], [], [], 0.0
+    generation_tokens = 0
+    for _ in range(trials):
+        ttft, latency, stats = _concurrent_round(model, tokenizer, prompt_tokens, max_tokens)
+        ttfts += ttft
+        latencies += latency
+        throughputs.append(stats.generation_tokens / stats.wall_time if stats.wall_time > 0 else 0.0)
+        generation_tokens += stats.generation_tokens
+        peak = max(peak, stats.peak_memory)
+    return {
+        "concurrency": level,
+        "ttft_ms": summarize(ttfts),
+        "latency_ms": summarize(latencies),
+        "throughput_tps": summarize(throughputs),
+        "generation_tokens": generation_tokens,
+        "peak_memory_gb": peak,
+    }
+
+
+def benchmark(model, tokenizer, prompts=PROMPTS, max_tokens=MAX_TOKENS, warmup=WARMUP, trials=TRIALS,
+              concurrency=CONCURRENCY):
+    """Benchmark completo de um modelo já carregado"""
+    prompts = [format_prompt(p) for p in prompts]
+    result = {"sequential": bench_sequential(model, tokenizer, prompts, max_tokens, warmup, trials)}
+    seq = result["sequential"]
+    print(f"  sequencial: TTFT p50 {seq['ttft_ms']['p50']:.1f} ms, "
+          f"prefill {seq['prefill_tps']['p50']:.0f} t/s, decode {seq['decode_tps']['p50']:.1f} t/s")
+    result["concurrency"] = []
+    for level in concurrency:
+        entry = bench_concurrency(model, tokenizer, prompts, level, max_tokens, warmup, trials)
+        result["concurrency"].append(entry)
+        print(f"  {level} em simultâneo: {entry['throughput_tps']['p50']:.1f} t/s agregados, "
+              f"latência p95 {entry['latency_ms']['p95']:.0f} ms")
+    return result
+
+
+def run(models, **kwargs):
+    """Carrega e mede cada modelo, um de cada vez"""
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "git_commit": _git_commit(),
+        "platform": {
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "system": platform.system(),
+            "python": platform.python_version(),
+            "mlx": metadata.version("mlx"),
+            "mlx_lm": metadata.version("mlx-lm"),
+            "device": str(mx.default_device()),
+        },
+        "settings": {k: v for k, v in kwargs.items() if k != "prompts"},
+        "prompts": kwargs.get("prompts", PROMPTS),
+        "models": {},
+    }
+    for name, (base_model, adapter_path) in models.items():
+        print(f"\n⚡ {name}: {base_model} + {adapter_path}")
+        model, tokenizer, mode = model_loader.load_model(base_model, adapter_path)
+        report["models"][name] = {"base_model": base_model, "adapter_path": adapter_path, "mode": mode,
+                                  **benchmark(model, tokenizer, **kwargs)}
+        del model, tokenizer
+        mx.clear_cache()
+    return report
+
+
+def print_comparison(report):
+    print(f"\n{'Modelo':<10} {'TTFT p50':>10} {'Lat. p95':>10} {'Prefill t/s':>12} "
+          f"{'Decode t/s':>16} {'Pico GB':>8}")
+    print("-" * 72)
+    for name, result in report["models"].items():
+        seq = result["sequential"]
+        decode = f"{seq['decode_tps']['mean']:.1f} ± {seq['decode_tps']['stdev']:.1f}"
+        print(f"{name:<10} {seq['ttft_ms']['p50']:>10.1f} {seq['latency_ms']['p95']:>10.0f} "
+              f"{seq['prefill_tps']['p50']:>12.0f} {decode:>16} {seq['peak_memory_gb']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de inferência (TTFT, prefill/decode, concorrência)")
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--base-model", help="Substituir o modelo base de todos os modelos")
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--trials", type=int, default=TRIALS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=CONCURRENCY)
+    parser.add_argument("--output", type=Path, help="Guardar o relatório neste ficheiro JSON")
+    args = parser.parse_args()
+
+    models = {name: (args.base_model or MODELS[name][0], MODELS[name][1]) for name in args.models}
+    report = run(models, prompts=PROMPTS, max_tokens=args.max_tokens, warmup=args.warmup,
+                 trials=args.trials, concurrency=args.concurrency)
+    print_comparison(report)
+
+    output = args.output or BENCHMARKS_DIR / f"inference_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n✓ Resultados guardados em {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Benchmark da KV cache quantizada (fp16 vs 8 bits vs 4 bits)
+
+Para cada configuração mede, com o mesmo modelo carregado:
+    - memória da KV cache por token de contexto (bytes dos tensores da cache, incluindo
+      escalas/biases da quantização) e memória de pico com um contexto longo;
+    - qualidade nos prompts de validação (valid_v3_final_complete.jsonl):
+        * NLL/perplexidade da resposta de referência com a cache do prompt quantizada e
+          divergência KL média face às distribuições da cache fp16;
+        * concordância da geração greedy com a da cache fp16 (sequências idênticas e
+          comprimento médio do prefixo comum);
+    - velocidade de decode (tokens/s) na geração greedy.
+
+Os resultados são guardados num JSON versionado, como em benchmark_inference.py.
+
+Usage:
+    python scripts/benchmark_kv_cache.py
+    python scripts/benchmark_kv_cache.py --kv-bits 8 4 --samples 50 --context-tokens 4096
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+from pathlib import Path
+
+import mlx.core as mx
+from mlx_lm.models.cache import make_prompt_cache
+
+import generation
+import model_loader
+from benchmark_inference import SCHEMA_VERSION, summarize
+from benchmark_training import BENCHMARKS_DIR, _git_commit
+
+VALID_FILE = model_loader.BASE_DIR / "data/valid_v3_final_complete.jsonl"
+KV_BITS = [8, 4]         # Comparados sempre com a cache fp16
+SAMPLES = 20
+MAX_TOKENS = 128
+CONTEXT_TOKENS = 2048
+
+
+def load_samples(path=VALID_FILE, limit=SAMPLES):
+    samples = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                samples.append(json.loads(line))
+            if len(samples) == limit:
+                break
+    return samples
+
+
+def _quantize(cache, kv_bits, kv_group_size):
+    return [c.to_quantized(group_size=kv_group_size, bits=kv_bits) for c in cache] if kv_bits else cache
+
+
+def _allocated_tokens(c):
+    keys = c.keys[0] if isinstance(c.keys, (tuple, list)) else c.keys
+    return keys.shape[2]
+
+
+def cache_bytes_per_token(model, tokenizer, samples, kv_bits, kv_group_size, context_tokens=CONTEXT_TOKENS):
+    """Bytes da KV cache por token de contexto (todas as camadas) e memória de pico com esse contexto"""
+    tokens = tokenizer.encode(" ".join(s["prompt"] + " " + s.get("completion", "") for s in samples))
+    tokens = (tokens * (context_tokens // len(tokens) + 1))[:context_tokens]
+    mx.clear_cache()
+    mx.reset_peak_memory()
+    cache = make_prompt_cache(model)
+    for start in range(0, len(tokens), 512):
+        model(mx.array(tokens[start:start + 512])[None], cache=cache)
+        if kv_bits and not start:
+            cache = _quantize(cache, kv_bits, kv_group_size)
+        mx.eval([c.state for c in cache])
+    per_token = sum(c.nbytes / _allocated_tokens(c) for c in cache)
+    return per_token, mx.get_peak_memory() / 1e9
+
+
+def reference_scores(model, tokenizer, sample, kv_bits, kv_group_size):
+    """Log-probabilidades da resposta de referência, com a cache do prompt (opcionalmente) quantizada"""
+    prompt = tokenizer.encode(generation.format_prompt(sample["prompt"]))
+    completion = tokenizer.encode(" " + sample["completion"].strip(), add_special_tokens=False)[:MAX_TOKENS]
+    cache = make_prompt_cache(model)
+    model(mx.array(prompt[:-1])[None], cache=cache)
+    cache = _quantize(cache, kv_bits, kv_group_size)
+    logits = model(mx.array(prompt[-1:] + completion[:-1])[None], cache=cache)[0].astype(mx.float32)
+    logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+    return logprobs, mx.array(completion)
+
+
+def quality(model, tokenizer, samples, kv_bits, kv_group_size, baseline=None):
+    """NLL da referência, KL face à cache fp16 e concordância greedy (baseline = tokens gerados com fp16)"""
+    nll, kl, agreement, prefix, decode_tps, generated = [], [], [], [], [], []
+    for i, sample in enumerate(samples):
+        if "completion" in sample:
+            logprobs, targets = reference_scores(model, tokenizer, sample, kv_bits, kv_group_size)
+            nll.append(-mx.take_along_axis(logprobs, targets[:, None], axis=-1).mean().item())
+            if kv_bits:
+                base, _ = reference_scores(model, tokenizer, sample, None, kv_group_size)
+                kl.append((mx.exp(base) * (base - logprobs)).sum(axis=-1).mean().item())
+
+        result = generation.generate(model, tokenizer, generation.format_prompt(sample["prompt"]), MAX_TOKENS,
+                                     kv_bits=kv_bits, kv_group_size=kv_group_size, quantized_kv_start=0)
+        generated.append(result["tokens"])
+        decode_tps.append(result["generation_tps"])
+        if baseline:
+            reference = baseline[i]
+            common = next((k for k, (a, b) in enumerate(zip(reference, result["tokens"])) if a != b),
+                          min(len(reference), len(result["tokens"])))
+            agreement.append(float(reference == result["tokens"]))
+            prefix.append(common)
+    report = {
+        "nll": summarize(nll),
+        "perplexity": math.exp(sum(nll) / len(nll)) if nll else None,
+        "decode_tps": summarize(decode_tps),
+    }
+    if baseline:
+        report.update(kl_vs_fp16=summarize(kl), identical_greedy=sum(agreement) / len(agreement),
+                      common_prefix_tokens=summarize(prefix))
+    return report, generated
+
+
+def run(base_model, adapter_path, kv_bits_list=KV_BITS, kv_group_size=generation.KV_GROUP_SIZE, samples=SAMPLES,
+        context_tokens=CONTEXT_TOKENS, valid_file=VALID_FILE):
+    # A qualidade só tem significado nos prompts de validação com resposta de referência
+    if not Path(valid_file).exists():
+        raise FileNotFoundError(f"Ficheiro de validação não encontrado: {valid_file} (usar --valid-file)")
+    model, tokenizer, mode = model_loader.load_model(base_model, adapter_path)
+    generation.check_kv_group_size(model, kv_group_size)
+    data = load_samples(valid_file, samples)
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "git_commit": _git_commit(),
+        "base_model": base_model,
+        "adapter_path": adapter_path,
+        "mode": mode,
+        "settings": {"valid_file": str(valid_file), "kv_group_size": kv_group_size, "samples": len(data), "max_tokens": MAX_TOKENS,
+                     "context_tokens": context_tokens},
+        "configs": {},
+    }
+
+    baseline = None
+    for kv_bits in [None] + list(kv_bits_list):
+        name = f"{kv_bits}bit" if kv_bits else "fp16"
+        per_token, peak = cache_bytes_per_token(model, tokenizer, data, kv_bits, kv_group_size, context_tokens)
+        result, generated = quality(model, tokenizer, data, kv_bits, kv_group_size, baseline)
+        result.update(kv_bytes_per_token=per_token, peak_memory_gb=peak)
+        if baseline is None:
+            # Referência fp16 para a concordância greedy das configurações quantizadas
+            baseline = generated
+            fp16_bytes = per_token
+        result["memory_reduction"] = fp16_bytes / per_token
+        report["configs"][name] = result
+        print(f"  {name}: {per_token / 1024:.1f} KB/token ({result['memory_reduction']:.2f}x), "
+              f"perplexidade {result['perplexity'] or float('nan'):.3f}, decode {result['decode_tps']['mean']:.1f} t/s"
+              + (f", greedy idêntico {result['identical_greedy']:.0%}" if "identical_greedy" in result else ""))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memória e qualidade da KV cache quantizada")
+    parser.add_argument("--base-model", default=model_loader.BASE_MODEL)
+    parser.add_argument("--adapter-path", default=model_loader.DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--kv-bits", type=int, nargs="+", choices=[4, 8], default=KV_BITS)
+    parser.add_argument("--kv-group-size", type=int, choices=generation.KV_GROUP_SIZES, default=generation.KV_GROUP_SIZE)
+    parser.add_argument("--valid-file", type=Path, default=VALID_FILE, help="JSONL com 'prompt' e 'completion'")
+    parser.add_argument("--samples", type=int, default=SAMPLES, help="Prompts de validação avaliados")
+    parser.add_argument("--context-tokens", type=int, default=CONTEXT_TOKENS, help="Contexto para medir a memória")
+    parser.add_argument("--output", type=Path, help="Guardar o relatório neste ficheiro JSON")
+    args = parser.parse_args()
+
+    try:
+        report = run(args.base_model, args.adapter_path, args.kv_bits, args.kv_group_size, args.samples,
+                     args.context_tokens, args.valid_file)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+    output = args.output or BENCHMARKS_DIR / f"kv_cache_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n✓ Resultados guardados em {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Benchmark do passo de treino com um modelo sintético pequeno (corre em CPU)
+
+Constrói um modelo de arquitetura Mistral pequeno e inicializado aleatoriamente,
+quantizado a 4 bits como o mistral-7b-4bit, no backend CPU do MLX, e aplica LoRA
+com linear_to_lora_layers usando a qlora_config de train_qlora.py. Mede, numa
+grelha de batch x sequência, o código real do treino:
+    - tokenização (train_qlora.tokenize)
+    - montagem de batches (train_qlora.build_batch)
+    - passos de treino compilados (train_qlora.create_step_fn)
+    - passos de avaliação (train_qlora.create_eval_fn)
+    - gravação de checkpoints (model.save_weights, como no loop de treino)
+
+Os resultados são guardados em JSON para comparar commits em qualquer máquina Linux.
+
+Usage:
+    python scripts/benchmark_training.py
+    python scripts/benchmark_training.py --save-baseline
+    python scripts/benchmark_training.py --compare benchmarks/baseline_training.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+import mlx.core as mx
+import mlx.nn as nn
+from mlx.optimizers import AdamW
+from mlx_lm.models import llama
+from mlx_lm.tuner import linear_to_lora_layers
+
+import train_qlora
+
+BASE_DIR = Path(__file__).parent.parent
+BENCHMARKS_DIR = BASE_DIR / "benchmarks"
+DEFAULT_BASELINE = BENCHMARKS_DIR / "baseline_training.json"
+SCHEMA_VERSION = 1
+
+TINY_MODEL = {
+    "hidden_size": 256,
+    "num_hidden_layers": 4,
+    "intermediate_size": 704,
+    "num_attention_heads": 8,
+    "num_key_value_heads": 2,
+    "vocab_size": 8192,
+}
+BATCH_SIZES = [1, 2, 4]
+SEQ_LENGTHS = [128, 256, 512]
+WARMUP = 2
+ITERATIONS = 5
+REGRESSION_THRESHOLD = 0.10
+
+
+class ByteTokenizer:
+    """Tokenizer sintético (bytes UTF-8 + BOS) para medir tokenize() sem descarregar o tokenizer real"""
+
+    eos_token = "</s>"
+
+    def encode(self, text):
+        return [1] + [3 + b for b in text.encode("utf-8")]
+
+
+def build_tiny_model(config=TINY_MODEL, quantize=True):
+    """Modelo Mistral pequeno, aleatório, com LoRA aplicado como em train_qlora.load_lora_model"""
+    args = llama.ModelArgs(
+        model_type="mistral",
+        rms_norm_eps=1e-5,
+        tie_word_embeddings=False,
+        **config,
+    )
+    model = llama.Model(args)
+    if quantize:
+        nn.quantize(model, group_size=train_qlora.qlora_config["group_size"], bits=4)
+    model.freeze()
+    num_layers = min(train_qlora.qlora_config["num_layers"], config["num_hidden_layers"] // 2)
+    linear_to_lora_layers(model, num_layers, train_qlora.qlora_config["lora_parameters"])
+    mx.eval(model.parameters())
+    return model
+
+
+def synthetic_samples(batch_size, seq_length, vocab_size):
+    """Amostras (tokens, prompt_len) com seq_length + 1 tokens e metade da sequência como prompt"""
+    rng = np.random.default_rng(0)
+    return [
+        (rng.integers(3, vocab_size, seq_length + 1).tolist(), seq_length // 2)
+        for _ in range(batch_size)
+    ]
+
+
+def _timed(fn, warmup=WARMUP, iterations=ITERATIONS):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_ms": float(np.median(times)) * 1000,
+        "p90_ms": float(np.percentile(times, 90)) * 1000,
+        "min_ms": float(np.min(times)) * 1000,
+    }
+
+
+def bench_tokenization(num_samples=500):
+    tokenizer = ByteTokenizer()
+    samples = [
+        {"prompt": f"Qual foi o resultado do Farense no jogo {i}?",
+         "completion": "O Farense venceu por 2-1 no Estádio de São Luís. " * 4}
+        for i in range(num_samples)
+    ]
+    result = _timed(lambda: [train_qlora.tokenize(s, tokenizer, 512) for s in samples])
+    result["samples_per_sec"] = num_samples / (result["median_ms"] / 1000)
+    return result
+
+
+def bench_grid(model, batch_sizes, seq_lengths):
+    results = {"batch_build": [], "train_step": [], "eval_step": []}
+    vocab_size = model.args.vocab_size
+    for seq_length in seq_lengths:
+        for batch_size in batch_sizes:
+            samples = synthetic_samples(batch_size, seq_length, vocab_size)
+            grid = {"batch_size": batch_size, "seq_length": seq_length}
+            tokens = batch_size * seq_length
+
+            results["batch_build"].append({**grid, **_timed(lambda: mx.eval(train_qlora.build_batch(samples)))})
+
+            batch = train_qlora.build_batch(samples)
+            optimizer = AdamW(learning_rate=train_qlora.training_config["learning_rate"])
+            step_fn = train_qlora.create_step_fn(model, optimizer)
+
+            def train_step():
+                loss = step_fn(*batch)
+                mx.eval(model.parameters(), optimizer.state, loss)
+
+            timing = _timed(train_step)
+            timing["tokens_per_sec"] = tokens / (timing["median_ms"] / 1000)
+            results["train_step"].append({**grid, **timing})
+
+            eval_fn = train_qlora.create_eval_fn(model)
+            timing = _timed(lambda: mx.eval(eval_fn(*batch)))
+            timing["tokens_per_sec"] = tokens / (timing["median_ms"] / 1000)
+            results["eval_step"].append({**grid, **timing})
+
+            print(f"  batch {batch_size} x seq {seq_length}: "
+                  f"train {results['train_step'][-1]['median_ms']:.1f} ms, "
+                  f"eval {results['eval_step'][-1]['median_ms']:.1f} ms")
+    return results
+
+
+def bench_checkpoint(model):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "adapters.safetensors")
+        return _timed(lambda: model.save_weights(path), warmup=1, iterations=5)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def run(batch_sizes=BATCH_SIZES, seq_lengths=SEQ_LENGTHS, quantize=True):
+    mx.set_default_device(mx.cpu)
+    print(f"A construir modelo sintético ({TINY_MODEL}, quantize={quantize}) no CPU...")
+    model = build_tiny_model(quantize=quantize)
+
+    print("Tokenização...")
+    results = {"tokenization": bench_tokenization()}
+    print("Grelha batch x sequência...")
+    results.update(bench_grid(model, batch_sizes, seq_lengths))
+    print("Checkpoint...")
+    results["checkpoint_save"] = bench_checkpoint(model)
+
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "git_commit": _git_commit(),
+        "platform": {
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "system": platform.system(),
+            "python": platform.python_version(),
+            "mlx": metadata.version("mlx"),
+            "mlx_lm": metadata.version("mlx-lm"),
+        },
+        "model": {**TINY_MODEL, "quantized": quantize},
+        "results": results,
+    }
+
+
+def _entries(report):
+    """Achata o relatório em {(benchmark, batch, seq): median_ms}"""
+    flat = {}
+    for name, value in report["results"].items():
+        if isinstance(value, list):
+            for entry in value:
+                flat[(name, entry["batch_size"], entry["seq_length"])] = entry["median_ms"]
+        else:
+            flat[(name, None, None)] = value["median_ms"]
+    return flat
+
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Compara medianas com um baseline; devolve a lista de regressões acima do limiar"""
+    base = _entries(baseline)
+    regressions = []
+    print(f"\n{'Benchmark':<28} {'Baseline (ms)':>14} {'Atual (ms)':>12} {'Δ':>8}")
+    print("-" * 66)
+    for key, value in _entries(current).items():
+        if key not in base:
+            continue
+        name = key[0] if key[1] is None else f"{key[0]} b{key[1]}xs{key[2]}"
+        delta = (value - base[key]) / base[key] if base[key] > 0 else 0.0
+        flag = " ⚠️" if delta > threshold else ""
+        print(f"{name:<28} {base[key]:>14.2f} {value:>12.2f} {delta:>+7.1%}{flag}")
+        if delta > threshold:
+            regressions.append((name, delta))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do passo de treino (modelo sintético em CPU)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--seq-lengths", type=int, nargs="+", default=SEQ_LENGTHS)
+    parser.add_argument("--no-quantize", action="store_true", help="Usar pesos float em vez de 4 bits")
+    parser.add_argument("--output", type=Path, help="Guardar o relatório neste ficheiro JSON")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Guardar como baseline ({DEFAULT_BASELINE})")
+    parser.add_argument("--compare", type=Path, help="Comparar com um relatório/baseline JSON")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"Regressão relativa tolerada (default: {REGRESSION_THRESHOLD})")
+    args = parser.parse_args()
+
+    report = run(args.batch_sizes, args.seq_lengths, quantize=not args.no_quantize)
+
+    output = DEFAULT_BASELINE if args.save_baseline else args.output
+    if output is None:
+        output = BENCHMARKS_DIR / f"training_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n✓ Resultados guardados em {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n✗ {len(regressions)} regressões acima de {args.threshold:.0%}")
+            sys.exit(1)
+        print("\n✓ Sem regressões")
+
+
+if __name__ == "__main__":
+    main()
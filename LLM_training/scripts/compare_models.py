@@ -5,12 +5,12 @@ Execução: python scripts/compare_models.py
 """
 
 import json
-import time
 from pathlib import Path
 from datetime import datetime
 
 try:
-    from mlx_lm import load, generate
+    from mlx_lm import load
+    import benchmark_inference
 except ImportError:
     print("Error: mlx-lm not installed. Run: pip install mlx mlx-lm")
     exit(1)
@@ -30,6 +30,7 @@ TEST_PROMPTS = [
 class ModelComparator:
     def __init__(self):
         self.results = {
+            "schema_version": benchmark_inference.SCHEMA_VERSION,
             "timestamp": datetime.now().isoformat(),
             "models": {},
             "comparison": {}
@@ -59,59 +60,10 @@ class ModelComparator:
             return None, None
 
     def benchmark_model(self, name, model, tokenizer, prompts, max_tokens=150):
-        """Benchmark a model"""
+        """Benchmark a model (TTFT, prefill/decode tokens/sec, percentiles, concurrency; see benchmark_inference.py)"""
         print(f"\n⚡ Benchmarking {name}...")
-
-        results = {
-            "name": name,
-            "responses": [],
-            "timing": [],
-            "avg_tokens_per_sec": 0,
-            "total_time": 0
-        }
-
-        for i, prompt in enumerate(prompts, 1):
-            print(f"  [{i}/{len(prompts)}] {prompt[:50]}...", end=" ", flush=True)
-
-            try:
-                start_time = time.time()
-                response = generate(
-                    model,
-                    tokenizer,
-                    prompt=prompt,
-                    max_tokens=max_tokens,
-                    verbose=False
-                )
-                inference_time = time.time() - start_time
-
-                tokens_generated = len(tokenizer.encode(response))
-                tokens_per_sec = tokens_generated / inference_time if inference_time > 0 else 0
-
-                results["responses"].append({
-                    "prompt": prompt,
-                    "response": response[:200],  # Truncate for storage
-                    "tokens": tokens_generated,
-                    "time_seconds": inference_time,
-                    "tokens_per_sec": tokens_per_sec
-                })
-
-                results["timing"].append(inference_time)
-
-                print(f"✓ ({inference_time:.2f}s, {tokens_per_sec:.0f} t/s)")
-
-            except Exception as e:
-                print(f"✗ Error: {str(e)[:50]}")
-                results["responses"].append({
-                    "prompt": prompt,
-                    "error": str(e)
-                })
-
-        if results["timing"]:
-            results["total_time"] = sum(results["timing"])\n            results["avg_time"] = sum(results["timing"]) / len(results["timing"])
-            results["avg_tokens_per_sec"] = sum(
-                r["tokens_per_sec"] for r in results["responses"] if "tokens_per_sec" in r
-            ) / len([r for r in results["responses"] if "tokens_per_sec" in r])
-
+        results = benchmark_inference.benchmark(model, tokenizer, prompts=prompts, max_tokens=max_tokens)
+        results["name"] = name
         return results
 
     def compare(self):
@@ -163,28 +115,31 @@ class ModelComparator:
         self.save_results()
 
     def print_comparison(self, lora_results, qlora_results):
-        \"\"\"Print comparison table\"\"\"
+        """Print comparison table"""
         print("\n" + "=" * 70)
         print("COMPARISON RESULTS")
         print("=" * 70)
 
-        lora_time = lora_results.get("avg_time", 0)
-        qlora_time = qlora_results.get("avg_time", 0)
-        lora_speed = lora_results.get("avg_tokens_per_sec", 0)
-        qlora_speed = qlora_results.get("avg_tokens_per_sec", 0)
+        lora_seq = lora_results["sequential"]
+        qlora_seq = qlora_results["sequential"]
+        lora_time = lora_seq["latency_ms"]["p50"] / 1000
+        qlora_time = qlora_seq["latency_ms"]["p50"] / 1000
 
         speedup = (lora_time - qlora_time) / lora_time * 100 if lora_time > 0 else 0
 
-        print(f"\n{'Metric':<30} {'LoRA':<20} {'QLoRA':<20}\"")
+        print(f"\n{'Metric':<30} {'LoRA':<20} {'QLoRA':<20}")
         print("-" * 70)
-        print(f"{'Avg Response Time (s)':<30} {lora_time:<20.2f} {qlora_time:<20.2f}\")
-        print(f"{'Avg Speed (tokens/sec)':<30} {lora_speed:<20.0f} {qlora_speed:<20.0f}\")
-        print(f"{'Total Time for Tests (s)':<30} {lora_results['total_time']:<20.2f} {qlora_results['total_time']:<20.2f}\")
-        print(f"{'Responses Generated':<30} {len(lora_results['responses']):<20} {len(qlora_results['responses']):<20}\")
+        print(f"{'Median Response Time (s)':<30} {lora_time:<20.2f} {qlora_time:<20.2f}")
+        print(f"{'p95 Response Time (s)':<30} {lora_seq['latency_ms']['p95'] / 1000:<20.2f} {qlora_seq['latency_ms']['p95'] / 1000:<20.2f}")
+        print(f"{'Time to First Token (ms)':<30} {lora_seq['ttft_ms']['p50']:<20.1f} {qlora_seq['ttft_ms']['p50']:<20.1f}")
+        print(f"{'Prefill Speed (tokens/sec)':<30} {lora_seq['prefill_tps']['p50']:<20.0f} {qlora_seq['prefill_tps']['p50']:<20.0f}")
+        print(f"{'Decode Speed (tokens/sec)':<30} {lora_seq['decode_tps']['p50']:<20.1f} {qlora_seq['decode_tps']['p50']:<20.1f}")
+        print(f"{'Peak Memory (GB)':<30} {lora_seq['peak_memory_gb']:<20.2f} {qlora_seq['peak_memory_gb']:<20.2f}")
+        print(f"{'Responses Generated':<30} {lora_seq['requests']:<20} {qlora_seq['requests']:<20}")
         print("-" * 70)
 
         if speedup > 0:
-            print(f"\n✓ QLoRA is {speedup:.1f}% {'faster' if speedup > 0 else 'slower'} than LoRA\")
+            print(f"\n✓ QLoRA is {speedup:.1f}% {'faster' if speedup > 0 else 'slower'} than LoRA")
 
         print("\n📊 MODEL SPECS:")
         print("  LoRA:")
@@ -197,20 +152,20 @@ class ModelComparator:
         print("\n✓ Recommendation: Use QLoRA for Mac M1 in production")
 
     def save_results(self):
-        \"\"\"Save results to JSON\"\"\"
-        output_path = Path("/Users/f.nuno/Desktop/chatbot_2.0/LLM_training/output/comparison_results.json\")
+        """Save results to JSON"""
+        output_path = Path("/Users/f.nuno/Desktop/chatbot_2.0/LLM_training/output/comparison_results.json")
         with open(output_path, 'w') as f:
             json.dump(self.results, f, indent=2, default=str)
-        print(f"\n✓ Results saved to {output_path}\")
+        print(f"\n✓ Results saved to {output_path}")
 
 def main():
     try:
         comparator = ModelComparator()
         comparator.compare()
     except KeyboardInterrupt:
-        print("\n✗ Comparison interrupted by user\")
+        print("\n✗ Comparison interrupted by user")
     except Exception as e:
-        print(f"\n✗ Error: {e}\")
+        print(f"\n✗ Error: {e}")
         import traceback
         traceback.print_exc()
 
@@ -0,0 +1,52 @@
+"""
+Embeddings de texto com um modelo local pequeno (MLX).
+
+Qualquer modelo de linguagem suportado pelo mlx_lm serve de codificador: os estados
+ocultos da última camada (depois da norma final) são agregados por média e
+normalizados (L2), pelo que o produto interno entre dois vetores é a semelhança
+cosseno. Usado pelo índice de recuperação (retrieval.py) para os vetores densos.
+
+O modelo por omissão vive em models/embedding (p.ex. um modelo pequeno convertido
+com mlx_lm.convert); o modelo 7B também funciona, mas é lento para indexar.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import mlx.core as mx
+from mlx_lm import load
+
+BASE_DIR = Path(__file__).parent.parent
+EMBEDDING_MODEL = str(BASE_DIR / "models/embedding")
+MAX_EMBED_TOKENS = 256
+EMBED_BATCH_SIZE = 16
+
+
+class Embedder:
+    """Codificador de frases: média dos estados ocultos finais, normalizada"""
+
+    def __init__(self, model_path=EMBEDDING_MODEL, max_tokens=MAX_EMBED_TOKENS):
+        self.model, self.tokenizer = load(model_path)
+        self.name = Path(model_path).name
+        self.max_tokens = max_tokens
+        self.dim = self.model.args.hidden_size
+
+    def embed_one(self, text):
+        return self.embed([text])[0]
+
+    def embed(self, texts, batch_size=EMBED_BATCH_SIZE):
+        """Matriz (len(texts), dim) float32 com uma linha normalizada por texto"""
+        encoded = [self.tokenizer.encode(text)[:self.max_tokens] or [0] for text in texts]
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        # Batches de comprimentos semelhantes; com atenção causal o padding à direita não
+        # altera os estados dos tokens reais, que são os únicos incluídos na média
+        order = sorted(range(len(texts)), key=lambda i: len(encoded[i]))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            width = len(encoded[batch[-1]])
+            tokens = mx.array([encoded[i] + [0] * (width - len(encoded[i])) for i in batch])
+            mask = mx.array([[1.0] * len(encoded[i]) + [0.0] * (width - len(encoded[i])) for i in batch])
+            hidden = self.model.model(tokens).astype(mx.float32)
+            pooled = (hidden * mask[..., None]).sum(axis=1) / mask.sum(axis=1, keepdims=True)
+            vectors[batch] = np.array(pooled)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Geração partilhada pelos scripts de inferência, com descodificação especulativa.
+
+Dois modos especulativos, ambos verificados pelo modelo principal num único forward
+e com output idêntico ao greedy normal:
+    - draft model: um modelo pequeno propõe k tokens;
+    - prompt lookup: sem modelo extra, os últimos n tokens gerados são procurados num
+      índice de n-gramas do prompt (e contexto recuperado) e a continuação encontrada
+      é proposta. Ideal para respostas que copiam nomes, datas e resultados do contexto.
+
+Com um modelo de rascunho (draft) pequeno e com o mesmo tokenizer, o draft propõe
+k tokens e o modelo 7B (+ adaptador) verifica-os todos num único forward
+(speculative_generate_step do mlx_lm). Em greedy, os tokens aceites são exatamente
+os que o 7B geraria sozinho; check_greedy_equivalence() confirma-o para um conjunto
+de prompts. Cada geração devolve as estatísticas de aceitação.
+
+Com kv_bits (8 ou 4) a KV cache é guardada quantizada por grupos (QuantizedKVCache do
+mlx_lm; a desquantização é feita dentro da atenção, com quantized_matmul), reduzindo
+2-4x a memória por token de contexto. Ao contrário da descodificação especulativa,
+altera ligeiramente o output; benchmark_kv_cache.py mede o impacto na qualidade.
+
+A geração pára no EOS ou quando o texto produz uma sequência de paragem (por omissão
+"### Pergunta", o início de um novo bloco inventado pelo modelo), verificada em
+streaming por StopMatcher; os tokens poupados face a max_tokens são reportados.
+
+O draft pode ser qualquer modelo pequeno com o tokenizer do Mistral (p.ex. um modelo
+destilado no dataset Farense) em models/draft.
+
+Usage:
+    python scripts/generation.py "Quem foi Hassan Nader?" --draft-model models/draft
+    python scripts/generation.py "Quem foi Hassan Nader?" --prompt-lookup
+    python scripts/generation.py "Quem foi Hassan Nader?" --draft-model models/draft --check
+    python scripts/generation.py "Quem foi Hassan Nader?" --rag --prompt-lookup
+    python scripts/generation.py "Quem foi Hassan Nader?" --rag --kv-bits 8
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import mlx.core as mx
+from mlx_lm import load
+from mlx_lm.generate import generate_step, maybe_quantize_kv_cache, speculative_generate_step
+from mlx_lm.models.cache import make_prompt_cache, trim_prompt_cache
+
+import model_loader
+import retrieval
+from prompt_format import format_prompt
+
+DRAFT_MODEL = str(model_loader.BASE_DIR / "models/draft")
+NUM_DRAFT_TOKENS = 4
+NUM_LOOKUP_TOKENS = 10   # Tokens propostos por correspondência no prompt lookup
+NGRAM_SIZE = 3           # Maior n-grama procurado (desce até 1 se não houver correspondência)
+STOP_SEQUENCES = ["### Pergunta"]
+MAX_TOKENS = 200
+KV_BITS = None           # 8 ou 4 para quantizar a KV cache
+KV_GROUP_SIZE = 64
+KV_GROUP_SIZES = (32, 64, 128)  # Grupos suportados pelo quantized_matmul do MLX
+QUANTIZED_KV_START = 0   # Posições em fp16 antes de a cache passar a quantizada
+
+
+def check_kv_group_size(model, kv_group_size):
+    """ValueError se o grupo não for suportado ou a dimensão das cabeças de atenção não for múltipla dele"""
+    if kv_group_size not in KV_GROUP_SIZES:
+        raise ValueError(f"kv_group_size {kv_group_size} não suportado; use um de {KV_GROUP_SIZES}")
+    head_dim = getattr(model.args, "head_dim", None) or model.args.hidden_size // model.args.num_attention_heads
+    if head_dim % kv_group_size:
+        valid = [g for g in sorted(KV_GROUP_SIZES, reverse=True) if head_dim % g == 0]
+        raise ValueError(f"kv_group_size {kv_group_size} não divide a dimensão das cabeças ({head_dim})"
+                         + (f"; use {valid[0]}" if valid else ""))
+
+
+def load_draft_model(draft_path, tokenizer):
+    """Carrega o modelo de rascunho e confirma que partilha o vocabulário do modelo principal"""
+    draft_model, draft_tokenizer = load(draft_path)
+    probe = "O Farense venceu por 2-1 no Estádio de São Luís."
+    if draft_tokenizer.vocab_size != tokenizer.vocab_size or draft_tokenizer.encode(probe) != tokenizer.encode(probe):
+        raise ValueError(f"O tokenizer do draft ({draft_path}) não é compatível com o do modelo principal")
+    return draft_model
+
+
+class StopMatcher:
+    """
+    Deteção incremental de sequências de paragem no texto gerado. feed() devolve o texto
+    que já pode ser emitido e retém o sufixo que ainda pode ser o início de uma sequência.
+    """
+
+    def __init__(self, stop_sequences=STOP_SEQUENCES):
+        self.stop_sequences = [seq for seq in stop_sequences if seq]
+        self.buffer = ""
+        self.stopped = False
+
+    def feed(self, segment):
+        self.buffer += segment
+        hits = [i for i in (self.buffer.find(seq) for seq in self.stop_sequences) if i >= 0]
+        if hits:
+            text, self.buffer, self.stopped = self.buffer[:min(hits)], "", True
+            return text
+        keep = 0
+        for seq in self.stop_sequences:
+            for k in range(min(len(seq) - 1, len(self.buffer)), keep, -1):
+                if self.buffer.endswith(seq[:k]):
+                    keep = k
+                    break
+        text, self.buffer = self.buffer[:len(self.buffer) - keep], self.buffer[len(self.buffer) - keep:]
+        return text
+
+    def flush(self):
+        text, self.buffer = self.buffer, ""
+        return text
+
+
+def cut_at_stop(text, stop_sequences=STOP_SEQUENCES):
+    """Texto até à primeira sequência de paragem (para geração que só pára no EOS)"""
+    for seq in stop_sequences:
+        if seq:
+            text = text.split(seq)[0]
+    return text
+
+
+class NgramIndex:
+    """Índice incremental: n-grama -> posição (mais recente) do token que se lhe seguiu"""
+
+    def __init__(self, tokens, ngram_size=NGRAM_SIZE):
+        self.ngram_size = ngram_size
+        self.tokens = []
+        self.index = {}
+        self.extend(tokens)
+
+    def extend(self, tokens):
+        for token in tokens:
+            self.tokens.append(token)
+            end = len(self.tokens) - 1
+            for n in range(1, self.ngram_size + 1):
+                if end >= n:
+                    self.index[tuple(self.tokens[end - n:end])] = end
+
+    def propose(self, num_tokens):
+        """Continuação do maior sufixo já visto antes (vazia se não houver correspondência)"""
+        for n in range(min(self.ngram_size, len(self.tokens)), 0, -1):
+            start = self.index.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + num_tokens]
+        return []
+
+
+def prompt_lookup_generate_step(prompt, model, context_tokens=None, num_draft_tokens=NUM_LOOKUP_TOKENS,
+                                ngram_size=NGRAM_SIZE, max_tokens=MAX_TOKENS, stats=None, kv_bits=None,
+                                kv_group_size=KV_GROUP_SIZE, quantized_kv_start=QUANTIZED_KV_START):
+    """
+    Como speculative_generate_step, mas as propostas vêm do índice de n-gramas do prompt,
+    do contexto e do texto já gerado. Gera (token, logprobs, from_draft); greedy.
+    """
+    prompt = prompt.tolist()
+    lookup = NgramIndex((context_tokens or []) + prompt, ngram_size)
+    cache = make_prompt_cache(model)
+    stats = stats if stats is not None else {}
+    stats.setdefault("drafted", 0)
+
+    # Prefill de tudo menos o último token, que entra no primeiro passo de verificação
+    if len(prompt) > 1:
+        model(mx.array(prompt[:-1])[None], cache=cache)
+        maybe_quantize_kv_cache(cache, quantized_kv_start, kv_group_size, kv_bits)
+        mx.eval([c.state for c in cache])
+    y = prompt[-1]
+
+    ntoks = 0
+    while ntoks < max_tokens:
+        draft = lookup.propose(min(num_draft_tokens, max_tokens - ntoks - 1))
+        logits = model(mx.array([y] + draft)[None], cache=cache)[0]
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        targets = mx.argmax(logits, axis=-1).tolist()
+        stats["drafted"] += len(draft)
+
+        n = 0
+        while n < len(draft) and targets[n] == draft[n]:
+            yield draft[n], logprobs[n], True
+            n += 1
+        yield targets[n], logprobs[n], False
+        ntoks += n + 1
+
+        # Descartar da cache as posições das propostas rejeitadas
+        trim_prompt_cache(cache, len(draft) - n)
+        maybe_quantize_kv_cache(cache, quantized_kv_start, kv_group_size, kv_bits)
+        lookup.extend(draft[:n] + [targets[n]])
+        y = targets[n]
+
+
+def generate(model, tokenizer, prompt, max_tokens=MAX_TOKENS, draft_model=None, num_draft_tokens=NUM_DRAFT_TOKENS,
+             prompt_lookup=False, context=None, ngram_size=NGRAM_SIZE, stop=STOP_SEQUENCES, kv_bits=KV_BITS,
+             kv_group_size=KV_GROUP_SIZE, quantized_kv_start=QUANTIZED_KV_START):
+    """
+    Gera a resposta (greedy) e devolve um dict com o texto, os tokens e as estatísticas.
+    kv_bits (8 ou 4): KV cache quantizada a partir da posição quantized_kv_start.
+    Em modo especulativo: accepted = tokens propostos e aceites, drafted = tokens propostos.
+    finish_reason: "stop" (EOS), "stop_sequence" ou "length".
+    """
+    prompt_tokens = mx.array(tokenizer.encode(prompt) if isinstance(prompt, str) else prompt)
+    stats = {"drafted": 0}
+    kv = {"kv_bits": kv_bits, "kv_group_size": kv_group_size, "quantized_kv_start": quantized_kv_start}
+    if prompt_lookup:
+        context_tokens = tokenizer.encode(context, add_special_tokens=False) if context else None
+        steps = prompt_lookup_generate_step(prompt_tokens, model, context_tokens, num_draft_tokens,
+                                            ngram_size, max_tokens, stats, **kv)
+    elif draft_model is not None:
+        steps = speculative_generate_step(prompt_tokens, model, draft_model,
+                                          num_draft_tokens=num_draft_tokens, max_tokens=max_tokens, **kv)
+    else:
+        steps = ((token, logprobs, False)
+                 for token, logprobs in generate_step(prompt_tokens, model, max_tokens=max_tokens, **kv))
+
+    count_drafted = draft_model is not None and not prompt_lookup  # o lookup conta as propostas em `stats`
+    detokenizer = tokenizer.detokenizer
+    matcher = StopMatcher(stop or [])
+    text = ""
+    tokens, finish_reason = [], "length"
+    accepted = rounds = 0
+    round_open = False
+    start = time.perf_counter()
+    prompt_time = None
+    for token, _, from_draft in steps:
+        if prompt_time is None:
+            prompt_time = time.perf_counter() - start
+        if token in tokenizer.eos_token_ids:
+            finish_reason = "stop"
+            break
+        # Cada ronda de verificação termina com um token do modelo principal
+        if count_drafted and not round_open:
+            stats["drafted"] += min(num_draft_tokens, max_tokens - len(tokens))
+        rounds += not round_open
+        round_open = from_draft
+        tokens.append(token)
+        accepted += from_draft
+        detokenizer.add_token(token)
+        text += matcher.feed(detokenizer.last_segment)
+        if matcher.stopped:
+            finish_reason = "stop_sequence"
+            break
+        if len(tokens) == max_tokens:
+            break
+    if not matcher.stopped:
+        detokenizer.finalize()
+        text += matcher.feed(detokenizer.last_segment) + matcher.flush()
+    elapsed = time.perf_counter() - start
+    decode_time = elapsed - (prompt_time or 0.0)
+
+    speculative = prompt_lookup or draft_model is not None
+    return {
+        "text": text,
+        "tokens": tokens,
+        "generation_tokens": len(tokens),
+        "elapsed_sec": elapsed,
+        "generation_tps": len(tokens) / decode_time if decode_time > 0 else 0.0,
+        "prompt_tps": prompt_tokens.size / prompt_time if prompt_time else 0.0,
+        "finish_reason": finish_reason,
+        "tokens_saved": max_tokens - len(tokens) if finish_reason != "length" else 0,
+        "accepted": accepted,
+        "drafted": stats["drafted"],
+        "acceptance_rate": accepted / stats["drafted"] if stats["drafted"] else 0.0,
+        "tokens_per_round": len(tokens) / rounds if speculative and rounds else 0.0,
+    }
+
+
+def check_greedy_equivalence(model, tokenizer, prompts, max_tokens=MAX_TOKENS, **speculative):
+    """Compara, prompt a prompt, os tokens greedy com e sem descodificação especulativa"""
+    results = []
+    for prompt in prompts:
+        reference = generate(model, tokenizer, prompt, max_tokens)
+        candidate = generate(model, tokenizer, prompt, max_tokens, **speculative)
+        results.append({
+            "prompt": prompt,
+            "identical": reference["tokens"] == candidate["tokens"],
+            "speedup": reference["elapsed_sec"] / candidate["elapsed_sec"] if candidate["elapsed_sec"] else 0.0,
+            "acceptance_rate": candidate["acceptance_rate"],
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Geração com descodificação especulativa (modelo de rascunho)")
+    parser.add_argument("prompt", help="Pergunta para o modelo")
+    parser.add_argument("--base-model", default=model_loader.BASE_MODEL)
+    parser.add_argument("--adapter-path", default=model_loader.DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--draft-model", default=None, help=f"Modelo de rascunho (p.ex. {DRAFT_MODEL})")
+    parser.add_argument("--prompt-lookup", action="store_true", help="Propostas por n-gramas do prompt (sem draft)")
+    parser.add_argument("--num-draft", type=int, default=None,
+                        help=f"Tokens propostos por ronda (default: {NUM_DRAFT_TOKENS} com draft, {NUM_LOOKUP_TOKENS} com lookup)")
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--check", action="store_true", help="Verificar que o output greedy é idêntico sem draft")
+    parser.add_argument("--kv-bits", type=int, choices=[4, 8], default=KV_BITS, help="Quantizar a KV cache")
+    parser.add_argument("--kv-group-size", type=int, choices=KV_GROUP_SIZES, default=KV_GROUP_SIZE,
+                        help="Tamanho dos grupos de quantização (divisor da dimensão das cabeças)")
+    parser.add_argument("--quantized-kv-start", type=int, default=QUANTIZED_KV_START,
+                        help="Posições em fp16 antes de quantizar a KV cache")
+    parser.add_argument("--rag", action="store_true", help="Juntar ao prompt os excertos recuperados de dados/")
+    parser.add_argument("--top-k", type=int, default=retrieval.TOP_K, help="Excertos recuperados com --rag")
+    args = parser.parse_args()
+
+    model, tokenizer, _ = model_loader.load_model(args.base_model, args.adapter_path)
+    if args.kv_bits:
+        try:
+            check_kv_group_size(model, args.kv_group_size)
+        except ValueError as e:
+            parser.error(str(e))
+    speculative = {}
+    if args.prompt_lookup:
+        speculative = {"prompt_lookup": True, "num_draft_tokens": args.num_draft or NUM_LOOKUP_TOKENS}
+    elif args.draft_model:
+        speculative = {"draft_model": load_draft_model(args.draft_model, tokenizer),
+                       "num_draft_tokens": args.num_draft or NUM_DRAFT_TOKENS}
+
+    context = None
+    if args.rag:
+        context = retrieval.retrieve_context(args.prompt, args.top_k)
+    prompt = format_prompt(args.prompt, context)
+    if args.check:
+        results = check_greedy_equivalence(model, tokenizer, [prompt], args.max_tokens, **speculative)
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        sys.exit(0 if all(r["identical"] for r in results) else 1)
+
+    result = generate(model, tokenizer, prompt, args.max_tokens, **speculative,
+                      kv_bits=args.kv_bits, kv_group_size=args.kv_group_size,
+                      quantized_kv_start=args.quantized_kv_start)
+    print(result["text"].strip())
+    print(f"\n[{result['generation_tokens']} tokens ({result['finish_reason']}, "
+          f"{result['tokens_saved']} poupados), {result['generation_tps']:.1f} t/s"
+          + (f", aceitação {result['acceptance_rate']:.0%}, {result['tokens_per_round']:.2f} tokens/ronda]"
+             if speculative else "]"), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Pesquisa de hiperparâmetros por successive halving (ASHA síncrono) num único processo.
+
+O modelo base é carregado e o dataset tokenizado uma só vez; entre ensaios apenas
+os adaptadores LoRA e o otimizador são recriados. Cada ronda ("rung") treina os
+ensaios sobreviventes até um orçamento de passos, avalia-os na subamostra fixa de
+validação (Validator) e promove apenas o melhor 1/eta para a ronda seguinte, com
+eta vezes mais passos. Os ensaios promovidos continuam de onde pararam (pesos LoRA
+e estado do AdamW guardados em memória).
+
+No fim é escrito um leaderboard (JSON/CSV) e exportado o adaptador do melhor ensaio.
+
+Usage:
+    python scripts/hparam_search.py
+    python scripts/hparam_search.py --trials 27 --min-steps 50 --eta 3
+"""
+
+import argparse
+import itertools
+import json
+import random
+import time
+from pathlib import Path
+
+import mlx.core as mx
+import pandas as pd
+from mlx.optimizers import AdamW
+from mlx.utils import tree_flatten
+from mlx_lm import load
+from mlx_lm.tuner import linear_to_lora_layers
+from mlx_lm.tuner.utils import remove_lora_layers
+
+import train_qlora
+from train_qlora import (
+    Validator, apply_grad_checkpointing, build_batch, create_eval_fn, create_step_fn,
+    load_batch, load_dataset, tokenize,
+)
+from trunk_cache import build_trunk_cache, num_frozen_layers
+
+SEARCH_DIR = train_qlora.CHECKPOINTS_DIR / "hparam_search"
+
+# Espaço de pesquisa (os ensaios são amostrados do produto cartesiano)
+search_space = {
+    "learning_rate": [5e-5, 1e-4, 2e-4, 5e-4],
+    "rank": [4, 6, 8, 16],
+    "dropout": [0.0, 0.05, 0.1],
+    "batch_size": [1, 2, 4],
+}
+
+search_config = {
+    "num_trials": 27,     # Ensaios na primeira ronda
+    "min_steps": 50,      # Orçamento (passos de treino) da primeira ronda
+    "eta": 3,             # Fator de redução: sobrevive 1/eta dos ensaios e o orçamento multiplica por eta
+    "max_steps": 1350,    # Orçamento máximo de um ensaio
+    "seed": 0,
+}
+
+
+def sample_trials(space, num_trials, seed=0):
+    """Amostra `num_trials` configurações distintas do espaço de pesquisa"""
+    grid = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    random.Random(seed).shuffle(grid)
+    return grid[:num_trials]
+
+
+class Trial:
+    """Um ensaio: configuração, progresso e estado (adaptadores + otimizador) entre rondas"""
+
+    def __init__(self, trial_id, params, seed):
+        self.trial_id = trial_id
+        self.params = params
+        self.seed = seed + trial_id
+        self.steps = 0
+        self.val_loss = float('inf')
+        self.history = []        # (passos, perda de validação) por ronda
+        self.adapters = None     # pesos LoRA treináveis
+        self.optimizer_state = None
+        self.train_time = 0.0
+
+    def batch_indices(self, step, num_samples):
+        """Índices do batch do passo `step` (ordem baralhada por época, determinística por ensaio)"""
+        batch_size = self.params["batch_size"]
+        steps_per_epoch = max(num_samples // batch_size, 1)
+        epoch, i = divmod(step, steps_per_epoch)
+        order = list(range(num_samples))
+        random.Random(self.seed * 1000 + epoch).shuffle(order)
+        return order[i * batch_size:(i + 1) * batch_size]
+
+
+class SearchRunner:
+    """Mantém o modelo base e os tokens carregados e corre os ensaios por successive halving"""
+
+    def __init__(self, output_dir=SEARCH_DIR):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.num_layers = train_qlora.qlora_config["num_layers"]
+        config = train_qlora.training_config
+
+        print(f"A carregar modelo: {train_qlora.model_name} (uma vez para toda a pesquisa)")
+        self.model, tokenizer = load(train_qlora.model_name)
+        tokenizer.pad_token = tokenizer.eos_token
+        self.model.freeze()
+
+        self.train_tokens = [tokenize(s, tokenizer, config["max_seq_length"]) for s in load_dataset(train_qlora.TRAIN_FILE)]
+        self.val_tokens = [tokenize(s, tokenizer, config["max_seq_length"]) for s in load_dataset(train_qlora.VALID_FILE)]
+        self.train_tokens = [(t, p) for t, p in self.train_tokens if len(t) > p]
+        self.val_tokens = [(t, p) for t, p in self.val_tokens if len(t) > p]
+        print(f"Amostras tokenizadas: {len(self.train_tokens)} treino, {len(self.val_tokens)} validação")
+
+        self.train_cache = self.val_cache = None
+        if config["cache_frozen_trunk"]:
+            num_frozen = num_frozen_layers(self.model, self.num_layers)
+            self.train_cache = build_trunk_cache(train_qlora.TRUNK_CACHE_DIR, self.model, train_qlora.model_name,
+                                                 num_frozen, self.train_tokens, build_batch)
+            self.val_cache = build_trunk_cache(train_qlora.TRUNK_CACHE_DIR, self.model, train_qlora.model_name,
+                                               num_frozen, self.val_tokens, build_batch)
+
+    def _attach(self, trial):
+        """Recria os adaptadores LoRA (e o otimizador) para o ensaio, retomando o seu estado"""
+        remove_lora_layers(self.model)
+        lora_parameters = dict(train_qlora.qlora_config["lora_parameters"])
+        lora_parameters.update(rank=trial.params["rank"], dropout=trial.params["dropout"])
+        # Inicialização dos adaptadores reprodutível por ensaio (e independente da ordem dos ensaios)
+        mx.random.seed(trial.seed)
+        linear_to_lora_layers(self.model, self.num_layers, lora_parameters)
+        apply_grad_checkpointing(self.model, self.num_layers, train_qlora.training_config["grad_checkpoint"])
+
+        optimizer = AdamW(learning_rate=trial.params["learning_rate"])
+        if trial.adapters is not None:
+            self.model.update(trial.adapters)
+            optimizer.state = trial.optimizer_state
+        optimizer.init(self.model.trainable_parameters())
+        mx.eval(self.model.parameters(), optimizer.state)
+        return optimizer
+
+    def run_trial(self, trial, target_steps, validator_subsample):
+        """Treina o ensaio até `target_steps` passos e devolve a perda de validação"""
+        optimizer = self._attach(trial)
+        step_fn = create_step_fn(self.model, optimizer)
+        validator = Validator(
+            create_eval_fn(self.model), self.val_tokens, self.val_cache,
+            batch_size=train_qlora.training_config["eval_batch_size"],
+            subsample_size=validator_subsample,
+        )
+
+        start = time.perf_counter()
+        for step in range(trial.steps, target_steps):
+            indices = trial.batch_indices(step, len(self.train_tokens))
+            loss = step_fn(*load_batch(self.train_tokens, indices, self.train_cache))
+            mx.eval(self.model.parameters(), optimizer.state, loss)
+        trial.train_time += time.perf_counter() - start
+        trial.steps = target_steps
+
+        # Comparar ensaios sempre na mesma subamostra fixa (ou no conjunto completo, se pequeno)
+        trial.val_loss = validator.loss(validator.subsample_indices if validator.subsampled else validator.full_indices)
+        trial.history.append((trial.steps, trial.val_loss))
+        trial.adapters = self.model.trainable_parameters()
+        trial.optimizer_state = optimizer.state
+        return trial.val_loss
+
+    def search(self, trials, min_steps, eta, max_steps, validator_subsample):
+        """Successive halving: cada ronda multiplica o orçamento por eta e mantém 1/eta dos ensaios"""
+        rung, budget, alive = 0, min_steps, list(trials)
+        while alive:
+            print(f"\n--- Ronda {rung}: {len(alive)} ensaios, {budget} passos ---")
+            for trial in alive:
+                val_loss = self.run_trial(trial, budget, validator_subsample)
+                print(f"  ensaio {trial.trial_id} {trial.params}: val {val_loss:.4f} ({trial.train_time:.0f}s)")
+            self.write_leaderboard(trials)
+
+            keep = len(alive) // eta
+            if keep == 0 or budget >= max_steps:
+                break
+            alive = sorted(alive, key=lambda t: t.val_loss)[:keep]
+            rung, budget = rung + 1, min(budget * eta, max_steps)
+
+        return sorted(trials, key=lambda t: (-t.steps, t.val_loss))
+
+    def write_leaderboard(self, trials):
+        # Ensaios que chegaram mais longe primeiro; dentro da mesma ronda, menor perda
+        rows = [
+            {"trial": t.trial_id, **t.params, "steps": t.steps, "val_loss": t.val_loss,
+             "train_time_sec": t.train_time, "history": t.history}
+            for t in sorted(trials, key=lambda t: (-t.steps, t.val_loss))
+        ]
+        with open(self.output_dir / "leaderboard.json", 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=4, ensure_ascii=False)
+        pd.DataFrame(rows).drop(columns=["history"]).to_csv(self.output_dir / "leaderboard.csv", index=False)
+
+    def export(self, trial):
+        """Guarda os adaptadores do ensaio no formato do mlx_lm (adapters.safetensors + adapter_config.json)"""
+        self._attach(trial)
+        export_dir = self.output_dir / f"best_trial_{trial.trial_id}"
+        export_dir.mkdir(parents=True, exist_ok=True)
+        # Só os pesos LoRA, como o mlx_lm guarda os adaptadores (não o modelo base inteiro)
+        mx.save_safetensors(str(export_dir / "adapters.safetensors"), dict(tree_flatten(self.model.trainable_parameters())))
+        lora_parameters = dict(train_qlora.qlora_config["lora_parameters"])
+        lora_parameters.update(rank=trial.params["rank"], dropout=trial.params["dropout"])
+        with open(export_dir / "adapter_config.json", 'w', encoding='utf-8') as f:
+            json.dump({"fine_tune_type": "lora", "num_layers": self.num_layers,
+                       "lora_parameters": lora_parameters, **trial.params}, f, indent=4, ensure_ascii=False)
+        return export_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pesquisa de hiperparâmetros por successive halving")
+    parser.add_argument("--trials", type=int, default=search_config["num_trials"])
+    parser.add_argument("--min-steps", type=int, default=search_config["min_steps"])
+    parser.add_argument("--eta", type=int, default=search_config["eta"])
+    parser.add_argument("--max-steps", type=int, default=search_config["max_steps"])
+    parser.add_argument("--seed", type=int, default=search_config["seed"])
+    args = parser.parse_args()
+
+    start = time.time()
+    runner = SearchRunner()
+    trials = [Trial(i, params, args.seed) for i, params in enumerate(sample_trials(search_space, args.trials, args.seed))]
+    ranking = runner.search(trials, args.min_steps, args.eta, args.max_steps,
+                            train_qlora.training_config["val_subsample"])
+
+    best = ranking[0]
+    export_dir = runner.export(best)
+    print(f"\n✓ Pesquisa concluída em {(time.time() - start) / 60:.1f} min")
+    print(f"Melhor ensaio {best.trial_id}: {best.params} -> val {best.val_loss:.4f} ({best.steps} passos)")
+    print(f"Adaptadores em {export_dir}; leaderboard em {runner.output_dir / 'leaderboard.csv'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Daemon local de inferência: mantém o modelo carregado e responde por um Unix socket.
+
+Os scripts de inferência (inference.py, inference_qlora.py, inference_during_training.py,
+interactive_inference.py) tentam primeiro o daemon com generate_remote(); se não houver
+daemon a correr (ou se servir outro modelo/adaptador) carregam o modelo no próprio processo.
+
+Protocolo: uma linha JSON por pedido e uma linha JSON por resposta.
+    {"cmd": "generate", "prompt": "...", "question": "...", "max_tokens": 200, "base_model": "...", "adapter_path": "..."}
+    {"cmd": "ping"} | {"cmd": "shutdown"}
+
+Quando o adaptador em disco muda (checkpoints durante o treino), os pesos LoRA são
+recarregados no pedido seguinte, sem voltar a ler o modelo base.
+
+Com um modelo de embeddings em models/embedding, os pedidos que indicam a pergunta
+original ("question") passam pela cache semântica (answer_cache.py): uma paráfrase de
+uma pergunta já respondida devolve a resposta guardada sem gerar. A cache é separada por
+formato do prompt e max_tokens (answer_cache.prompt_variant); prompts com contexto
+recuperado (--rag) não passam pela cache.
+
+Usage:
+    python scripts/inference_daemon.py
+    python scripts/inference_daemon.py --adapter-path checkpoints_qlora/adapters
+    python scripts/inference_daemon.py --no-cache
+    python scripts/inference_daemon.py --cache-threshold 0.97
+    python scripts/inference_daemon.py --status
+    python scripts/inference_daemon.py --stop
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+SOCKET_PATH = os.environ.get("FARENSE_INFERENCE_SOCKET", str(Path(tempfile.gettempdir()) / "farense_inference.sock"))
+CONNECT_TIMEOUT = 2.0
+REQUEST_TIMEOUT = 600.0
+
+
+def _same_path(a, b):
+    if a is None or b is None:
+        return a == b
+    return os.path.realpath(a) == os.path.realpath(b)
+
+
+def _adapter_signature(adapter_path):
+    weights = Path(adapter_path) / "adapters.safetensors" if adapter_path else None
+    if weights is None or not weights.exists():
+        return None
+    stat = weights.stat()
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+# --- Cliente --- #
+
+def request(payload, socket_path=SOCKET_PATH, timeout=REQUEST_TIMEOUT):
+    """Envia um pedido ao daemon; devolve a resposta (dict) ou None se não houver daemon"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(socket_path)
+            sock.settimeout(timeout)
+            sock.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+    except (FileNotFoundError, ConnectionRefusedError, socket.timeout, OSError):
+        return None
+    return json.loads(data) if data else None
+
+
+def is_available(base_model, adapter_path, socket_path=SOCKET_PATH):
+    """True se houver um daemon a servir este modelo base e adaptador"""
+    info = request({"cmd": "ping"}, socket_path, timeout=CONNECT_TIMEOUT)
+    return bool(info) and _same_path(info["base_model"], base_model) and _same_path(info["adapter_path"], adapter_path)
+
+
+def generate_remote(prompt, max_tokens, base_model, adapter_path, socket_path=SOCKET_PATH, question=None):
+    """Gera no daemon; devolve a resposta (response, mode, elapsed_sec) ou None para fallback local"""
+    reply = request({
+        "cmd": "generate",
+        "prompt": prompt,
+        "question": question,
+        "max_tokens": max_tokens,
+        "base_model": base_model,
+        "adapter_path": adapter_path,
+    }, socket_path)
+    if not reply or reply.get("status") != "ok":
+        if reply:
+            print(f"[WARN] Daemon de inferência: {reply.get('error')}", file=sys.stderr)
+        return None
+    source = f"cache, semelhança {reply['similarity']:.2f}" if reply.get("cached") else reply["mode"]
+    print(f"[INFO] Resposta do daemon de inferência ({source}, {reply['elapsed_sec']:.1f}s)", file=sys.stderr)
+    return reply
+
+
+# --- Servidor --- #
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, base_model, adapter_path, semantic_cache=True, cache_threshold=None):
+        import answer_cache
+        import model_loader
+
+        self.base_model = base_model
+        self.adapter_path = adapter_path
+        # As streams do MLX pertencem à thread que importou o mlx_lm: a geração corre na
+        # thread principal (um pedido de cada vez) e as threads das ligações esperam na fila
+        self.jobs = queue.Queue()
+        # Depois do shutdown não entram pedidos novos; os que ficaram na fila recebem um erro
+        self.jobs_lock = threading.Lock()
+        self.stopping = False
+        self.started = time.time()
+        self.requests_served = 0
+        self.model, self.tokenizer, self.mode = model_loader.load_model(base_model, adapter_path)
+        self.adapter_signature = _adapter_signature(adapter_path)
+        # (Embedder, limiar) partilhados pelas caches de cada variante de prompt
+        self.embedder = answer_cache.open_embedder(threshold=cache_threshold) if semantic_cache else None
+        self.caches = {}
+        super().__init__(socket_path, InferenceHandler)
+
+    def refresh_adapter(self):
+        """Recarrega o adaptador se o ficheiro mudou desde o último pedido"""
+        import model_loader
+
+        signature = _adapter_signature(self.adapter_path)
+        if signature == self.adapter_signature:
+            return
+        if self.mode == "adapter":
+            print(f"[INFO] Adaptador alterado; a recarregar {self.adapter_path}", file=sys.stderr)
+            self.model.load_weights(str(Path(self.adapter_path) / "adapters.safetensors"), strict=False)
+        else:
+            self.model, self.tokenizer, self.mode = model_loader.load_model(self.base_model, self.adapter_path)
+        self.adapter_signature = signature
+        # Respostas do adaptador anterior ficam na partição antiga
+        self.close_caches()
+
+    def cache_for(self, payload):
+        """Cache semântica para o formato do prompt deste pedido; None se não for cacheável"""
+        import answer_cache
+
+        question = payload.get("question")
+        if not self.embedder or not question:
+            return None
+        variant = answer_cache.prompt_variant(payload["prompt"], question, payload.get("max_tokens", 200))
+        if variant is None:
+            return None
+        if variant not in self.caches:
+            embedder, threshold = self.embedder
+            self.caches[variant] = answer_cache.SemanticCache(embedder, threshold, self.base_model,
+                                                              self.adapter_path, variant)
+        return self.caches[variant]
+
+    def close_caches(self):
+        for cache in self.caches.values():
+            cache.close()
+        self.caches = {}
+
+    def info(self):
+        return {
+            "status": "ok",
+            "pid": os.getpid(),
+            "base_model": self.base_model,
+            "adapter_path": self.adapter_path,
+            "mode": self.mode,
+            "uptime_sec": time.time() - self.started,
+            "requests_served": self.requests_served,
+            "cache": [cache.info() for cache in self.caches.values()] if self.embedder else None,
+        }
+
+    def generate(self, payload):
+        if not (_same_path(payload.get("base_model"), self.base_model)
+                and _same_path(payload.get("adapter_path"), self.adapter_path)):
+            return {"status": "error", "error": "modelo/adaptador diferente do servido pelo daemon"}
+        result = queue.Queue(maxsize=1)
+        with self.jobs_lock:
+            if self.stopping:
+                return {"status": "error", "error": "daemon a terminar"}
+            self.jobs.put((payload, result))
+        return result.get()
+
+    def run_jobs(self):
+        """Ciclo da thread principal: executa os pedidos de geração até ao shutdown"""
+        import generation
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            payload, result = job
+            try:
+                self.refresh_adapter()
+                start = time.perf_counter()
+                cache = self.cache_for(payload)
+                question = payload.get("question")
+                max_tokens = payload.get("max_tokens", 200)
+                hit = cache.lookup(question) if cache else None
+                self.requests_served += 1
+                if hit:
+                    result.put({"status": "ok", "response": hit["answer"], "mode": self.mode, "cached": True,
+                                "similarity": hit["similarity"], "finish_reason": "cache", "tokens_saved": max_tokens,
+                                "elapsed_sec": time.perf_counter() - start})
+                    continue
+                output = generation.generate(self.model, self.tokenizer, payload["prompt"], max_tokens=max_tokens)
+                if cache:
+                    cache.store(question, output["text"])
+                result.put({"status": "ok", "response": output["text"], "mode": self.mode,
+                            "finish_reason": output["finish_reason"], "tokens_saved": output["tokens_saved"],
+                            "elapsed_sec": time.perf_counter() - start})
+            except Exception as e:
+                result.put({"status": "error", "error": str(e)})
+
+    def stop(self):
+        """Termina depois do pedido em curso; os que estão na fila recebem um erro"""
+        self.drain_jobs()
+        self.jobs.put(None)
+
+    def drain_jobs(self):
+        """Responde com erro aos pedidos que ficaram na fila, para os clientes não esperarem pelo timeout"""
+        with self.jobs_lock:
+            self.stopping = True
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None:
+                job[1].put({"status": "error", "error": "daemon terminado antes de executar o pedido"})
+
+
+class InferenceHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            payload = json.loads(line)
+            cmd = payload.get("cmd", "generate")
+            if cmd == "ping":
+                reply = self.server.info()
+            elif cmd == "shutdown":
+                reply = {"status": "ok"}
+                self.server.stop()
+            else:
+                reply = self.server.generate(payload)
+        except Exception as e:
+            reply = {"status": "error", "error": str(e)}
+        self.wfile.write((json.dumps(reply, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+def serve(base_model, adapter_path, socket_path=SOCKET_PATH, semantic_cache=True, cache_threshold=None):
+    if os.path.exists(socket_path):
+        if request({"cmd": "ping"}, socket_path, timeout=CONNECT_TIMEOUT):
+            print(f"❌ Já existe um daemon em {socket_path}", file=sys.stderr)
+            sys.exit(1)
+        os.unlink(socket_path)  # socket órfão de um daemon anterior
+
+    server = InferenceServer(socket_path, base_model, adapter_path, semantic_cache, cache_threshold)
+    os.chmod(socket_path, 0o600)
+    print(f"✅ Daemon de inferência pronto em {socket_path} ({server.mode}"
+          + (f", cache semântica com limiar {server.embedder[1]:.3f})" if server.embedder else ")"), file=sys.stderr)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        server.run_jobs()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.drain_jobs()
+        server.close_caches()
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        print("👋 Daemon terminado", file=sys.stderr)
+
+
+def main():
+    import model_loader
+
+    parser = argparse.ArgumentParser(description="Daemon local de inferência (Unix socket)")
+    parser.add_argument("--base-model", default=model_loader.BASE_MODEL)
+    parser.add_argument("--adapter-path", default=model_loader.DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--no-cache", action="store_true", help="Desativar a cache semântica de respostas")
+    parser.add_argument("--cache-threshold", type=float, default=None,
+                        help="Limiar de semelhança da cache (default: o calibrado com answer_cache.py --calibrate)")
+    parser.add_argument("--status", action="store_true", help="Mostrar o estado do daemon")
+    parser.add_argument("--stop", action="store_true", help="Terminar o daemon")
+    args = parser.parse_args()
+
+    if args.status or args.stop:
+        reply = request({"cmd": "shutdown" if args.stop else "ping"}, args.socket, timeout=CONNECT_TIMEOUT)
+        if reply is None:
+            print(f"Nenhum daemon em {args.socket}")
+            sys.exit(1)
+        print(json.dumps(reply, indent=2, ensure_ascii=False))
+        return
+
+    serve(args.base_model, args.adapter_path, args.socket, semantic_cache=not args.no_cache,
+          cache_threshold=args.cache_threshold)
+
+
+if __name__ == "__main__":
+    main()
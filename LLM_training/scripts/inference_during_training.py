@@ -8,6 +8,9 @@ Usage:
 
     # Com adapter path customizado:
     python scripts/inference_during_training.py "Pergunta" --adapter-path checkpoints_qlora/adapters
+
+    # Com excertos recuperados de dados/ no prompt (retrieval.py):
+    python scripts/inference_during_training.py "Quem foi Hassan Nader?" --rag
 """
 
 import sys
@@ -17,15 +20,19 @@ from pathlib import Path
 from datetime import datetime
 
 try:
-    from mlx_lm import load, generate
+    import generation
+    import model_loader
+    import inference_daemon
+    import match_query
+    import answer_store
+    import retrieval
 except ImportError:
     print("Error: mlx-lm not installed. Run: pip install mlx mlx-lm", file=sys.stderr)
     sys.exit(1)
 
 # Configuration
-BASE_DIR = Path("/Users/f.nuno/Desktop/chatbot_2.0/LLM_training")
-BASE_MODEL = str(BASE_DIR / "models/mistral-7b-4bit")
-DEFAULT_ADAPTER_PATH = str(BASE_DIR / "checkpoints_qlora/adapters")
+BASE_MODEL = model_loader.BASE_MODEL
+DEFAULT_ADAPTER_PATH = model_loader.DEFAULT_ADAPTER_PATH
 MAX_TOKENS = 200
 
 def load_model(adapter_path=None):
@@ -36,51 +43,35 @@ def load_model(adapter_path=None):
     print(f"[INFO] Adapter path: {adapter_path}", file=sys.stderr)
 
     try:
-        adapter_path_obj = Path(adapter_path)
-
-        if adapter_path_obj.exists():
-            print(f"[INFO] Loading model com adapter...", file=sys.stderr)
-            model, tokenizer = load(
-                BASE_MODEL,
-                adapter_path=adapter_path
-            )
-            print(f"[OK] Model loaded with QLoRA adapters", file=sys.stderr)
-            return model, tokenizer, True
-        else:
-            print(f"[WARN] Adapter path não existe: {adapter_path}", file=sys.stderr)
-            print(f"[INFO] Loading base model sem adapters...", file=sys.stderr)
-            model, tokenizer = load(BASE_MODEL)
+        # Usa a cópia fundida (base + LoRA) em cache quando existe (ver model_loader.py)
+        model, tokenizer, mode = model_loader.load_model(BASE_MODEL, adapter_path)
+        if mode == "base":
             print(f"[OK] Base model loaded (sem fine-tuning ainda)", file=sys.stderr)
-            return model, tokenizer, False
+        else:
+            print(f"[OK] Model loaded with QLoRA adapters ({mode})", file=sys.stderr)
+        return model, tokenizer, mode != "base"
 
     except Exception as e:
         print(f"[ERROR] Failed to load model: {e}", file=sys.stderr)
         raise
 
-def format_prompt(prompt):
-    """Format prompt in Farense style"""
-    return f"""### Pergunta:
-{prompt}
-
-### Resposta:"""
+def format_prompt(prompt, context=None):
+    """Format prompt in Farense style (com contexto recuperado opcional)"""
+    return generation.format_prompt(prompt, context)
 
-def generate_response(model, tokenizer, prompt, max_tokens=MAX_TOKENS):
+def generate_response(model, tokenizer, prompt, max_tokens=MAX_TOKENS, context=None):
     """Generate response for the given prompt"""
-    formatted_prompt = format_prompt(prompt)
+    formatted_prompt = format_prompt(prompt, context)
 
     print(f"[INFO] Gerando resposta...", file=sys.stderr)
 
     try:
-        response = generate(
-            model,
-            tokenizer,
-            prompt=formatted_prompt,
-            max_tokens=max_tokens,
-            verbose=False
-        )
-        # Remove the prompt from response
-        response = response.replace(formatted_prompt, "").strip()
-        return response
+        # Pára no EOS ou num novo bloco "### Pergunta" em vez de gastar os max_tokens
+        result = generation.generate(model, tokenizer, formatted_prompt, max_tokens=max_tokens)
+        if result["tokens_saved"]:
+            print(f"[INFO] Paragem antecipada ({result['finish_reason']}): {result['tokens_saved']} tokens poupados",
+                  file=sys.stderr)
+        return result["text"].strip()
 
     except Exception as e:
         print(f"[ERROR] Generation failed: {e}", file=sys.stderr)
@@ -110,6 +101,11 @@ Examples:
         default=MAX_TOKENS,
         help=f"Tokens máximos (default: {MAX_TOKENS})"
     )
+    parser.add_argument(
+        "--rag",
+        action="store_true",
+        help="Juntar ao prompt os excertos mais relevantes de dados/ (retrieval.py)"
+    )
     parser.add_argument(
         "--json",
         action="store_true",
@@ -123,11 +119,30 @@ Examples:
     max_tokens = args.max_tokens
 
     try:
-        # Load model
-        model, tokenizer, has_adapter = load_model(adapter_path)
+        # Consultas de resultados respondidas pelo índice de jogos, sem o modelo
+        response = match_query.answer(prompt)
+        direct = response is not None
+        precomputed = False
+        has_adapter = False
+        if not direct:
+            # Resposta pré-calculada para este checkpoint (answer_store.py); um checkpoint novo ainda não tem
+            response = answer_store.answer(prompt, BASE_MODEL, adapter_path)
+            precomputed = response is not None
+            has_adapter = precomputed and model_loader.has_adapter(adapter_path)
+        if response is None:
+            context = retrieval.retrieve_context(prompt) if args.rag else None
+            # Daemon de inferência (recarrega o adapter quando há novo checkpoint); sem daemon, carrega localmente
+            reply = inference_daemon.generate_remote(format_prompt(prompt, context), max_tokens, BASE_MODEL, adapter_path,
+                                                     question=prompt)
+            if reply:
+                response = reply["response"].strip()
+                has_adapter = reply["mode"] != "base"
+            else:
+                # Load model
+                model, tokenizer, has_adapter = load_model(adapter_path)
 
-        # Generate response
-        response = generate_response(model, tokenizer, prompt, max_tokens)
+                # Generate response
+                response = generate_response(model, tokenizer, prompt, max_tokens, context)
 
         if response:
             if args.json:
@@ -135,7 +150,8 @@ Examples:
                     "timestamp": datetime.now().isoformat(),
                     "prompt": prompt,
                     "response": response,
-                    "model": "Mistral-7B (INT4)",
+                    "model": "Índice de resultados" if direct else "Mistral-7B (INT4)",
+                    "precomputed": precomputed,
                     "adapter": "LoRA" if has_adapter else "None",
                     "status": "success"
                 }
@@ -145,7 +161,12 @@ Examples:
                 print(f"   {prompt}\n")
                 print(f"💬 RESPOSTA:")
                 print(f"   {response}\n")
-                print(f"ℹ️  Modelo: {'Mistral-7B com LoRA' if has_adapter else 'Mistral-7B Base'}")
+                if direct:
+                    print("ℹ️  Fonte: índice de resultados (sem modelo)")
+                elif precomputed:
+                    print(f"ℹ️  Fonte: respostas pré-calculadas ({'Mistral-7B com LoRA' if has_adapter else 'Mistral-7B Base'})")
+                else:
+                    print(f"ℹ️  Modelo: {'Mistral-7B com LoRA' if has_adapter else 'Mistral-7B Base'}")
         else:
             if args.json:
                 result = {
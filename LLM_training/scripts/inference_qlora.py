@@ -5,6 +5,9 @@ Otimizado para Mac M1 com MLX
 
 Usage:
     python scripts/inference_qlora.py "Qual foi a melhor classificação do Farense?"
+
+Adaptador: model_loader.DEFAULT_ADAPTER_PATH (checkpoints_qlora/adapters, o mesmo do daemon
+de inferência). O default anterior, checkpoints/adapters, já não é lido.
 """
 
 import sys
@@ -12,14 +15,19 @@ import json
 from pathlib import Path
 
 try:
-    from mlx_lm import load, generate
+    import generation
+    import model_loader
+    import inference_daemon
+    import match_query
+    import answer_store
 except ImportError:
     print("Error: mlx-lm not installed. Run: pip install mlx mlx-lm", file=sys.stderr)
     sys.exit(1)
 
 # Configuration
-BASE_MODEL = "/Users/f.nuno/Desktop/chatbot_2.0/LLM_training/models/mistral-7b-4bit"
-ADAPTER_PATH = "/Users/f.nuno/Desktop/chatbot_2.0/LLM_training/checkpoints/adapters"
+# Os mesmos caminhos do daemon de inferência (model_loader), para o poder usar
+BASE_MODEL = model_loader.BASE_MODEL
+ADAPTER_PATH = model_loader.DEFAULT_ADAPTER_PATH
 MAX_TOKENS = 200
 QUANTIZATION = "int4"
 
@@ -27,11 +35,9 @@ def load_model():
     """Load model with QLoRA adapter and INT4 quantization"""
     print("[INFO] Loading QLoRA model with INT4 quantization...", file=sys.stderr)
     try:
-        model, tokenizer = load(
-            BASE_MODEL,
-            adapter_path=ADAPTER_PATH
-        )
-        print("[OK] QLoRA model loaded successfully", file=sys.stderr)
+        # Usa a cópia fundida (base + LoRA) em cache quando existe (ver model_loader.py)
+        model, tokenizer, mode = model_loader.load_model(BASE_MODEL, ADAPTER_PATH)
+        print(f"[OK] QLoRA model loaded successfully ({mode})", file=sys.stderr)
         return model, tokenizer
     except Exception as e:
         print(f"[ERROR] Failed to load model: {e}", file=sys.stderr)
@@ -42,14 +48,11 @@ def generate_response(model, tokenizer, prompt):
     print(f"[INFO] Processing: {prompt[:50]}...", file=sys.stderr)
 
     try:
-        response = generate(
-            model,
-            tokenizer,
-            prompt=prompt,
-            max_tokens=MAX_TOKENS,
-            verbose=False
-        )
-        return response
+        # Pára no EOS ou num novo bloco "### Pergunta" em vez de gastar os MAX_TOKENS
+        result = generation.generate(model, tokenizer, generation.format_prompt(prompt), max_tokens=MAX_TOKENS)
+        if result["tokens_saved"]:
+            print(f"[INFO] Early stop ({result['finish_reason']}): {result['tokens_saved']} tokens saved", file=sys.stderr)
+        return result["text"]
     except Exception as e:
         print(f"[ERROR] Generation failed: {e}", file=sys.stderr)
         return None
@@ -67,8 +70,19 @@ def main():
     prompt = sys.argv[1]
 
     try:
-        model, tokenizer = load_model()
-        response = generate_response(model, tokenizer, prompt)
+        # Consultas de resultados respondidas pelo índice de jogos, sem o modelo
+        response = match_query.answer(prompt)
+        if response is None:
+            # Perguntas do dataset com resposta pré-calculada para este adaptador (answer_store.py)
+            response = answer_store.answer(prompt, BASE_MODEL, ADAPTER_PATH)
+        if response is None:
+            # Daemon de inferência (modelo já carregado); sem daemon, carrega o modelo neste processo
+            reply = inference_daemon.generate_remote(generation.format_prompt(prompt), MAX_TOKENS, BASE_MODEL, ADAPTER_PATH, question=prompt)
+            if reply:
+                response = reply["response"]
+            else:
+                model, tokenizer = load_model()
+                response = generate_response(model, tokenizer, prompt)
 
         if response:
             result = {
@@ -3,9 +3,15 @@
 Interactive Inference Console for Farense Bot
 Permite conversa contínua com o modelo durante o treino
 
+O histórico da conversa fica na KV cache (ChatSession): cada turno processa apenas
+os tokens novos. Quando o contexto excede MAX_CONTEXT_TOKENS, os turnos mais antigos
+são descartados e o histórico restante é recalculado uma vez. Com --kv-bits 8/4 a cache
+é guardada quantizada (ver generation.py), com 2-4x menos memória por token de histórico.
+
 Usage:
     python scripts/interactive_inference.py
     python scripts/interactive_inference.py --adapter-path checkpoints_qlora/adapters
+    python scripts/interactive_inference.py --kv-bits 8
 """
 
 import sys
@@ -14,25 +20,116 @@ from pathlib import Path
 from datetime import datetime
 
 try:
-    from mlx_lm import load, generate
+    from mlx_lm import stream_generate
+    from mlx_lm.models.cache import make_prompt_cache, trim_prompt_cache
+    from generation import KV_GROUP_SIZE, StopMatcher
+    from prompt_format import format_prompt
+    import model_loader
+    import inference_daemon
+    import match_query
+    import answer_cache
+    import answer_store
     import mlx.core as mx
 except ImportError:
     print("Error: mlx-lm not installed. Run: pip install mlx mlx-lm", file=sys.stderr)
     sys.exit(1)
 
 # Configuration
-BASE_DIR = Path("/Users/f.nuno/Desktop/chatbot_2.0/LLM_training")
-BASE_MODEL = str(BASE_DIR / "models/mistral-7b-4bit")
-DEFAULT_ADAPTER_PATH = str(BASE_DIR / "checkpoints_qlora/adapters")
+BASE_MODEL = model_loader.BASE_MODEL
+DEFAULT_ADAPTER_PATH = model_loader.DEFAULT_ADAPTER_PATH
 MAX_TOKENS = 200
+MAX_CONTEXT_TOKENS = 2048  # Limite do histórico na KV cache (turnos antigos são descartados)
+
+class ChatSession:
+    """Conversa multi-turno com a KV cache mantida entre turnos"""
+
+    def __init__(self, model, tokenizer, max_context_tokens=MAX_CONTEXT_TOKENS, kv_bits=None,
+                 kv_group_size=KV_GROUP_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_context_tokens = max_context_tokens
+        # KV cache quantizada desde a primeira posição (None = fp16)
+        self.kv = {"kv_bits": kv_bits, "kv_group_size": kv_group_size, "quantized_kv_start": 0}
+        self.reset()
+
+    def reset(self):
+        self.cache = make_prompt_cache(self.model)
+        self.prefix = self.tokenizer.encode("")  # BOS
+        self.turns = []        # tokens de cada turno (pergunta + resposta)
+        self.last_prefill_tokens = 0
+        self.tokens_saved = 0
+
+    @property
+    def history(self):
+        return self.prefix + [t for turn in self.turns for t in turn]
+
+    def _fit(self, new_tokens, max_tokens):
+        """Descarta os turnos mais antigos até o novo turno caber no limite; recalcula a cache se preciso"""
+        dropped = 0
+        while self.turns and len(self.history) + new_tokens + max_tokens > self.max_context_tokens:
+            self.turns.pop(0)
+            dropped += 1
+        if dropped:
+            self.cache = make_prompt_cache(self.model)
+        return dropped
+
+    def ask(self, user_input, max_tokens=MAX_TOKENS):
+        """Gera a resposta processando só os tokens que ainda não estão na cache"""
+        text = ("\n\n" if self.turns else "") + format_prompt(user_input)
+        question = self.tokenizer.encode(text, add_special_tokens=False)
+        self._fit(len(question), max_tokens)
+
+        # O último token gerado no turno anterior ainda não passou pelo modelo
+        history = self.history
+        pending = history[self.cache[0].offset:] + question
+
+        answer_start = len(history) + len(question)
+        matcher = StopMatcher()
+        answer, text, response = [], "", None
+        for response in stream_generate(self.model, self.tokenizer, pending,
+                                        max_tokens=max_tokens, prompt_cache=self.cache, **self.kv):
+            answer.append(response.token)
+            text += matcher.feed(response.text)
+            if matcher.stopped:
+                break
+        self.last_prefill_tokens = response.prompt_tokens if response else len(pending)
+        self.tokens_saved = max_tokens - len(answer) if response and response.finish_reason != "length" else 0
+
+        if matcher.stopped:
+            # O modelo começou outra pergunta: o histórico guarda só a resposta (re-tokenizada)
+            # e a cache volta ao fim da pergunta; a resposta é processada no turno seguinte
+            trim_prompt_cache(self.cache, self.cache[0].offset - answer_start)
+            answer = self.tokenizer.encode(text.rstrip(), add_special_tokens=False)
+        else:
+            text += matcher.flush()
+        self.turns.append(question + answer)
+        return text.strip()
+
+    def add_turn(self, user_input, answer_text):
+        """Acrescenta ao histórico um turno respondido sem o modelo; é processado no turno seguinte"""
+        text = ("\n\n" if self.turns else "") + format_prompt(user_input) + answer_text
+        tokens = self.tokenizer.encode(text, add_special_tokens=False)
+        self._fit(len(tokens), 0)
+        self.turns.append(tokens)
+
 
 class FarenseBot:
-    def __init__(self, adapter_path=None):
+    def __init__(self, adapter_path=None, kv_bits=None):
         self.adapter_path = adapter_path or DEFAULT_ADAPTER_PATH
+        self.kv_bits = kv_bits
         self.model = None
         self.tokenizer = None
         self.has_adapter = False
-        self.load_model()
+        self.session = None
+        self.cache = None
+        # Com um daemon de inferência a servir o mesmo modelo, não é preciso carregá-lo aqui
+        # (o daemon responde a turnos isolados; o histórico em KV cache exige o modelo local)
+        self.use_daemon = inference_daemon.is_available(BASE_MODEL, self.adapter_path)
+        if self.use_daemon:
+            self.has_adapter = model_loader.has_adapter(self.adapter_path)
+            print(f"\n🔌 A usar o daemon de inferência ({inference_daemon.SOCKET_PATH})", file=sys.stderr)
+        else:
+            self.load_model()
 
     def load_model(self):
         """Load model with adapter"""
@@ -41,47 +138,60 @@ class FarenseBot:
         print(f"   Adapter: {self.adapter_path}", file=sys.stderr)
 
         try:
-            adapter_path_obj = Path(self.adapter_path)
-
-            if adapter_path_obj.exists():
-                print(f"   ✅ Adapter encontrado", file=sys.stderr)
-                self.model, self.tokenizer = load(
-                    BASE_MODEL,
-                    adapter_path=self.adapter_path
-                )
-                self.has_adapter = True
-                print(f"✅ Modelo carregado com LoRA adapters\n", file=sys.stderr)
+            # Usa a cópia fundida (base + LoRA) em cache quando existe (ver model_loader.py)
+            self.model, self.tokenizer, mode = model_loader.load_model(BASE_MODEL, self.adapter_path)
+            self.has_adapter = mode != "base"
+            self.session = ChatSession(self.model, self.tokenizer, kv_bits=self.kv_bits)
+            self.cache = answer_cache.open_cache(BASE_MODEL, self.adapter_path)
+            if self.has_adapter:
+                print(f"✅ Modelo carregado com LoRA adapters ({mode})\n", file=sys.stderr)
             else:
-                print(f"   ⚠️  Adapter não encontrado", file=sys.stderr)
-                self.model, self.tokenizer = load(BASE_MODEL)
-                self.has_adapter = False
                 print(f"⚠️  Modelo carregado em versão base (sem fine-tuning ainda)\n", file=sys.stderr)
 
         except Exception as e:
             print(f"❌ Erro ao carregar: {e}", file=sys.stderr)
             raise
 
-    def format_prompt(self, user_input):
-        """Format prompt"""
-        return f"""### Pergunta:
-{user_input}
-
-### Resposta:"""
+    def _answered(self, user_input, answer_text):
+        """Resposta obtida sem o modelo local: entra no histórico para os turnos seguintes"""
+        if self.session:
+            self.session.add_turn(user_input, answer_text)
+        return answer_text
 
     def generate_response(self, user_input, max_tokens=MAX_TOKENS):
         """Generate response"""
-        formatted_prompt = self.format_prompt(user_input)
+        # Consultas de resultados respondidas pelo índice de jogos, sem o modelo
+        direct = match_query.answer(user_input)
+        if direct is not None:
+            return self._answered(user_input, direct)
+
+        # Só perguntas sem histórico usam respostas guardadas (answer_store.py, answer_cache.py):
+        # as outras ("E quando nasceu?") dependem da conversa. Com o daemon não há histórico.
+        first_turn = self.session is None or not self.session.turns
+        if first_turn:
+            # Perguntas do dataset com resposta pré-calculada para este adaptador
+            precomputed = answer_store.answer(user_input, BASE_MODEL, self.adapter_path)
+            if precomputed is not None:
+                return self._answered(user_input, precomputed)
+
+        formatted_prompt = format_prompt(user_input)
+
+        if self.use_daemon:
+            reply = inference_daemon.generate_remote(formatted_prompt, max_tokens, BASE_MODEL, self.adapter_path,
+                                                     question=user_input)
+            if reply:
+                return reply["response"].strip()
+            # Daemon terminou a meio da sessão: carregar o modelo localmente
+            self.use_daemon = False
+            self.load_model()
 
         try:
-            response = generate(
-                self.model,
-                self.tokenizer,
-                prompt=formatted_prompt,
-                max_tokens=max_tokens,
-                verbose=False
-            )
-            # Remove prompt from response
-            response = response.replace(formatted_prompt, "").strip()
+            hit = self.cache.lookup(user_input) if self.cache and first_turn else None
+            if hit:
+                return self._answered(user_input, hit["answer"])
+            response = self.session.ask(user_input, max_tokens)
+            if self.cache and first_turn:
+                self.cache.store(user_input, response)
             return response
 
         except Exception as e:
@@ -95,7 +205,7 @@ class FarenseBot:
         print("="*80)
         print(f"\nModelo: {'Mistral-7B com LoRA' if self.has_adapter else 'Mistral-7B Base'}")
         print(f"Device: {mx.default_device()}")
-        print(f"\nDigite 'sair' para terminar\n")
+        print(f"\nDigite 'sair' para terminar ou 'limpar' para começar uma nova conversa\n")
 
         conversation_count = 0
 
@@ -110,6 +220,11 @@ class FarenseBot:
                     print(f"\n👋 Até logo! ({conversation_count} conversas)")
                     break
 
+                if user_input.lower() == 'limpar' and self.session:
+                    self.session.reset()
+                    print("🧹 Histórico limpo\n")
+                    continue
+
                 print(f"\n🤔 Processando...", end='', flush=True)
                 response = self.generate_response(user_input)
                 print(f"\r               \r", end='', flush=True)  # Clear "Processando..."
@@ -126,6 +241,8 @@ class FarenseBot:
             except Exception as e:
                 print(f"❌ Erro: {e}\n")
 
+        if self.cache:
+            self.cache.close()
         print("\n" + "="*80)
 
 def main():
@@ -139,11 +256,18 @@ def main():
         default=DEFAULT_ADAPTER_PATH,
         help=f"Caminho aos adapters (default: {DEFAULT_ADAPTER_PATH})"
     )
+    parser.add_argument(
+        "--kv-bits",
+        type=int,
+        choices=[4, 8],
+        default=None,
+        help="Guardar a KV cache do histórico quantizada (8 ou 4 bits)"
+    )
 
     args = parser.parse_args()
 
     try:
-        bot = FarenseBot(adapter_path=args.adapter_path)
+        bot = FarenseBot(adapter_path=args.adapter_path, kv_bits=args.kv_bits)
         bot.chat()
     except Exception as e:
         print(f"❌ Erro fatal: {e}", file=sys.stderr)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Respostas estruturadas sobre os jogos do Farense, sem passar pelo modelo 7B.
+
+MatchIndex carrega dados/resultados/farense_resultados.csv (gerado por
+farense_md_to_csv.processar_markdown) e mantém índices em memória por data, adversário,
+época, ano, competição e resultado. O router (answer) reconhece perguntas de consulta -
+"resultado do Farense contra o Olhanense em 1914-10-04", "balanço contra o Benfica",
+"jogos da época 1983/84" - e responde diretamente; perguntas abertas devolvem None
+e seguem para o modelo. Perguntas com interrogativas abertas (quem, quando, qual,
+quantos...) ou palavras que o índice não sabe responder (sócios, treinador, marcadores...)
+são sempre abertas, mesmo que refiram um jogo; uma consulta direta exige um adversário ou
+uma data/época, não basta a competição ou o ano.
+
+As competições são agrupadas por família (sem a época nem "de"/"da"/"do"), e os nomes
+comerciais da mesma competição ("Liga NOS", "LP Betclic", "Ledman LigaPro", "Allianz
+Cup"...) são unificados pela tabela COMPETITION_ALIASES.
+
+A época é calculada a partir da data (agosto a julho) ou, para os jogos sem data, do
+nome da competição: a coluna "epoca" do CSV não é fiável. Pela mesma razão a coluna
+"local" não é usada.
+
+Usage:
+    python scripts/match_query.py "Resultado do Farense contra o Olhanense em 1914-10-04"
+    python scripts/match_query.py "Balanço do Farense contra o Benfica"
+"""
+
+import csv
+import re
+import sys
+import time
+import unicodedata
+from collections import defaultdict
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent.parent
+MATCHES_CSV = BASE_DIR / "dados/resultados/farense_resultados.csv"
+MATCHES_MD = BASE_DIR / "dados/resultados/resultados_completos.md"
+MAX_LISTED = 10
+
+# Palavras que não distinguem clubes (o próprio Farense incluído)
+CLUB_STOPWORDS = {
+    "sporting", "clube", "club", "sc", "fc", "cd", "gd", "ud", "ad", "ac", "sl", "cf", "de", "da", "do",
+    "dos", "das", "e", "futebol", "associacao", "farense", "o", "a",
+}
+LOOKUP_WORDS = {"resultado", "resultados", "jogo", "jogos", "contra", "frente", "vs", "defrontou", "jogou",
+                "partida", "partidas"}
+SUMMARY_WORDS = {"balanco", "registo", "estatisticas", "vitorias", "derrotas", "empates"}
+# Perguntas que o índice de resultados não responde (interrogativas abertas, factos fora dos
+# resultados): seguem sempre para o modelo
+OPEN_WORDS = {"quem", "porque", "como", "onde", "quando", "qual", "quais", "quantas", "quantos", "ano", "historia",
+              "historial", "socio", "socios", "treinador", "treinadores", "marcador", "marcadores", "jogador",
+              "jogadores", "plantel", "presidente", "estadio", "adeptos", "assistencia", "arbitro", "capitao",
+              "contratou", "transferencia"}
+# Resultado "2-1" (não apanha os números de uma data 1914-10-04)
+SCORE_PATTERN = re.compile(r"(?<![\d-])(\d{1,2})\s*-\s*(\d{1,2})(?![\d-])")
+COMPETITION_STOPWORDS = {"de", "da", "do"}
+# Família canónica -> outros nomes da mesma competição (já normalizados, sem "de"/"da"/"do")
+COMPETITION_ALIASES = {
+    "primeira liga": ["i liga", "i divisao", "primeira divisao", "liga portuguesa", "liga nos", "liga portugal betclic",
+                      "lp betclic"],
+    "segunda liga": ["ii liga", "liga 2", "liga2", "liga2 cabovisao", "liga 2 sabseg", "liga portugal 2",
+                     "liga portugal 2 meu super", "liga portugal sabseg", "ligapro", "ledman ligapro"],
+    "taca portugal": ["taca"],
+    "taca liga": ["allianz cup"],
+    "liguilha i/ii divisao": ["liguilha i/ii div"],
+}
+COMPETITION_FAMILIES = {alias: family for family, aliases in COMPETITION_ALIASES.items()
+                        for alias in aliases + [family]}
+SELF_NAME = re.compile(r"\b(sporting clube|sc) farense\b")
+MONTHS = {
+    "janeiro": 1, "fevereiro": 2, "marco": 3, "abril": 4, "maio": 5, "junho": 6, "julho": 7,
+    "agosto": 8, "setembro": 9, "outubro": 10, "novembro": 11, "dezembro": 12,
+}
+
+
+def normalize(text):
+    """Minúsculas, sem acentos nem pontuação"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9/]+", " ", text).strip()
+
+
+def season_of(date):
+    """Época (agosto a julho) de uma data ISO: 1983-10-02 -> 1983/84"""
+    year, month = int(date[:4]), int(date[5:7])
+    start = year if month >= 8 else year - 1
+    return f"{start}/{(start + 1) % 100:02d}"
+
+
+def _season_from_competition(competition):
+    """Época indicada no nome da competição ('... 36/37', '... 1944/45'), para jogos sem data"""
+    m = re.search(r"(\d{2,4})/(\d{2,4})\b", competition)
+    if not m:
+        return None
+    start = int(m.group(1))
+    if start < 100:
+        start += 1900 if start >= 13 else 2000
+    return f"{start}/{(start + 1) % 100:02d}"
+
+
+def _competition_words(text):
+    return " ".join(w for w in normalize(text).split() if w not in COMPETITION_STOPWORDS)
+
+
+def competition_family(competition):
+    """Família da competição, sem a época: 'Taça de Portugal 1963/1964' e 'Taça Portugal 24/25' -> 'taca portugal'"""
+    name = re.sub(r"\s*\d{2,4}(/\d{2,4})?.*$", "", _competition_words(competition)).strip()
+    return COMPETITION_FAMILIES.get(name, name)
+
+
+def _clean_opponent(name):
+    # Algumas linhas do markdown foram fundidas pelo parser ("Amora FC 3-0 D J5 - Fora Seixal FC")
+    return re.split(r"\s+\d+\s*-\s*\d+\s", name)[0].strip()
+
+
+class MatchIndex:
+    """Jogos do Farense com índices em memória para consultas estruturadas"""
+
+    def __init__(self, rows):
+        for row in rows:
+            row["com_data"] = bool(re.match(r"^\d{4}-\d{2}-\d{2}$", row["data"]))
+            row["epoca"] = season_of(row["data"]) if row["com_data"] else _season_from_competition(row["competicao"])
+        self.rows = sorted(rows, key=lambda r: (r["epoca"] or "", r["data"] if r["com_data"] else ""))
+        self.by_date = defaultdict(list)
+        self.by_opponent = defaultdict(list)
+        self.by_season = defaultdict(list)
+        self.by_year = defaultdict(list)
+        self.by_competition = defaultdict(list)
+        self.by_score = defaultdict(list)   # (golos do Farense, golos do adversário) -> jogos
+        self.opponent_tokens = {}   # adversário -> (tokens distintivos, todos os tokens)
+
+        for i, row in enumerate(self.rows):
+            row["adversario"] = _clean_opponent(row["adversario"])
+            row["golos_farense"] = int(row["golos_farense"])
+            row["golos_adversario"] = int(row["golos_adversario"])
+            self.by_opponent[row["adversario"]].append(i)
+            if row["epoca"]:
+                self.by_season[row["epoca"]].append(i)
+            if row["com_data"]:
+                self.by_date[row["data"]].append(i)
+                self.by_year[row["data"][:4]].append(i)
+            self.by_competition[competition_family(row["competicao"])].append(i)
+            self.by_score[(row["golos_farense"], row["golos_adversario"])].append(i)
+
+        self.opponents_by_token = defaultdict(set)
+        for name in self.by_opponent:
+            tokens = set(normalize(name).split())
+            distinctive = {t for t in tokens - CLUB_STOPWORDS if len(t) > 1}
+            # "Sporting B": sem tokens distintivos, o nome completo tem de aparecer na pergunta
+            distinctive = (tokens - {"farense"} if not distinctive else tokens - CLUB_STOPWORDS) or tokens
+            self.opponent_tokens[name] = (distinctive, tokens)
+            for token in distinctive:
+                self.opponents_by_token[token].add(name)
+
+        # Nomes reconhecidos nas perguntas: famílias do CSV e os seus aliases (o mais longo primeiro)
+        names = {f for f in self.by_competition if f}
+        names |= {alias for alias, family in COMPETITION_FAMILIES.items() if family in names}
+        self.competition_pattern = re.compile(r"\b(" + "|".join(map(re.escape, sorted(names, key=len, reverse=True)))
+                                              + r")\b")
+
+    @classmethod
+    def from_csv(cls, csv_file=MATCHES_CSV):
+        with open(csv_file, 'r', encoding='utf-8') as f:
+            return cls(list(csv.DictReader(f)))
+
+    @classmethod
+    def from_markdown(cls, md_file=MATCHES_MD, csv_file=MATCHES_CSV):
+        """Regenera o CSV a partir do markdown (farense_md_to_csv) e carrega-o"""
+        from farense_md_to_csv import processar_markdown
+
+        processar_markdown(str(md_file), str(csv_file))
+        return cls.from_csv(csv_file)
+
+    def find_opponents(self, question):
+        """Adversários cujos tokens distintivos aparecem todos na pergunta (preferindo o nome mais completo)"""
+        words = set(SELF_NAME.sub("farense", normalize(question)).split())
+        candidates = set().union(*(self.opponents_by_token.get(w, ()) for w in words))
+        found = [name for name in candidates if self.opponent_tokens[name][0] <= words]
+        # "Sporting" não aparece quando a pergunta refere por extenso "Sporting Clube Olhanense"
+        complete = [name for name in found if self.opponent_tokens[name][1] <= words]
+        return sorted(a for a in found
+                      if not any(self.opponent_tokens[a][1] < self.opponent_tokens[b][1] for b in complete))
+
+    def find_competition(self, question):
+        m = self.competition_pattern.search(_competition_words(question))
+        return COMPETITION_FAMILIES.get(m.group(1), m.group(1)) if m else None
+
+    def query(self, date=None, opponents=None, season=None, year=None, competition=None, score=None):
+        """Jogos que satisfazem todos os filtros dados (ordenados por data); o resultado vale nos dois sentidos"""
+        selected = None
+        filters = [
+            self.by_score.get(score, []) + self.by_score.get(score[::-1], []) if score else None,
+            self.by_date.get(date, []) if date else None,
+            [i for name in opponents for i in self.by_opponent[name]] if opponents else None,
+            self.by_season.get(season, []) if season else None,
+            self.by_year.get(year, []) if year else None,
+            self.by_competition.get(competition, []) if competition else None,
+        ]
+        for indices in filters:
+            if indices is not None:
+                selected = set(indices) if selected is None else selected & set(indices)
+        return [self.rows[i] for i in sorted(selected)] if selected is not None else []
+
+    @staticmethod
+    def summary(rows):
+        return {
+            "jogos": len(rows),
+            "vitorias": sum(r["resultado_tipo"] == "V" for r in rows),
+            "empates": sum(r["resultado_tipo"] == "E" for r in rows),
+            "derrotas": sum(r["resultado_tipo"] == "D" for r in rows),
+            "golos_marcados": sum(r["golos_farense"] for r in rows),
+            "golos_sofridos": sum(r["golos_adversario"] for r in rows),
+        }
+
+
+def parse_date(question):
+    text = normalize(question)
+    if m := re.search(r"\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b", question):
+        year, month, day = m.groups()
+    elif m := re.search(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b", question):
+        day, month, year = m.groups()
+    elif m := re.search(rf"\b(\d{{1,2}}) de ({'|'.join(MONTHS)}) de (\d{{4}})\b", text):
+        day, month, year = m.group(1), MONTHS[m.group(2)], m.group(3)
+    else:
+        return None
+    return f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+
+
+def parse_season(question):
+    m = re.search(r"\b(\d{4})\s*/\s*(\d{2}|\d{4})\b", question)
+    if not m:
+        return None
+    start = int(m.group(1))
+    return f"{start}/{(start + 1) % 100:02d}"
+
+
+def parse_score(question):
+    """Resultado indicado na pergunta ("2-1" -> (2, 1)) ou None"""
+    m = SCORE_PATTERN.search(question)
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+def parse_question(question, index):
+    """Filtros e intenção de uma pergunta; intent None = pergunta aberta (vai para o modelo)"""
+    words = set(normalize(question).split())
+    filters = {
+        "date": parse_date(question),
+        "opponents": index.find_opponents(question),
+        "season": parse_season(question),
+        "competition": index.find_competition(question),
+        "score": parse_score(question),
+    }
+    if not filters["date"] and not filters["season"]:
+        years = re.findall(r"\b(1[89]\d{2}|20\d{2})\b", question)
+        filters["year"] = years[0] if len(years) == 1 else None
+
+    has_entity = any(filters.values())
+    # Uma consulta de jogos precisa de um adversário ou de uma data/época; a competição ou o
+    # ano sozinhos ("ganhou a Taça?") são perguntas abertas
+    has_match = filters["opponents"] or filters["date"] or filters["season"]
+    if words & OPEN_WORDS:
+        intent = None
+    elif has_entity and words & SUMMARY_WORDS:
+        intent = "summary"
+    elif has_match and (words & LOOKUP_WORDS or filters["date"]):
+        intent = "lookup"
+    else:
+        intent = None
+    return intent, filters
+
+
+def _format_match(row):
+    date = row['data'] if row['com_data'] else f"{row['epoca']} (sem data)"
+    return (f"{date} ({row['competicao']}, {row['jornada']}): "
+            f"Farense {row['golos_farense']}-{row['golos_adversario']} {row['adversario']}")
+
+
+def _format_summary(stats):
+    return (f"{stats['jogos']} jogos: {stats['vitorias']} vitórias, {stats['empates']} empates e "
+            f"{stats['derrotas']} derrotas ({stats['golos_marcados']} golos marcados, "
+            f"{stats['golos_sofridos']} sofridos).")
+
+
+_index = None
+
+
+def get_index():
+    """Índice partilhado, carregado uma vez por processo"""
+    global _index
+    if _index is None:
+        _index = MatchIndex.from_csv()
+    return _index
+
+
+def answer(question, index=None):
+    """Resposta direta a perguntas de consulta sobre jogos; None para perguntas abertas"""
+    index = index or get_index()
+    intent, filters = parse_question(question, index)
+    if intent is None:
+        return None
+    rows = index.query(**filters)
+    if not rows:
+        return None  # sem registo no CSV: o modelo pode saber mais
+
+    if intent == "summary" or len(rows) > MAX_LISTED:
+        text = _format_summary(index.summary(rows))
+        if len(rows) <= MAX_LISTED:
+            text += "\n" + "\n".join(_format_match(r) for r in rows)
+        else:
+            text += "\nÚltimos jogos:\n" + "\n".join(_format_match(r) for r in rows[-5:])
+        return text
+    return "\n".join(_format_match(r) for r in rows)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python scripts/match_query.py 'pergunta'")
+        sys.exit(1)
+
+    question = sys.argv[1]
+    start = time.perf_counter()
+    index = get_index()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    response = answer(question, index)
+    answer_us = (time.perf_counter() - start) * 1e6
+    print(response if response is not None else "(pergunta aberta: segue para o modelo)")
+    print(f"\n[índice: {len(index.rows)} jogos em {load_ms:.1f} ms; resposta em {answer_us:.0f} µs]", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Auto-tuning de batch_size / max_seq_length por sondagem de memória.
+
+Em vez dos limiares de RAM fixos (services/system.py, PreflightChecker.recommend_config),
+carrega o modelo configurado em train_qlora.py, aplica LoRA e corre alguns passos
+de treino compilados reais com tamanhos batch x sequência crescentes, medindo o
+pico de memória (RSS do processo e memória ativa/pico do MLX). Escolhe a maior
+configuração que fica abaixo de uma margem de segurança da memória disponível.
+
+O resultado fica em cache por impressão digital modelo/hardware e é exposto como
+o preset "auto" em get_hardware_info().
+
+Usage:
+    python scripts/memory_probe.py
+    python scripts/memory_probe.py --margin 0.75 --force
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from importlib import metadata
+from pathlib import Path
+
+import psutil
+
+BASE_DIR = Path(__file__).parent.parent
+CHECKPOINTS_DIR = BASE_DIR / "checkpoints_qlora"
+AUTOTUNE_CACHE = CHECKPOINTS_DIR / "autotune_cache.json"
+
+# Grelha de candidatos (sondada por ordem crescente de tokens por passo)
+SEQ_LENGTHS = [256, 512, 1024, 2048]
+BATCH_SIZES = [1, 2, 4, 8, 16]
+PROBE_STEPS = 3
+SAFETY_MARGIN = 0.80
+# Batch efetivo (batch_size x gradient_accumulation) a manter no preset gerado
+TARGET_EFFECTIVE_BATCH = 8
+
+
+def _mlx_version():
+    try:
+        return metadata.version("mlx")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def hardware_fingerprint(model_path, qlora_config, grad_checkpoint="none"):
+    """Impressão digital do par modelo/hardware/configuração LoRA que determina o uso de memória"""
+    model_path = Path(model_path)
+    config_file = model_path / "config.json"
+    model_config_hash = (
+        hashlib.sha256(config_file.read_bytes()).hexdigest()[:16] if config_file.exists() else "missing"
+    )
+    parts = {
+        "model": str(model_path.resolve()),
+        "model_config": model_config_hash,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.system(),
+        "ram_gb": round(psutil.virtual_memory().total / (1024 ** 3)),
+        "mlx": _mlx_version(),
+        "num_layers": qlora_config["num_layers"],
+        "rank": qlora_config["lora_parameters"]["rank"],
+        "grad_checkpoint": str(grad_checkpoint),
+    }
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:24]
+    return digest, parts
+
+
+def _load_cache():
+    if not AUTOTUNE_CACHE.exists():
+        return {}
+    try:
+        with open(AUTOTUNE_CACHE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {}
+
+
+def load_cached_result(fingerprint):
+    """Resultado de auto-tuning em cache para esta impressão digital (ou None)"""
+    return _load_cache().get(fingerprint)
+
+
+def _save_result(fingerprint, result):
+    cache = _load_cache()
+    cache[fingerprint] = result
+    CHECKPOINTS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(AUTOTUNE_CACHE, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=4, ensure_ascii=False)
+
+
+def cached_auto_preset():
+    """Preset "auto" para a configuração atual de train_qlora, se já tiver sido sondado"""
+    import train_qlora
+
+    fingerprint, _ = hardware_fingerprint(
+        train_qlora.model_name, train_qlora.qlora_config, train_qlora.training_config["grad_checkpoint"]
+    )
+    result = load_cached_result(fingerprint)
+    return result["preset"] if result else None
+
+
+def _synthetic_batch(batch_size, seq_length, vocab_size):
+    """Batch sintético com o pior caso de comprimento: toda a sequência preenchida, metade supervisionada"""
+    import mlx.core as mx
+
+    num_supervised = seq_length // 2
+    inputs = mx.random.randint(0, vocab_size, (batch_size, seq_length))
+    targets = mx.random.randint(0, vocab_size, (batch_size, num_supervised))
+    positions = mx.broadcast_to(
+        mx.arange(seq_length - num_supervised, seq_length)[None, :], (batch_size, num_supervised)
+    )
+    lengths = mx.full((batch_size,), num_supervised)
+    return inputs, targets, positions, lengths
+
+
+def probe(model, step_fn, optimizer, batch_size, seq_length, steps=PROBE_STEPS):
+    """Corre `steps` passos de treino compilados e devolve o pico de memória e o débito"""
+    import mlx.core as mx
+
+    process = psutil.Process(os.getpid())
+    batch = _synthetic_batch(batch_size, seq_length, model.args.vocab_size)
+    mx.eval(batch)
+    mx.reset_peak_memory()
+
+    peak_rss = process.memory_info().rss
+    start = time.perf_counter()
+    for _ in range(steps):
+        loss = step_fn(*batch)
+        mx.eval(model.parameters(), optimizer.state, loss)
+        peak_rss = max(peak_rss, process.memory_info().rss)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "batch_size": batch_size,
+        "max_seq_length": seq_length,
+        "peak_rss_gb": peak_rss / (1024 ** 3),
+        "mlx_peak_gb": mx.get_peak_memory() / (1024 ** 3),
+        "mlx_active_gb": mx.get_active_memory() / (1024 ** 3),
+        "tokens_per_sec": batch_size * seq_length * steps / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def _peak_gb(result):
+    return max(result["peak_rss_gb"], result["mlx_peak_gb"])
+
+
+def autotune(margin=SAFETY_MARGIN, force=False, seq_lengths=SEQ_LENGTHS, batch_sizes=BATCH_SIZES):
+    """Sonda a grelha batch x sequência e devolve (e guarda em cache) a maior configuração segura"""
+    import mlx.core as mx
+    from mlx.optimizers import AdamW
+
+    import train_qlora
+
+    grad_checkpoint = train_qlora.training_config["grad_checkpoint"]
+    fingerprint, parts = hardware_fingerprint(train_qlora.model_name, train_qlora.qlora_config, grad_checkpoint)
+    if not force:
+        cached = load_cached_result(fingerprint)
+        if cached:
+            print(f"✓ Auto-tuning em cache para {parts['model']} ({fingerprint})")
+            return cached
+
+    model, _ = train_qlora.load_lora_model()
+    optimizer = AdamW(learning_rate=train_qlora.training_config["learning_rate"])
+    step_fn = train_qlora.create_step_fn(model, optimizer)
+    mx.eval(model.parameters())
+
+    # Orçamento: memória já ocupada pelo modelo + fração segura da memória ainda disponível
+    base_gb = max(psutil.Process(os.getpid()).memory_info().rss, mx.get_active_memory()) / (1024 ** 3)
+    budget_gb = base_gb + margin * psutil.virtual_memory().available / (1024 ** 3)
+    print(f"Modelo carregado: {base_gb:.2f} GB | Orçamento de memória: {budget_gb:.2f} GB (margem {margin:.0%})")
+
+    candidates = sorted(
+        ((b, s) for s in seq_lengths for b in batch_sizes),
+        key=lambda c: (c[0] * c[1], c[1]),
+    )
+    probes = []
+    best = None
+    for batch_size, seq_length in candidates:
+        # Estimar linearmente a partir da maior sondagem bem sucedida para não arriscar um OOM
+        if best:
+            scale = (batch_size * seq_length) / (best["batch_size"] * best["max_seq_length"])
+            estimate = base_gb + (_peak_gb(best) - base_gb) * scale
+            if estimate > budget_gb:
+                print(f"  - batch {batch_size} x seq {seq_length}: estimado {estimate:.2f} GB, ignorado")
+                continue
+
+        result = probe(model, step_fn, optimizer, batch_size, seq_length)
+        result["fits"] = _peak_gb(result) <= budget_gb
+        probes.append(result)
+        print(f"  - batch {batch_size} x seq {seq_length}: pico {_peak_gb(result):.2f} GB, "
+              f"{result['tokens_per_sec']:.0f} tokens/s {'✓' if result['fits'] else '✗'}")
+        if not result["fits"]:
+            # Os candidatos seguintes são maiores: parar antes de arriscar um OOM
+            break
+        best = result
+
+    if best is None:
+        raise RuntimeError("Nenhuma configuração cabe no orçamento de memória; reduza o modelo ou liberte memória.")
+
+    preset = {
+        "batch_size": best["batch_size"],
+        "gradient_accumulation": max(1, TARGET_EFFECTIVE_BATCH // best["batch_size"]),
+        "max_seq_length": best["max_seq_length"],
+        "learning_rate": train_qlora.training_config["learning_rate"],
+        "num_epochs": train_qlora.training_config["num_epochs"],
+        "grad_checkpoint": grad_checkpoint,
+    }
+    result = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "fingerprint": parts,
+        "budget_gb": budget_gb,
+        "safety_margin": margin,
+        "peak_memory_gb": _peak_gb(best),
+        "preset": preset,
+        "probes": probes,
+    }
+    _save_result(fingerprint, result)
+    print(f"✓ Configuração escolhida: batch {preset['batch_size']} x seq {preset['max_seq_length']} "
+          f"(pico {result['peak_memory_gb']:.2f} GB) guardada em {AUTOTUNE_CACHE}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Auto-tuning de batch/sequência por sondagem de memória")
+    parser.add_argument("--margin", type=float, default=SAFETY_MARGIN,
+                        help=f"Fração da memória disponível a usar (default: {SAFETY_MARGIN})")
+    parser.add_argument("--force", action="store_true", help="Ignorar o resultado em cache e voltar a sondar")
+    args = parser.parse_args()
+
+    try:
+        autotune(margin=args.margin, force=args.force)
+    except Exception as e:
+        print(f"✗ Erro no auto-tuning: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Carregamento partilhado do modelo para os scripts de inferência.
+
+Com um adaptador LoRA, cada camada adaptada faz duas multiplicações extra por token
+((x @ lora_a) @ lora_b). Este módulo exporta uma versão fundida do modelo (pesos
+base + delta LoRA, re-quantizados com o mesmo group_size/bits) para
+models/fused/<hash do adaptador>/, usando os métodos fuse() do mlx_lm
+(LoRALinear, LoRASwitchLinear, LoRAEmbedding). Quando essa cópia existe,
+load_model() carrega-a diretamente e a inferência corre ao ritmo do modelo base.
+
+O hash cobre os pesos e a configuração do adaptador e a configuração do modelo base:
+um adaptador re-treinado gera uma nova entrada, sem reutilizar uma fusão antiga.
+
+Memória: o mx.load lê os safetensors de forma preguiçosa (tensor a tensor, sem buffer
+intermédio), mas o MLX copia os pesos para buffers próprios do processo. Um
+np.memmap partilhado não evita essa cópia (as páginas mapeadas somam-se à memória
+privada), pelo que cada processo que carrega o modelo paga ~4 GB de memória única (USS).
+A partilha entre processos faz-se com um único processo dono do modelo (servidor de
+inferência); --measure reporta os tempos de carregamento a frio/quente e a USS.
+
+Usage:
+    python scripts/model_loader.py --fuse
+    python scripts/model_loader.py --fuse --adapter-path checkpoints_qlora/adapters --force
+    python scripts/model_loader.py --measure
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import mlx.core as mx
+import psutil
+from mlx.utils import tree_unflatten
+from mlx_lm import load
+from mlx_lm.utils import save
+
+BASE_DIR = Path(__file__).parent.parent
+BASE_MODEL = str(BASE_DIR / "models/mistral-7b-4bit")
+DEFAULT_ADAPTER_PATH = str(BASE_DIR / "checkpoints_qlora/adapters")
+FUSED_DIR = BASE_DIR / "models" / "fused"
+FUSED_INFO_FILE = "fused_info.json"
+ADAPTER_FILES = ("adapters.safetensors", "adapter_config.json")
+
+
+def adapter_hash(base_model, adapter_path):
+    """Hash dos ficheiros do adaptador e da configuração do modelo base"""
+    digest = hashlib.sha256()
+    base_config = Path(base_model) / "config.json"
+    digest.update(base_config.read_bytes() if base_config.exists() else str(base_model).encode("utf-8"))
+    for name in ADAPTER_FILES:
+        path = Path(adapter_path) / name
+        if path.exists():
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def has_adapter(adapter_path):
+    return adapter_path is not None and (Path(adapter_path) / "adapters.safetensors").exists()
+
+
+def fused_model_path(base_model, adapter_path):
+    return FUSED_DIR / adapter_hash(base_model, adapter_path)
+
+
+def is_fused_ready(path):
+    # fused_info.json é escrito no fim da exportação: sem ele a cópia está incompleta
+    return (Path(path) / FUSED_INFO_FILE).exists()
+
+
+def export_fused(base_model=BASE_MODEL, adapter_path=DEFAULT_ADAPTER_PATH, force=False):
+    """Funde o adaptador nos pesos base e grava o modelo em models/fused/<hash>/"""
+    output_dir = fused_model_path(base_model, adapter_path)
+    if is_fused_ready(output_dir) and not force:
+        print(f"[INFO] Modelo fundido já existe: {output_dir}", file=sys.stderr)
+        return output_dir
+
+    print(f"[INFO] A fundir {adapter_path} em {base_model}...", file=sys.stderr)
+    start = time.perf_counter()
+    model, tokenizer, config = load(base_model, adapter_path=adapter_path, return_config=True)
+    fused = [(name, module.fuse(dequantize=False)) for name, module in model.named_modules() if hasattr(module, "fuse")]
+    if fused:
+        model.update_modules(tree_unflatten(fused))
+
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    save(output_dir, base_model, model, tokenizer, config, donate_model=False)
+    with open(output_dir / FUSED_INFO_FILE, 'w', encoding='utf-8') as f:
+        json.dump({
+            "base_model": str(base_model),
+            "adapter_path": str(adapter_path),
+            "adapter_hash": output_dir.name,
+            "fused_layers": len(fused),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }, f, indent=4, ensure_ascii=False)
+    print(f"[OK] {len(fused)} camadas fundidas em {time.perf_counter() - start:.1f}s: {output_dir}", file=sys.stderr)
+    return output_dir
+
+
+def load_model(base_model=BASE_MODEL, adapter_path=DEFAULT_ADAPTER_PATH, use_fused=True):
+    """
+    Carrega o modelo para inferência. Devolve (model, tokenizer, modo), com modo:
+        "fused"   - cópia fundida em cache para este adaptador
+        "adapter" - modelo base + adaptador LoRA (sem cópia fundida)
+        "base"    - modelo base (adaptador inexistente)
+    """
+    if not has_adapter(adapter_path):
+        print(f"[WARN] Adapter não encontrado: {adapter_path}; a carregar o modelo base", file=sys.stderr)
+        model, tokenizer = load(base_model)
+        return model, tokenizer, "base"
+
+    if use_fused:
+        fused_path = fused_model_path(base_model, adapter_path)
+        if is_fused_ready(fused_path):
+            print(f"[INFO] A carregar modelo fundido em cache: {fused_path}", file=sys.stderr)
+            model, tokenizer = load(str(fused_path))
+            return model, tokenizer, "fused"
+
+    print(f"[INFO] A carregar {base_model} com adapter {adapter_path}", file=sys.stderr)
+    model, tokenizer = load(base_model, adapter_path=adapter_path)
+    return model, tokenizer, "adapter"
+
+
+def process_memory():
+    """Memória do processo em MB: RSS, USS (única), partilhada e buffers ativos do MLX"""
+    info = psutil.Process(os.getpid()).memory_full_info()
+    return {
+        "rss_mb": info.rss / (1024 ** 2),
+        "uss_mb": info.uss / (1024 ** 2),
+        "shared_mb": getattr(info, "shared", 0) / (1024 ** 2),
+        "mlx_active_mb": mx.get_active_memory() / (1024 ** 2),
+    }
+
+
+def evict_from_page_cache(model_path):
+    """Retira os ficheiros de pesos da page cache (Linux) para medir um carregamento a frio"""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for weight_file in glob.glob(str(Path(model_path) / "*.safetensors")):
+        fd = os.open(weight_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def _weight_dirs(base_model, adapter_path, use_fused):
+    """Pastas cujos pesos load_model vai ler com estes argumentos"""
+    if not has_adapter(adapter_path):
+        return [base_model]
+    if use_fused and is_fused_ready(fused_model_path(base_model, adapter_path)):
+        return [fused_model_path(base_model, adapter_path)]
+    return [base_model, adapter_path]
+
+
+def _measure_child(base_model, adapter_path, use_fused, queue):
+    start = time.perf_counter()
+    model, _, mode = load_model(base_model, adapter_path, use_fused=use_fused)
+    mx.eval(model.parameters())
+    load_sec = time.perf_counter() - start
+    mx.clear_cache()
+    queue.put({"mode": mode, "load_sec": load_sec, **process_memory()})
+
+
+def measure_load(base_model=BASE_MODEL, adapter_path=DEFAULT_ADAPTER_PATH, use_fused=True):
+    """Carrega o modelo em processos novos (a frio e a quente) e devolve tempos e memória"""
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    # Retirar da page cache a cópia que vai de facto ser carregada (a fundida, quando existe)
+    weight_dirs = _weight_dirs(base_model, adapter_path, use_fused)
+    for label in ("cold", "warm"):
+        if label == "cold" and not all([evict_from_page_cache(path) for path in weight_dirs]):
+            label = "first"
+        queue = context.Queue()
+        child = context.Process(target=_measure_child, args=(base_model, adapter_path, use_fused, queue))
+        child.start()
+        results[label] = queue.get()
+        child.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exportar/verificar o modelo fundido (base + LoRA)")
+    parser.add_argument("--fuse", action="store_true", help="Exportar o modelo fundido para este adaptador")
+    parser.add_argument("--base-model", default=BASE_MODEL)
+    parser.add_argument("--adapter-path", default=DEFAULT_ADAPTER_PATH)
+    parser.add_argument("--force", action="store_true", help="Voltar a fundir mesmo que a cópia exista")
+    parser.add_argument("--measure", action="store_true",
+                        help="Medir carregamento a frio/quente e memória única por processo (JSON)")
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure_load(args.base_model, args.adapter_path), indent=2))
+        return
+    if not has_adapter(args.adapter_path):
+        print(f"❌ Adapter não encontrado: {args.adapter_path}", file=sys.stderr)
+        sys.exit(1)
+    if args.fuse:
+        export_fused(args.base_model, args.adapter_path, force=args.force)
+    else:
+        path = fused_model_path(args.base_model, args.adapter_path)
+        print(f"{path} ({'pronto' if is_fused_ready(path) else 'não exportado; usar --fuse'})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Treino simultâneo de vários adaptadores LoRA sobre um único forward do modelo base.
+
+Em vez de correr train() K vezes para comparar configurações LoRA (rank, scale,
+dropout, learning rate), os K conjuntos de adaptadores são ligados às mesmas
+camadas base e treinados nos mesmos batches:
+    - o tronco congelado (blocos sem LoRA) corre uma única vez por batch;
+    - a partir do primeiro bloco adaptado o batch é replicado K vezes na dimensão
+      do batch (linhas k*B..(k+1)*B pertencem ao adaptador k), para que as camadas
+      base corram numa única multiplicação de matrizes maior;
+    - cada adaptador tem a sua perda, o seu otimizador AdamW (MultiOptimizer) e o
+      seu melhor checkpoint, exportado no formato normal do mlx_lm.
+
+Usage:
+    python scripts/multi_lora.py --configs sweep.json
+    (sweep.json: lista de {"rank": 4, "scale": 16, "dropout": 0.05, "learning_rate": 2e-4})
+"""
+
+import argparse
+import json
+import random
+import time
+from functools import partial
+from pathlib import Path
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx.optimizers import AdamW, MultiOptimizer
+from mlx.utils import tree_flatten, tree_unflatten
+from mlx_lm import load
+from mlx_lm.models.base import create_attention_mask
+from tqdm import tqdm
+
+import train_qlora
+from train_qlora import Validator, build_batch, load_batch, load_dataset, output_head, tokenize
+from trunk_cache import build_trunk_cache, frozen_trunk_forward, num_frozen_layers
+
+MULTI_LORA_DIR = train_qlora.OUTPUT_DIR / "multi_lora"
+
+
+class LoRAAdapter(nn.Module):
+    """Um conjunto de pesos LoRA (A, B) com o seu scale e dropout"""
+
+    def __init__(self, input_dims, output_dims, rank=8, scale=20.0, dropout=0.0):
+        super().__init__()
+        self.dropout = nn.Dropout(p=dropout)
+        self.scale = scale
+        bound = 1 / input_dims ** 0.5
+        self.lora_a = mx.random.uniform(low=-bound, high=bound, shape=(input_dims, rank))
+        self.lora_b = mx.zeros(shape=(rank, output_dims))
+
+    def __call__(self, x):
+        return self.scale * ((self.dropout(x) @ self.lora_a) @ self.lora_b)
+
+
+class MultiLoRALinear(nn.Module):
+    """
+    Camada linear (possivelmente quantizada) partilhada por K adaptadores LoRA.
+    A entrada tem K*B linhas: o bloco k do batch passa pelo adaptador k.
+    """
+
+    def __init__(self, linear, lora_configs):
+        super().__init__()
+        output_dims, input_dims = linear.weight.shape
+        if isinstance(linear, nn.QuantizedLinear):
+            input_dims = input_dims * 32 // linear.bits
+        self.linear = linear
+        self.adapters = [
+            LoRAAdapter(input_dims, output_dims, c["rank"], c["scale"], c.get("dropout", 0.0))
+            for c in lora_configs
+        ]
+
+    def __call__(self, x):
+        y = self.linear(x)
+        # Fatias explícitas em vez de mx.split (o mx.split falha dentro do mx.compile)
+        rows = x.shape[0] // len(self.adapters)
+        z = mx.concatenate(
+            [adapter(x[k * rows:(k + 1) * rows]) for k, adapter in enumerate(self.adapters)], axis=0
+        )
+        return y + z.astype(x.dtype)
+
+
+def apply_multi_lora(model, num_layers, lora_configs, keys):
+    """Substitui as camadas `keys` dos últimos `num_layers` blocos por MultiLoRALinear"""
+    for layer in model.layers[-num_layers:]:
+        replacements = [
+            (name, MultiLoRALinear(module, lora_configs))
+            for name, module in layer.named_modules()
+            if name in keys and isinstance(module, (nn.Linear, nn.QuantizedLinear))
+        ]
+        layer.update_modules(tree_unflatten(replacements))
+
+
+def multi_loss_fn(model, num_adapters, num_frozen, inputs, targets, positions, lengths):
+    """Soma das perdas dos K adaptadores (os gradientes de cada um só dependem da sua perda)"""
+    if inputs.ndim == 3:
+        hidden = inputs.astype(model.model.norm.weight.dtype)
+    else:
+        hidden = frozen_trunk_forward(model, inputs, num_frozen)
+
+    # Replicar o batch por adaptador a partir do primeiro bloco adaptado
+    hidden = mx.concatenate([hidden] * num_adapters, axis=0)
+    mask = create_attention_mask(hidden, None)
+    for layer in model.layers[num_frozen:]:
+        hidden = layer(hidden, mask)
+    hidden = model.model.norm(hidden)
+
+    positions = mx.concatenate([positions] * num_adapters, axis=0)
+    hidden = mx.take_along_axis(hidden, positions[..., None], axis=1)
+    logits = output_head(model, hidden)
+
+    targets = mx.concatenate([targets] * num_adapters, axis=0)
+    token_mask = mx.arange(targets.shape[1])[None, :] < lengths[:, None]
+    loss = nn.losses.cross_entropy(logits, targets, reduction='none')
+    loss = loss.reshape(num_adapters, -1, targets.shape[1])
+    ntoks = mx.sum(token_mask)
+    losses = mx.sum(loss * token_mask, axis=(1, 2)) / ntoks
+    return mx.sum(losses), (losses, ntoks)
+
+
+def create_multi_step_fn(model, optimizer, num_adapters, num_frozen):
+    loss = partial(multi_loss_fn, model, num_adapters, num_frozen)
+    grad_fn = nn.value_and_grad(model, lambda *batch: loss(*batch))
+    state = [model.state, optimizer.state, mx.random.state]
+
+    @partial(mx.compile, inputs=state, outputs=state)
+    def step_fn(inputs, targets, positions, lengths):
+        (_, (losses, _)), grads = grad_fn(inputs, targets, positions, lengths)
+        optimizer.update(model, grads)
+        return losses
+    return step_fn
+
+
+def create_multi_eval_fn(model, num_adapters, num_frozen):
+    @partial(mx.compile, inputs=model.state)
+    def eval_fn(inputs, targets, positions, lengths):
+        _, (losses, ntoks) = multi_loss_fn(model, num_adapters, num_frozen, inputs, targets, positions, lengths)
+        return losses, ntoks
+    return train_qlora.eval_mode(model, eval_fn)
+
+
+def create_multi_optimizer(model, lora_configs, default_lr):
+    """Um AdamW por adaptador, escolhido pelo caminho do parâmetro (...adapters.k...)"""
+    optimizers = [AdamW(learning_rate=c.get("learning_rate", default_lr)) for c in lora_configs]
+    filters = [partial(lambda k, path, _: f".adapters.{k}." in path, k) for k in range(len(lora_configs) - 1)]
+    optimizer = MultiOptimizer(optimizers, filters)
+    # MultiOptimizer.state é construído a cada acesso: inicializar antes do mx.compile
+    # para que o estado capturado seja o dos otimizadores internos
+    optimizer.init(model.trainable_parameters())
+    return optimizer
+
+
+def adapter_weights(model, k):
+    """Pesos do adaptador k com os nomes do LoRALinear do mlx_lm (carregáveis com adapter_path)"""
+    weights = {}
+    for path, value in tree_flatten(model.trainable_parameters()):
+        marker = f".adapters.{k}."
+        if marker in path:
+            weights[path.replace(marker, ".")] = value
+    return weights
+
+
+def export_adapter(model, k, lora_config, num_layers, output_dir):
+    """Guarda adapters.safetensors + adapter_config.json do adaptador k (formato do mlx_lm)"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    mx.save_safetensors(str(output_dir / "adapters.safetensors"), adapter_weights(model, k))
+    lora_parameters = dict(train_qlora.qlora_config["lora_parameters"])
+    lora_parameters.update({key: lora_config[key] for key in ("rank", "scale", "dropout") if key in lora_config})
+    with open(output_dir / "adapter_config.json", 'w', encoding='utf-8') as f:
+        json.dump({
+            "fine_tune_type": "lora",
+            "num_layers": num_layers,
+            "lora_parameters": lora_parameters,
+            "learning_rate": lora_config.get("learning_rate"),
+        }, f, indent=4, ensure_ascii=False)
+
+
+def train_multi_lora(lora_configs, custom_training_config=None, output_dir=MULTI_LORA_DIR):
+    """Treina os K adaptadores em simultâneo; devolve a tabela de resultados por adaptador"""
+    config = dict(train_qlora.training_config)
+    if custom_training_config:
+        config.update(custom_training_config)
+    num_adapters = len(lora_configs)
+    num_layers = train_qlora.qlora_config["num_layers"]
+    keys = train_qlora.qlora_config["lora_parameters"]["keys"]
+
+    print(f"A carregar modelo: {train_qlora.model_name} com {num_adapters} adaptadores LoRA simultâneos")
+    model, tokenizer = load(train_qlora.model_name)
+    model.freeze()
+    apply_multi_lora(model, num_layers, lora_configs, keys)
+    num_frozen = num_frozen_layers(model, num_layers)
+
+    train_tokens = [tokenize(s, tokenizer, config["max_seq_length"]) for s in load_dataset(train_qlora.TRAIN_FILE)]
+    val_tokens = [tokenize(s, tokenizer, config["max_seq_length"]) for s in load_dataset(train_qlora.VALID_FILE)]
+    train_tokens = [(t, p) for t, p in train_tokens if len(t) > p]
+    val_tokens = [(t, p) for t, p in val_tokens if len(t) > p]
+
+    train_cache = val_cache = None
+    if config["cache_frozen_trunk"]:
+        model_name = train_qlora.model_name
+        train_cache = build_trunk_cache(train_qlora.TRUNK_CACHE_DIR, model, model_name, num_frozen, train_tokens, build_batch)
+        if val_tokens:
+            val_cache = build_trunk_cache(train_qlora.TRUNK_CACHE_DIR, model, model_name, num_frozen, val_tokens, build_batch)
+
+    optimizer = create_multi_optimizer(model, lora_configs, config["learning_rate"])
+    step_fn = create_multi_step_fn(model, optimizer, num_adapters, num_frozen)
+    validator = Validator(create_multi_eval_fn(model, num_adapters, num_frozen), val_tokens, val_cache,
+                          batch_size=max(1, config["eval_batch_size"] // num_adapters))
+
+    best = [{"val_loss": float('inf'), "step": None} for _ in lora_configs]
+    steps_per_epoch = len(train_tokens) // config["batch_size"]
+    start_time = time.perf_counter()
+
+    def evaluate(step):
+        val_losses = validator.full()
+        for k, val_loss in enumerate(val_losses):
+            if val_loss < best[k]["val_loss"]:
+                best[k] = {"val_loss": val_loss, "step": step}
+                export_adapter(model, k, lora_configs[k], num_layers, Path(output_dir) / f"adapter_{k}")
+        print(f"Passo {step} - Val Loss: " + " | ".join(f"[{k}] {v:.4f}" for k, v in enumerate(val_losses)))
+
+    global_step = 0
+    for epoch in range(config["num_epochs"]):
+        order = list(range(len(train_tokens)))
+        random.shuffle(order)
+        for i in tqdm(range(steps_per_epoch), desc=f"Época {epoch + 1}/{config['num_epochs']}"):
+            indices = order[i * config["batch_size"]:(i + 1) * config["batch_size"]]
+            losses = step_fn(*load_batch(train_tokens, indices, train_cache))
+            mx.eval(model.parameters(), optimizer.state, losses)
+            global_step += 1
+
+            if global_step % config["log_steps"] == 0:
+                print(f"Passo {global_step} - Loss: " + " | ".join(f"[{k}] {v:.4f}" for k, v in enumerate(losses.tolist())))
+            if global_step % config["eval_steps"] == 0 and val_tokens:
+                evaluate(global_step)
+    if val_tokens and global_step % config["eval_steps"] != 0:
+        evaluate(global_step)
+
+    elapsed = time.perf_counter() - start_time
+    results = [
+        {"adapter": k, **lora_configs[k], "best_val_loss": best[k]["val_loss"], "best_step": best[k]["step"],
+         "path": str(Path(output_dir) / f"adapter_{k}")}
+        for k in range(num_adapters)
+    ]
+    results.sort(key=lambda r: r["best_val_loss"])
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(output_dir) / "results.json", 'w', encoding='utf-8') as f:
+        json.dump({"total_time_sec": elapsed, "steps": global_step, "results": results}, f, indent=4, ensure_ascii=False)
+
+    print(f"\n✓ {num_adapters} adaptadores treinados em {elapsed:.1f}s; resultados em {Path(output_dir) / 'results.json'}")
+    for r in results:
+        print(f"  [{r['adapter']}] rank={r['rank']} scale={r['scale']} dropout={r.get('dropout', 0.0)} -> {r['best_val_loss']:.4f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Treino simultâneo de vários adaptadores LoRA")
+    parser.add_argument("--configs", type=Path, required=True,
+                        help="JSON com a lista de configurações ({rank, scale, dropout, learning_rate})")
+    parser.add_argument("--output", type=Path, default=MULTI_LORA_DIR)
+    args = parser.parse_args()
+
+    with open(args.configs, 'r', encoding='utf-8') as f:
+        lora_configs = json.load(f)
+    train_multi_lora(lora_configs, output_dir=args.output)
+
+
+if __name__ == "__main__":
+    main()
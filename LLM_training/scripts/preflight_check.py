@@ -452,6 +452,14 @@ class PreflightChecker:
     # RECOMENDAÇÃO DE CONFIGURAÇÃO
     # ========================================================================
 
+    def load_auto_preset(self):
+        """Preset medido por memory_probe.py para este modelo/hardware, se existir"""
+        try:
+            import memory_probe
+            return memory_probe.cached_auto_preset()
+        except Exception:
+            return None
+
     def recommend_config(self) -> RecommendedConfig:
         """Recomenda configuração otimizada baseado em hardware detectado"""
         self.print_section("7. RECOMENDAÇÃO DE CONFIGURAÇÃO")
@@ -513,6 +521,15 @@ class PreflightChecker:
             batch_size = max(1, batch_size // 2)
             reason += " | GPU não disponível"
 
+        # ====== RESULTADO MEDIDO (memory_probe.py) ======
+
+        auto_preset = self.load_auto_preset()
+        if auto_preset:
+            batch_size = auto_preset["batch_size"]
+            grad_accum = auto_preset["gradient_accumulation"]
+            max_seq_length = auto_preset["max_seq_length"]
+            reason = "Medido por sondagem de memória (memory_probe.py)"
+
         # ====== OUTRAS CONFIGS DERIVADAS ======
 
         num_epochs = 3
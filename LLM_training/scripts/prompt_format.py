@@ -0,0 +1,17 @@
+"""
+Formato das amostras de treino ("### Pergunta" / "### Resposta").
+
+Partilhado por train_qlora.py e pelos scripts de inferência sem importar o treino, para
+que todos os prompts gerados usem exatamente o formato com que o modelo foi treinado.
+"""
+
+
+def format_prompt(prompt, context=None):
+    """Prompt até ao início da resposta; com contexto recuperado (retrieval.py), num bloco "### Contexto" antes da pergunta"""
+    block = f"### Contexto:\n{context}\n\n" if context else ""
+    return f"{block}### Pergunta:\n{prompt}\n\n### Resposta:\n"
+
+
+def format_sample(sample):
+    """Amostra no formato do treino: o prompt seguido da completion"""
+    return format_prompt(sample["prompt"]) + sample["completion"]
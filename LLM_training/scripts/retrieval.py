@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+Índice de recuperação sobre as fontes em dados/ (geração aumentada com contexto).
+
+O conhecimento de dados/ (biografias, classificações, livro do SCF, estatutos) chega ao
+bot apenas pelo fine-tuning. Este módulo parte as fontes markdown/txt/json em excertos
+de ~CHUNK_WORDS palavras, indexa-os com BM25 (índice invertido em memória) e devolve
+os top-k excertos para uma pergunta em poucos milissegundos; format_context() prepara-os
+para o bloco "### Contexto" de prompt_format.format_prompt().
+
+A reindexação é incremental: cada ficheiro guarda a sua assinatura (mtime, tamanho) e só
+os ficheiros novos ou alterados voltam a ser partidos em excertos. Opcionalmente (--dense)
+cada excerto tem também um vetor denso (embeddings.py); a pesquisa combina então o
+ranking BM25 e o denso por reciprocal rank fusion.
+
+Formato em disco (INDEX_DIR):
+    index.json    ficheiros indexados (assinatura) e respetivos excertos, com as frequências
+                  dos termos; o índice invertido é reconstruído ao carregar
+    vectors.npy   (opcional) matriz float16 (excertos, dim), aberta em memory-map
+
+Usage:
+    python scripts/retrieval.py --update
+    python scripts/retrieval.py "Quem foi Hassan Nader?" --top-k 3
+    python scripts/retrieval.py "Quando foi fundado o Farense?" --dense
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from match_query import normalize
+
+BASE_DIR = Path(__file__).parent.parent
+DADOS_DIR = BASE_DIR / "dados"
+INDEX_DIR = BASE_DIR / "output/retrieval"
+INDEX_VERSION = 1
+
+# Fontes indexadas (relativas a dados/)
+SOURCES = [
+    "biografias/**/*.md",
+    "biografias/**/*.txt",
+    "biografias/**/*.json",
+    "classificacoes/classificacoes_completas.md",
+    "outros/livro_scf_*.txt",
+    "outros/estatutos_scf_*.md",
+]
+
+CHUNK_WORDS = 160
+CHUNK_OVERLAP = 40       # Palavras repetidas entre janelas quando um bloco é maior que CHUNK_WORDS
+TOP_K = 3
+MAX_CONTEXT_CHARS = 1500
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60               # Constante da reciprocal rank fusion (BM25 + denso)
+DUPLICATE_JACCARD = 0.6  # Excertos quase iguais (p.ex. versões corrigidas do livro) só contam uma vez
+
+STOPWORDS = {
+    "a", "o", "as", "os", "ao", "aos", "de", "do", "da", "dos", "das", "e", "em", "no", "na", "nos", "nas",
+    "um", "uma", "uns", "umas", "que", "por", "para", "com", "sem", "se", "foi", "era", "sao", "ser", "qual",
+    "quais", "quem", "quando", "como", "onde", "sua", "seu", "suas", "seus", "mais", "pelo", "pela", "pelos",
+    "pelas", "ou", "mas", "lhe", "isso", "este", "esta", "esse", "essa", "ja", "tem", "teve", "sobre",
+}
+
+
+def tokenize(text):
+    return [t for t in normalize(text).split() if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+def _words(text):
+    return len(text.split())
+
+
+def pack(blocks, heading=""):
+    """Junta blocos (parágrafos, linhas de tabela, pares pergunta/resposta) em excertos de ~CHUNK_WORDS"""
+    chunks, current, size = [], [], 0
+    for block in blocks:
+        n = _words(block)
+        if n > CHUNK_WORDS:
+            if current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            lines = block.split("\n")
+            if len(lines) > 1:
+                chunks += [chunk["text"] for chunk in pack(lines)]
+                continue
+            words = block.split()
+            for i in range(0, max(len(words) - CHUNK_OVERLAP, 1), CHUNK_WORDS - CHUNK_OVERLAP):
+                chunks.append(" ".join(words[i:i + CHUNK_WORDS]))
+            continue
+        if current and size + n > CHUNK_WORDS:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(block)
+        size += n
+    if current:
+        chunks.append("\n".join(current))
+    return [{"heading": heading, "text": text} for text in chunks if text.strip()]
+
+
+def _paragraphs(text, join_lines=False):
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    if join_lines:
+        # Texto digitalizado: as quebras de linha dentro de um parágrafo não têm significado
+        paragraphs = [re.sub(r"\s*\n\s*", " ", p) for p in paragraphs]
+    return paragraphs
+
+
+def chunk_markdown(text, title):
+    """Uma secção por cabeçalho; o cabeçalho (e o anterior) acompanha cada excerto da secção"""
+    chunks, headings, lines = [], [], []
+
+    def flush():
+        if lines:
+            chunks.extend(pack(_paragraphs("\n".join(lines)), " > ".join(headings[-2:]) or title))
+            lines.clear()
+
+    for line in text.split("\n"):
+        m = re.match(r"^(#{1,6})\s+(.*)$", line)
+        if m:
+            flush()
+            level = len(m.group(1))
+            headings[level - 1:] = [m.group(2).strip()]
+            continue
+        lines.append(line)
+    flush()
+    return chunks
+
+
+def _json_blocks(value, label=""):
+    if isinstance(value, dict):
+        lines, blocks = [], []
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                blocks += _json_blocks(item, key)
+            elif item not in (None, ""):
+                lines.append(f"{key}: {item}")
+        if lines:
+            blocks.insert(0, (f"{label}:\n" if label else "") + "\n".join(lines))
+        return blocks
+    if isinstance(value, list):
+        scalars = [str(item) for item in value if not isinstance(item, (dict, list))]
+        blocks = [f"{label}: " + "; ".join(scalars)] if scalars else []
+        for item in value:
+            if isinstance(item, (dict, list)):
+                blocks += _json_blocks(item, label)
+        return blocks
+    return [f"{label}: {value}"]
+
+
+def chunk_file(path):
+    """Excertos de um ficheiro .md, .txt ou .json"""
+    title = path.stem.replace("_", " ")
+    if path.suffix == ".json":
+        with open(path, 'r', encoding='utf-8') as f:
+            return pack(_json_blocks(json.load(f)), title)
+    text = path.read_text(encoding='utf-8', errors='replace')
+    if path.suffix == ".md":
+        return chunk_markdown(text, title)
+    return pack(_paragraphs(text, join_lines=True), title)
+
+
+def _signature(path):
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _chunk_text(chunk):
+    return f"{chunk['heading']}\n{chunk['text']}" if chunk["heading"] else chunk["text"]
+
+
+class RetrievalIndex:
+    """Excertos das fontes de dados/ com índice BM25 e vetores densos opcionais"""
+
+    def __init__(self, index_dir=INDEX_DIR, root=DADOS_DIR, sources=SOURCES):
+        self.index_dir = Path(index_dir)
+        self.root = Path(root)
+        self.sources = sources
+        self.index_file = self.index_dir / "index.json"
+        self.vectors_file = self.index_dir / "vectors.npy"
+        self.files = {}     # caminho relativo -> {"signature", "chunks"}
+        self.dense = None   # {"model", "dim", "ids"} dos vetores em vectors.npy
+        if self.index_file.exists():
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION:
+                self.files = data["files"]
+                self.dense = data.get("dense")
+        self._build()
+
+    def _build(self):
+        """Índice invertido (termo -> [(excerto, tf)]) e comprimentos, a partir dos excertos"""
+        self.chunks = [chunk for rel in sorted(self.files) for chunk in self.files[rel]["chunks"]]
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for i, chunk in enumerate(self.chunks):
+            for term, tf in chunk["terms"].items():
+                self.postings[term].append((i, tf))
+            self.lengths.append(chunk["length"])
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.term_sets = [set(chunk["terms"]) for chunk in self.chunks]
+
+        self.vectors = None
+        if self.dense and self.vectors_file.exists() and self.dense["ids"] == [c["id"] for c in self.chunks]:
+            self.vectors = np.load(self.vectors_file, mmap_mode='r')
+
+    def _index_file(self, path, rel):
+        chunks = []
+        for chunk in chunk_file(path):
+            terms = tokenize(_chunk_text(chunk))
+            chunk.update(
+                source=rel,
+                id=hashlib.sha1(_chunk_text(chunk).encode("utf-8")).hexdigest()[:16],
+                terms=dict(Counter(terms)),
+                length=len(terms),
+            )
+            chunks.append(chunk)
+        return chunks
+
+    def update(self, embedder=None):
+        """Reindexa apenas os ficheiros novos, alterados ou removidos; devolve as contagens"""
+        current = {}
+        for pattern in self.sources:
+            for path in sorted(self.root.glob(pattern)):
+                current[path.relative_to(self.root).as_posix()] = path
+
+        changes = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        for rel in [rel for rel in self.files if rel not in current]:
+            del self.files[rel]
+            changes["removed"] += 1
+        for rel, path in current.items():
+            signature = _signature(path)
+            entry = self.files.get(rel)
+            if entry and entry["signature"] == signature:
+                changes["unchanged"] += 1
+                continue
+            changes["updated" if entry else "added"] += 1
+            self.files[rel] = {"signature": signature, "chunks": self._index_file(path, rel)}
+
+        changed = changes["added"] or changes["updated"] or changes["removed"]
+        if changed:
+            self._build()
+        if embedder is not None and self.vectors is None:
+            self._update_vectors(embedder)
+            changed = True
+        if changed:
+            self.save()
+        return changes
+
+    def _update_vectors(self, embedder):
+        """Reescreve vectors.npy, calculando embeddings apenas para os excertos novos"""
+        ids = [chunk["id"] for chunk in self.chunks]
+        old_rows, old_vectors = {}, None
+        if self.dense and self.dense["model"] == embedder.name and self.vectors_file.exists():
+            old_vectors = np.load(self.vectors_file, mmap_mode='r')
+            old_rows = {cid: row for row, cid in enumerate(self.dense["ids"])}
+        missing = [i for i, cid in enumerate(ids) if cid not in old_rows]
+        print(f"A calcular {len(missing)} embeddings ({embedder.name}); {len(ids) - len(missing)} reutilizados",
+              file=sys.stderr)
+
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_dir / "vectors.tmp.npy"
+        data = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float16, shape=(len(ids), embedder.dim))
+        for row, cid in enumerate(ids):
+            if cid in old_rows:
+                data[row] = old_vectors[old_rows[cid]]
+        if missing:
+            data[missing] = embedder.embed([_chunk_text(self.chunks[i]) for i in missing])
+        data.flush()
+        del data, old_vectors
+        os.replace(tmp_file, self.vectors_file)
+        self.dense = {"model": embedder.name, "dim": embedder.dim, "ids": ids}
+        self.vectors = np.load(self.vectors_file, mmap_mode='r')
+
+    def save(self):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_suffix(".tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"version": INDEX_VERSION, "files": self.files, "dense": self.dense}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.index_file)
+
+    def bm25(self, query):
+        """Pontuação BM25 de cada excerto que contém pelo menos um termo da pergunta"""
+        scores = defaultdict(float)
+        n = len(self.chunks)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / self.avg_length)
+                scores[i] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query, top_k=TOP_K, embedder=None):
+        """Top-k excertos (source, heading, text, score), sem duplicados quase iguais"""
+        scores = self.bm25(query)
+        ranked = heapq.nlargest(top_k * 4, scores, key=scores.get)
+        if embedder is not None and self.vectors is not None:
+            dense_scores = self.vectors @ embedder.embed_one(query).astype(np.float16)
+            dense_ranked = np.argsort(-dense_scores)[:top_k * 4]
+            fused = defaultdict(float)
+            for ranking in (ranked, dense_ranked):
+                for rank, i in enumerate(ranking):
+                    fused[int(i)] += 1 / (RRF_K + rank + 1)
+            scores = fused
+            ranked = sorted(fused, key=fused.get, reverse=True)
+
+        hits = []
+        for i in ranked:
+            terms = self.term_sets[i]
+            if any(len(terms & self.term_sets[j]) / max(len(terms | self.term_sets[j]), 1) >= DUPLICATE_JACCARD
+                   for j, _ in hits):
+                continue
+            hits.append((i, scores[i]))
+            if len(hits) == top_k:
+                break
+        return [{"source": self.chunks[i]["source"], "heading": self.chunks[i]["heading"],
+                 "text": self.chunks[i]["text"], "score": float(score)} for i, score in hits]
+
+
+def format_context(hits, max_chars=MAX_CONTEXT_CHARS):
+    """Excertos para o bloco "### Contexto" do prompt, limitados a max_chars"""
+    parts, used = [], 0
+    for hit in hits:
+        text = f"[{hit['heading']}] {hit['text']}" if hit["heading"] else hit["text"]
+        if used + len(text) > max_chars:
+            if max_chars - used > 200:
+                parts.append(text[:max_chars - used].rsplit(" ", 1)[0] + " ...")
+            break
+        parts.append(text)
+        used += len(text)
+    return "\n\n".join(parts)
+
+
+_index = None
+
+
+def get_index():
+    """Índice partilhado, carregado (e atualizado se as fontes mudaram) uma vez por processo"""
+    global _index
+    if _index is None:
+        _index = RetrievalIndex()
+        _index.update()
+    return _index
+
+
+def retrieve_context(question, top_k=TOP_K, embedder=None):
+    """Contexto recuperado para a pergunta ("" se nenhum excerto partilhar termos com ela)"""
+    return format_context(get_index().search(question, top_k, embedder))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice BM25 (e denso opcional) sobre as fontes em dados/")
+    parser.add_argument("query", nargs="?", help="Pergunta a pesquisar")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--update", action="store_true", help="Só atualizar o índice")
+    parser.add_argument("--rebuild", action="store_true", help="Apagar e reconstruir o índice")
+    parser.add_argument("--dense", action="store_true", help="Usar (e calcular) vetores densos")
+    parser.add_argument("--embedding-model", default=None, help="Modelo de embeddings (default: models/embedding)")
+    args = parser.parse_args()
+    if not args.query and not args.update and not args.rebuild:
+        parser.error("indique uma pergunta ou --update")
+
+    embedder = None
+    if args.dense:
+        from embeddings import EMBEDDING_MODEL, Embedder
+        embedder = Embedder(args.embedding_model or EMBEDDING_MODEL)
+
+    if args.rebuild:
+        for path in (INDEX_DIR / "index.json", INDEX_DIR / "vectors.npy"):
+            path.unlink(missing_ok=True)
+    start = time.perf_counter()
+    index = RetrievalIndex()
+    changes = index.update(embedder)
+    print(f"[índice: {len(index.chunks)} excertos de {len(index.files)} ficheiros em "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms; {changes}]", file=sys.stderr)
+    if not args.query:
+        return
+
+    start = time.perf_counter()
+    hits = index.search(args.query, args.top_k, embedder)
+    search_ms = (time.perf_counter() - start) * 1000
+    for hit in hits:
+        print(f"\n--- {hit['source']} ({hit['score']:.3f}) {hit['heading']}\n{hit['text']}")
+    print(f"\n[pesquisa em {search_ms:.1f} ms]", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
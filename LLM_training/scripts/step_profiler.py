@@ -0,0 +1,184 @@
+"""
+Captura de perfis a pedido para passos de treino (train_qlora.train()).
+
+Um perfil dos passos N..N+k pode ser pedido:
+    - na configuração: training_config["profile_steps"] = [N, k]
+    - com o treino a correr: POST /profile no backend, que escreve
+      checkpoints_qlora/profile_request.json ({"start_step": N, "num_steps": k})
+
+Durante a captura são escritos, junto aos checkpoints (checkpoints_qlora/profiles/):
+    - profile_stepN-M.speedscope.json: amostragem das stacks Python da thread de treino
+      (abrir em https://www.speedscope.app)
+    - profile_stepN-M.trace.json: Chrome trace (chrome://tracing / Perfetto) com os
+      tempos por fase do passo (batch, step_dispatch, eval_sync, ...) medidos pelo PhaseTimer
+
+O MLX não expõe tempos por operação em Python; o trabalho de computação aparece na fase
+eval_sync (ou forward_backward/optimizer com detailed_step_timing). Em Metal, com
+MTL_CAPTURE_ENABLED=1, é também gravado um .gputrace com as operações Metal dos passos.
+
+Sem captura pedida, o custo no loop é uma verificação de atributo por passo e a leitura
+de um ficheiro a cada log_steps.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import mlx.core as mx
+
+SAMPLE_INTERVAL_SEC = 0.002
+
+
+class StackSampler(threading.Thread):
+    """Amostra periodicamente a stack Python de uma thread (perfil por amostragem)"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL_SEC):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self.frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stop_event = threading.Event()
+
+    def _frame_id(self, code, line):
+        key = (code.co_name, code.co_filename, line)
+        if key not in self.frame_index:
+            self.frame_index[key] = len(self.frames)
+            self.frames.append({"name": code.co_name, "file": code.co_filename, "line": line})
+        return self.frame_index[key]
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_id(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append(now - last)
+            last = now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class StepProfiler:
+    """Agenda e executa capturas de perfil para um intervalo de passos globais"""
+
+    def __init__(self, checkpoint_dir, profile_steps=None):
+        self.output_dir = Path(checkpoint_dir) / "profiles"
+        self.request_file = Path(checkpoint_dir) / "profile_request.json"
+        self.scheduled = None   # (primeiro passo, número de passos)
+        self.current_step = None
+        self.active = False
+        self.events = []
+        self.sampler = None
+        self.timer = None
+        self.gpu_trace = None
+        if profile_steps:
+            self.schedule(*profile_steps)
+
+    def schedule(self, start_step, num_steps):
+        self.scheduled = (int(start_step), max(int(num_steps), 1))
+        print(f"🔬 Perfil agendado: passos {self.scheduled[0]}..{self.scheduled[0] + self.scheduled[1] - 1}")
+
+    def poll(self, global_step):
+        """Lê (e consome) um pedido de captura escrito pelo backend"""
+        if self.active or not self.request_file.exists():
+            return
+        try:
+            with open(self.request_file, 'r', encoding='utf-8') as f:
+                request = json.load(f)
+            self.schedule(request.get("start_step") or global_step + 1, request.get("num_steps", 10))
+        except (json.JSONDecodeError, ValueError, TypeError) as e:
+            print(f"Pedido de perfil inválido: {e}")
+        finally:
+            self.request_file.unlink(missing_ok=True)
+
+    def step_begin(self, global_step, timer):
+        """Chamar antes de cada passo enquanto houver uma captura agendada"""
+        self.current_step = global_step
+        if self.active or global_step < self.scheduled[0]:
+            return
+        self.active = True
+        self.events = []
+        self.timer = timer
+        timer.listener = self._on_phase
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        if mx.metal.is_available() and os.environ.get("MTL_CAPTURE_ENABLED") == "1":
+            self.gpu_trace = self.output_dir / f"profile_step{global_step}.gputrace"
+            mx.metal.start_capture(str(self.gpu_trace))
+
+        self.sampler = StackSampler(threading.get_ident())
+        self.start_time = time.perf_counter()
+        self.sampler.start()
+
+    def step_end(self, global_step, force=False):
+        """Chamar depois de cada passo com captura ativa; termina e escreve os ficheiros no fim"""
+        first_step, num_steps = self.scheduled
+        if global_step < first_step + num_steps - 1 and not force:
+            return
+        self.sampler.stop()
+        end_time = time.perf_counter()
+        if self.gpu_trace is not None:
+            mx.metal.stop_capture()
+        self.timer.listener = None
+
+        name = f"profile_step{first_step}-{global_step}"
+        self._write_speedscope(self.output_dir / f"{name}.speedscope.json", name, end_time)
+        self._write_chrome_trace(self.output_dir / f"{name}.trace.json")
+        print(f"🔬 Perfil dos passos {first_step}..{global_step} guardado em {self.output_dir / name}.*")
+
+        self.active = False
+        self.scheduled = None
+        self.sampler = None
+        self.timer = None
+        self.gpu_trace = None
+
+    def _on_phase(self, name, seconds):
+        end = time.perf_counter()
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (end - seconds - self.start_time) * 1e6,
+            "dur": seconds * 1e6,
+            "pid": os.getpid(),
+            "tid": 1,
+            "args": {"step": self.current_step},
+        })
+
+    def _write_speedscope(self, path, name, end_time):
+        sampler = self.sampler
+        profile = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "train_qlora step_profiler",
+            "shared": {"frames": sampler.frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": end_time - self.start_time,
+                "samples": sampler.samples,
+                "weights": sampler.weights,
+            }],
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(profile, f)
+
+    def _write_chrome_trace(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
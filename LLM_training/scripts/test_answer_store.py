@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Testes das chaves (adaptador, pergunta) das respostas pré-calculadas (answer_store.py)
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import answer_store
+from answer_cache import partition_key
+from answer_store import AnswerStore, question_key, read_questions
+
+
+@pytest.fixture
+def adapter(tmp_path):
+    path = tmp_path / "adapters"
+    path.mkdir()
+    (path / "adapters.safetensors").write_bytes(b"pesos v1")
+    (path / "adapter_config.json").write_text(json.dumps({"rank": 8}))
+    return path
+
+
+def test_question_key_ignores_case_accents_and_punctuation():
+    assert question_key("Quem foi Hassan Nader?") == question_key("quem foi  hassan nader")
+    assert question_key("Qual é o estádio do Farense?") == question_key("Qual e o estadio do Farense")
+    assert question_key("Quem foi Hassan Nader?") != question_key("Quem foi Paco Fortes?")
+
+
+def test_answers_are_separated_by_adapter(tmp_path):
+    store = AnswerStore(tmp_path / "store.sqlite")
+    store.put_many("adaptador_a", [("Quem foi Hassan Nader?", "Um avançado marroquino.")])
+    assert store.lookup("quem foi hassan nader", "adaptador_a") == "Um avançado marroquino."
+    assert store.lookup("Quem foi Hassan Nader?", "adaptador_b") is None
+    assert store.keys("adaptador_a") == {question_key("Quem foi Hassan Nader?")}
+    assert store.prune("adaptador_b") == 1
+    assert store.stats() == {}
+
+
+def test_read_questions_deduplicates(tmp_path):
+    train, valid = tmp_path / "train.jsonl", tmp_path / "valid.jsonl"
+    train.write_text(json.dumps({"prompt": "Quem foi Hassan Nader?", "completion": "a"}) + "\n")
+    valid.write_text(json.dumps({"prompt": " quem foi hassan nader ", "completion": "b"}) + "\n\n")
+    bank = read_questions([train, valid, tmp_path / "em_falta.jsonl"])
+    assert bank == {question_key("Quem foi Hassan Nader?"): "Quem foi Hassan Nader?"}
+
+
+def test_retrained_adapter_gets_a_new_key(tmp_path, adapter, monkeypatch):
+    monkeypatch.setattr(answer_store, "_store", None)
+    store_file = tmp_path / "store.sqlite"
+    key = partition_key("base", adapter)
+    AnswerStore(store_file).put_many(key, [("Quem foi Hassan Nader?", "Um avançado.")])
+    assert answer_store.answer("Quem foi Hassan Nader?", "base", adapter, store_file) == "Um avançado."
+
+    (adapter / "adapters.safetensors").write_bytes(b"pesos v2, re-treinado")
+    assert partition_key("base", adapter) != key
+    assert answer_store.answer("Quem foi Hassan Nader?", "base", adapter, store_file) is None
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Testes das sequências de paragem e do prompt lookup (generation.py)
+"""
+
+import sys
+from pathlib import Path
+
+import mlx.core as mx
+import pytest
+from mlx_lm.generate import generate_step
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from benchmark_training import build_tiny_model
+from generation import NgramIndex, StopMatcher, cut_at_stop, prompt_lookup_generate_step
+
+TINY_CONFIG = {
+    "hidden_size": 64,
+    "num_hidden_layers": 2,
+    "intermediate_size": 128,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "vocab_size": 64,
+}
+
+
+def test_stop_sequence_split_across_segments():
+    matcher = StopMatcher(["### Pergunta"])
+    emitted = [matcher.feed(segment) for segment in ["O Farense venceu ###", " Perg", "unta:\nE depois?"]]
+    assert emitted == ["O Farense venceu ", "", ""]
+    assert matcher.stopped
+
+
+def test_partial_stop_prefix_is_released():
+    matcher = StopMatcher(["### Pergunta"])
+    assert matcher.feed("Golos: 2 #") == "Golos: 2 "
+    assert matcher.feed("## Resposta") == "### Resposta"
+    assert matcher.feed(" final ##") == " final "
+    assert matcher.flush() == "##"
+    assert not matcher.stopped
+
+
+def test_cut_at_stop():
+    assert cut_at_stop("2-1 em casa\n\n### Pergunta:\nE depois?") == "2-1 em casa\n\n"
+    assert cut_at_stop("sem paragem") == "sem paragem"
+
+
+def test_ngram_index_proposes_the_longest_match():
+    index = NgramIndex([1, 2, 3, 4, 9, 2, 3, 7, 1, 2, 3], ngram_size=3)
+    # O sufixo (1, 2, 3) foi seguido de 4; o (2, 3) mais recente, de 7
+    assert index.propose(2) == [4, 9]
+    index.extend([8])
+    assert index.propose(3) == []
+    index.extend([5, 8])
+    assert index.propose(2) == [5, 8]
+
+
+def test_prompt_lookup_matches_greedy():
+    mx.random.seed(0)
+    model = build_tiny_model(TINY_CONFIG, quantize=False)
+    model.eval()
+    prompt = mx.array([5, 6, 7, 8, 9, 10] * 4 + [5, 6])
+    max_tokens = 24
+
+    reference = [token for token, _ in generate_step(prompt, model, max_tokens=max_tokens)]
+    stats = {}
+    lookup = [token for token, _, _ in prompt_lookup_generate_step(prompt, model, max_tokens=max_tokens,
+                                                                   stats=stats)][:max_tokens]
+
+    assert stats["drafted"] > 0
+    assert lookup == [int(t) for t in reference]
+
+
+@pytest.mark.parametrize("num_draft_tokens", [1, 4])
+def test_prompt_lookup_respects_max_tokens(num_draft_tokens):
+    mx.random.seed(1)
+    model = build_tiny_model(TINY_CONFIG, quantize=False)
+    model.eval()
+    steps = prompt_lookup_generate_step(mx.array([3, 4, 5, 3, 4, 5, 3, 4]), model,
+                                        num_draft_tokens=num_draft_tokens, max_tokens=10)
+    assert len(list(steps)) == 10
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Testes do router de consultas de jogos (match_query.py) sobre o CSV de resultados
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import match_query
+
+
+@pytest.fixture(scope="module")
+def index():
+    return match_query.get_index()
+
+
+@pytest.mark.parametrize("question", [
+    "Qual o total de sócios do Farense em 2020?",
+    "Quem marcou os golos do Farense contra o Portimonense?",
+    "Porque é que o Farense perdeu tantas vezes contra o Benfica?",
+    "Em que ano o Farense ganhou a Taça?",
+    "O Farense ganhou a Taça de Portugal?",
+    "Quantas vezes o Farense perdeu na Taça?",
+    "Qual a história do Farense contra o Benfica?",
+    "resultado Farense 2-1 em 1983",
+    "Quando foi fundado o Farense?",
+])
+def test_open_questions_go_to_the_model(index, question):
+    assert match_query.parse_question(question, index)[0] is None
+    assert match_query.answer(question, index) is None
+
+
+def test_lookup_by_date_and_opponent(index):
+    response = match_query.answer("Resultado do Farense contra o Olhanense em 1914-10-04", index)
+    assert response == "1914-10-04 (Jogos Pioneiros 1913-1916, -): Farense 0-3 Sporting Clube Olhanense"
+
+
+def test_summary_needs_a_record_word(index):
+    intent, filters = match_query.parse_question("Balanço do Farense contra o Benfica", index)
+    assert intent == "summary"
+    assert filters["opponents"] == ["Benfica"]
+
+
+def test_score_filters_both_directions(index):
+    rows = index.query(opponents=["Benfica"], score=(1, 2))
+    assert rows
+    assert all({r["golos_farense"], r["golos_adversario"]} == {1, 2} for r in rows)
+    assert match_query.parse_score("em 1914-10-04") is None
+
+
+def test_competition_aliases_share_a_family(index):
+    assert match_query.competition_family("Taça de Portugal 1963/1964") == "taca portugal"
+    assert match_query.competition_family("Taça Portugal 24/25") == "taca portugal"
+    assert match_query.competition_family("LP Betclic 2024/25") == "primeira liga"
+    assert index.find_competition("jogos na Taça de Portugal") == "taca portugal"
+    cup = index.query(competition="taca portugal")
+    assert len(cup) == len(index.by_competition["taca portugal"])
+    assert {r["epoca"] for r in cup} >= {"1938/39", "2024/25"}
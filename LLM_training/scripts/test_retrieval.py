@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Testes do chunker e da reindexação incremental (retrieval.py)
+"""
+
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from retrieval import CHUNK_OVERLAP, CHUNK_WORDS, RetrievalIndex, chunk_markdown, pack
+
+SOURCES = ["*.md", "*.txt"]
+
+
+def test_pack_merges_short_blocks():
+    chunks = pack(["um dois três", "quatro cinco"], heading="Título")
+    assert chunks == [{"heading": "Título", "text": "um dois três\nquatro cinco"}]
+
+
+def test_pack_splits_long_blocks_with_overlap():
+    words = [f"p{i}" for i in range(CHUNK_WORDS * 2)]
+    chunks = pack([" ".join(words)])
+    step = CHUNK_WORDS - CHUNK_OVERLAP
+    assert all(len(chunk["text"].split()) <= CHUNK_WORDS for chunk in chunks)
+    assert chunks[1]["text"].split()[0] == words[step]
+    assert chunks[-1]["text"].split()[-1] == words[-1]
+
+
+def test_chunk_markdown_keeps_the_headings():
+    text = "# Farense\nIntrodução.\n\n## Fundação\nFundado em 1910.\n\n## Estádio\nSão Luís."
+    chunks = chunk_markdown(text, "farense")
+    assert [c["heading"] for c in chunks] == ["Farense", "Farense > Fundação", "Farense > Estádio"]
+    assert chunks[1]["text"] == "Fundado em 1910."
+
+
+def test_incremental_update(tmp_path):
+    root, index_dir = tmp_path / "dados", tmp_path / "index"
+    root.mkdir()
+    (root / "hassan.md").write_text("# Hassan Nader\nAvançado marroquino, melhor marcador do Farense.")
+    (root / "estadio.txt").write_text("O Estádio de São Luís fica em Faro.")
+
+    index = RetrievalIndex(index_dir, root, SOURCES)
+    assert index.update() == {"added": 2, "updated": 0, "removed": 0, "unchanged": 0}
+    assert index.search("Hassan Nader marcador", top_k=1)[0]["source"] == "hassan.md"
+
+    index_file = index_dir / "index.json"
+    saved_at = index_file.stat().st_mtime_ns
+    assert RetrievalIndex(index_dir, root, SOURCES).update()["unchanged"] == 2
+    assert index_file.stat().st_mtime_ns == saved_at
+
+    (root / "estadio.txt").write_text("O Estádio de São Luís, em Faro, foi inaugurado em 1923.")
+    os.remove(root / "hassan.md")
+    index = RetrievalIndex(index_dir, root, SOURCES)
+    assert index.update() == {"added": 0, "updated": 1, "removed": 1, "unchanged": 0}
+    assert index.search("Hassan Nader") == []
+    assert "1923" in index.search("inaugurado estádio")[0]["text"]
+    assert [c["id"] for c in RetrievalIndex(index_dir, root, SOURCES).chunks] == [c["id"] for c in index.chunks]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Testes da preparação dos batches e da máscara da perda (train_qlora.py)
+"""
+
+import sys
+from pathlib import Path
+
+import mlx.core as mx
+import mlx.nn as nn
+import pytest
+from mlx.utils import tree_map
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import train_qlora
+from benchmark_training import ByteTokenizer, build_tiny_model
+from train_qlora import PAD_MULTIPLE, build_batch, create_eval_fn, loss_fn, tokenize
+
+TINY_CONFIG = {
+    "hidden_size": 64,
+    "num_hidden_layers": 2,
+    "intermediate_size": 128,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "vocab_size": 300,
+}
+
+
+@pytest.fixture(scope="module")
+def model():
+    mx.random.seed(0)
+    model = build_tiny_model(TINY_CONFIG, quantize=False)
+    model.eval()  # Sem dropout LoRA: perdas determinísticas
+    return model
+
+
+def test_tokenize_marks_the_completion():
+    sample = {"prompt": "Quem fundou o Farense?", "completion": "Um grupo de estudantes."}
+    tokens, prompt_len = tokenize(sample, ByteTokenizer(), max_seq_length=512)
+    assert tokens[prompt_len:] == [3 + b for b in sample["completion"].encode("utf-8")]
+    assert tokens[:prompt_len] == ByteTokenizer().encode(train_qlora.format_prompt({**sample, "completion": ""}))
+
+
+def test_tokenize_truncated_prompt_has_no_supervised_tokens():
+    # Amostras assim (len(tokens) == prompt_len) são descartadas antes do treino
+    sample = {"prompt": "x" * 100, "completion": "resposta"}
+    tokens, prompt_len = tokenize(sample, ByteTokenizer(), max_seq_length=20)
+    assert len(tokens) == prompt_len == 20
+
+
+def test_build_batch_supervises_only_the_completion():
+    samples = [(list(range(10, 20)), 4), (list(range(30, 37)), 6)]
+    inputs, targets, positions, lengths = build_batch(samples)
+
+    assert inputs.shape == (2, PAD_MULTIPLE)
+    assert targets.shape == positions.shape == (2, PAD_MULTIPLE)
+    assert lengths.tolist() == [6, 1]
+    for row, (tokens, prompt_len) in enumerate(samples):
+        n = lengths[row].item()
+        assert inputs[row, :len(tokens) - 1].tolist() == tokens[:-1]
+        assert targets[row, :n].tolist() == tokens[prompt_len:]
+        # O estado oculto na posição p prevê o token p + 1
+        assert positions[row, :n].tolist() == list(range(prompt_len - 1, len(tokens) - 1))
+
+
+def test_loss_ignores_prompt_and_padding(model):
+    samples = [([5, 6, 7, 8, 9, 10, 11, 12], 3), ([20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31], 9)]
+    loss, ntoks = loss_fn(model, *build_batch(samples))
+
+    # Referência: forward completo de cada amostra sem padding, perda só nos tokens da resposta
+    total = 0.0
+    for tokens, prompt_len in samples:
+        logits = model(mx.array(tokens[:-1])[None])[0, prompt_len - 1:]
+        total += nn.losses.cross_entropy(logits, mx.array(tokens[prompt_len:]), reduction='sum').item()
+    expected_tokens = sum(len(t) - p for t, p in samples)
+
+    assert ntoks.item() == expected_tokens
+    assert loss.item() == pytest.approx(total / expected_tokens, rel=1e-4)
+
+
+def test_eval_fn_runs_without_dropout():
+    mx.random.seed(1)
+    model = build_tiny_model(TINY_CONFIG, quantize=False)
+    # lora_b começa a zero: com pesos aleatórios o dropout LoRA muda a perda
+    model.update(tree_map(lambda p: 0.1 * mx.random.normal(p.shape), model.trainable_parameters()))
+    batch = build_batch([(list(range(5, 40)), 10)])
+
+    eval_fn = create_eval_fn(model)
+    losses = [eval_fn(*batch)[0].item() for _ in range(3)]
+    assert model.training
+    model.eval()
+    assert losses == [pytest.approx(loss_fn(model, *batch)[0].item(), rel=1e-5)] * 3
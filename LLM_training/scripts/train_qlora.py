@@ -4,19 +4,28 @@ import re
 import os
 import shutil
 import random
+from functools import partial
 from pathlib import Path
 import mlx.core as mx
 import mlx.nn as nn
 from mlx.optimizers import AdamW
+from mlx.utils import tree_map
 from mlx_lm import load
 
 from tqdm import tqdm
 import math
 import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
 import psutil
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from prompt_format import format_sample as format_prompt
+from step_profiler import StepProfiler
+from trunk_cache import adapted_trunk_forward, build_trunk_cache, num_frozen_layers
+
 # --- Configurações --- #
 
 # Caminhos
@@ -24,6 +33,7 @@ BASE_DIR = Path(__file__).parent.parent
 DATA_DIR = BASE_DIR / "data"
 CHECKPOINTS_DIR = BASE_DIR / "checkpoints_qlora"
 OUTPUT_DIR = BASE_DIR / "output"
+TRUNK_CACHE_DIR = CHECKPOINTS_DIR / "trunk_cache"
 
 # Certificar que os diretórios existem
 CHECKPOINTS_DIR.mkdir(parents=True, exist_ok=True)
@@ -45,7 +55,9 @@ qlora_config = {
         "rank": 6,              # LoRA decomposition rank (reduzido de 8 para 6 - menos parâmetros = menos overfitting)
         "scale": 16,            # LoRA scaling factor (lora_alpha)
         "dropout": 0.08,        # Dropout rate for LoRA layers (aumentado de 0.0 para 0.08 - reduz overfitting)
-        "keys": ["q_proj", "v_proj", "k_proj", "o_proj", "gate_proj", "up_proj", "down_proj"], # Módulos alvo
+        # Módulos alvo (caminhos relativos a cada bloco do transformador, como o linear_to_lora_layers espera)
+        "keys": ["self_attn.q_proj", "self_attn.v_proj", "self_attn.k_proj", "self_attn.o_proj",
+                 "mlp.gate_proj", "mlp.up_proj", "mlp.down_proj"],
     },
     "bias": "none",
 }
@@ -62,14 +74,21 @@ training_config = {
     "log_steps": 10,              # Registar métricas a cada N passos
     "early_stopping_patience": 5, # Parar após 5 validações sem melhoria
     "early_stopping_min_delta": 0.001, # Melhoria mínima de 0.1%
+    "eval_batch_size": 8,         # Batch da validação (sem gradientes, cabe um batch maior que o de treino)
+    "val_subsample": 64,          # Subamostra estratificada fixa para as avaliações a cada eval_steps (None = sempre completa)
+    "cache_frozen_trunk": False,  # Calcular as camadas congeladas uma vez por amostra e guardar em disco (memmap)
+    "grad_checkpoint": "none",    # Recalcular ativações no backward: "none", "all", N (1 em cada N blocos LoRA) ou lista de índices
+    "timing_window": 100,         # Janela (em passos) dos percentis de tempo por fase
+    "detailed_step_timing": False, # Separar forward/backward e otimizador (custa uma sincronização extra por passo)
+    "profile_steps": None,        # [N, k]: capturar um perfil dos passos globais N..N+k-1 (ver step_profiler.py)
     "lora_parameters_path": CHECKPOINTS_DIR / "adapters.safetensors",
     "model_path": OUTPUT_DIR / "mistral-7b-farense-qlora",
 }
 
-# --- Funções de Utilidade --- #
+# Múltiplo para o padding dinâmico dos batches (limita recompilações do mx.compile)
+PAD_MULTIPLE = 32
 
-def format_prompt(sample):
-    return f"### Pergunta:\n{sample['prompt']}\n\n### Resposta:\n{sample['completion']}"
+# --- Funções de Utilidade --- #
 
 def load_dataset(file_path):
     data = []
@@ -79,20 +98,160 @@ def load_dataset(file_path):
     return data
 
 def tokenize(sample, tokenizer, max_seq_length):
+    """
+    Tokeniza uma amostra e devolve (tokens, prompt_len).
+
+    prompt_len marca a fronteira prompt/completion: apenas os tokens a partir
+    desta posição (a resposta) são supervisionados. O padding é feito por batch
+    em build_batch, não aqui.
+    """
     prompt_text = format_prompt(sample)
-    # Adicionar padding e truncation para garantir comprimento uniforme
-    return tokenizer.encode(prompt_text, max_length=max_seq_length, padding="max_length", truncation=True)
+    prompt_prefix = format_prompt({"prompt": sample["prompt"], "completion": ""})
+    tokens = tokenizer.encode(prompt_text)[:max_seq_length]
+    prompt_len = min(max(len(tokenizer.encode(prompt_prefix)), 1), len(tokens))
+    return tokens, prompt_len
+
+def _round_up(n, multiple=PAD_MULTIPLE):
+    return ((n + multiple - 1) // multiple) * multiple
+
+def build_batch(batch_tokens):
+    """
+    Cria os tensores de um batch a partir de pares (tokens, prompt_len).
+
+    Returns:
+        inputs: tokens de entrada (B, L), com padding
+        targets: próximo token em cada posição supervisionada (B, S)
+        positions: índices em `inputs` das posições supervisionadas (B, S)
+        lengths: número de posições supervisionadas válidas por amostra (B,)
+
+    L e S são arredondados a PAD_MULTIPLE para limitar o número de formas
+    distintas que o mx.compile tem de traçar.
+    """
+    max_len = _round_up(max(len(t) - 1 for t, _ in batch_tokens))
+    max_sup = _round_up(max(len(t) - p for t, p in batch_tokens))
+
+    inputs, targets, positions, lengths = [], [], [], []
+    for tokens, prompt_len in batch_tokens:
+        n = len(tokens) - 1
+        # O estado oculto na posição p prevê o token p + 1
+        sup_positions = list(range(prompt_len - 1, n))
+        sup_pad = max_sup - len(sup_positions)
+        inputs.append(tokens[:-1] + [0] * (max_len - n))
+        targets.append(tokens[prompt_len:] + [0] * sup_pad)
+        positions.append(sup_positions + [0] * sup_pad)
+        lengths.append(len(sup_positions))
+
+    return mx.array(inputs), mx.array(targets), mx.array(positions), mx.array(lengths)
+
+def load_batch(token_samples, indices, trunk_cache=None):
+    """build_batch para as amostras `indices`; com cache, os tokens de entrada são
+    substituídos pelas ativações guardadas do tronco congelado"""
+    inputs, targets, positions, lengths = build_batch([token_samples[k] for k in indices])
+    if trunk_cache is not None:
+        inputs = trunk_cache.hidden_batch(indices, inputs.shape[1])
+    return inputs, targets, positions, lengths
 
 def calculate_memory_usage():
     process = psutil.Process(os.getpid())
     mem_info = process.memory_info()
     return mem_info.rss / (1024 ** 2)  # Memória em MB
 
+# --- Classe PhaseTimer --- #
+
+class PhaseTimer:
+    """
+    Tempos de parede por fase do passo de treino e débito (tokens/amostras por segundo).
+
+    Mantém uma janela deslizante por fase para os percentis e totais acumulados
+    para o sumário final. Como o MLX é lazy, o trabalho de computação aparece na
+    fase em que é feito o mx.eval ("eval_sync"); "step_dispatch" mede apenas a
+    construção do grafo do passo compilado.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, window=100):
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.counts = {}
+        self.throughput = deque(maxlen=window)  # (tokens reais, amostras, segundos) por passo
+        self.total_tokens = 0
+        self.total_samples = 0
+        self.total_step_time = 0.0
+        self.listener = None  # callback(fase, segundos) usado pelo StepProfiler durante uma captura
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+            self.totals[name] = 0.0
+            self.counts[name] = 0
+        self.samples[name].append(seconds)
+        self.totals[name] += seconds
+        self.counts[name] += 1
+        if self.listener is not None:
+            self.listener(name, seconds)
+
+    def record_step(self, real_tokens, num_samples, seconds):
+        self.throughput.append((real_tokens, num_samples, seconds))
+        self.total_tokens += real_tokens
+        self.total_samples += num_samples
+        self.total_step_time += seconds
+
+    def _rates(self, entries):
+        tokens = sum(e[0] for e in entries)
+        samples = sum(e[1] for e in entries)
+        seconds = sum(e[2] for e in entries)
+        if seconds <= 0:
+            return 0.0, 0.0
+        return tokens / seconds, samples / seconds
+
+    def snapshot(self):
+        """Métricas planas (ms por fase na janela atual) para o registo de métricas"""
+        metrics = {}
+        for name, values in self.samples.items():
+            for p, value in zip(self.PERCENTILES, np.percentile(values, self.PERCENTILES)):
+                metrics[f"time_{name}_p{p}_ms"] = float(value) * 1000
+        tokens_per_sec, samples_per_sec = self._rates(self.throughput)
+        metrics["tokens_per_sec"] = tokens_per_sec
+        metrics["samples_per_sec"] = samples_per_sec
+        return metrics
+
+    def summary(self):
+        """Sumário acumulado para training_summary.json"""
+        phases = {}
+        for name, values in self.samples.items():
+            percentiles = np.percentile(values, self.PERCENTILES)
+            phases[name] = {
+                "count": self.counts[name],
+                "total_sec": self.totals[name],
+                "mean_ms": self.totals[name] / self.counts[name] * 1000,
+                **{f"p{p}_ms": float(v) * 1000 for p, v in zip(self.PERCENTILES, percentiles)},
+            }
+        tokens_per_sec = self.total_tokens / self.total_step_time if self.total_step_time > 0 else 0.0
+        samples_per_sec = self.total_samples / self.total_step_time if self.total_step_time > 0 else 0.0
+        return {
+            "phases": phases,
+            "total_real_tokens": self.total_tokens,
+            "total_samples": self.total_samples,
+            "tokens_per_sec": tokens_per_sec,
+            "samples_per_sec": samples_per_sec,
+        }
+
 # --- Classe MetricsTracker --- #
 
 class MetricsTracker:
-    def __init__(self, checkpoint_dir):
+    def __init__(self, checkpoint_dir, is_main=True):
         self.checkpoint_dir = Path(checkpoint_dir)
+        self.is_main = is_main  # Em treino distribuído só o rank 0 escreve métricas e checkpoints
         self.metrics_file_csv = self.checkpoint_dir / "training_metrics.csv"
         self.metrics_file_json = self.checkpoint_dir / "training_metrics.json"
         self.summary_file = self.checkpoint_dir / "training_summary.json"
@@ -128,6 +287,8 @@ class MetricsTracker:
                 print("Erro ao ler training_metrics.json, a iniciar novo registo de métricas.")
 
     def _save_state(self):
+        if not self.is_main:
+            return
         state = {
             'current_epoch': self.current_epoch,
             'current_step': self.current_step,
@@ -137,7 +298,8 @@ class MetricsTracker:
         with open(self.training_state_file, 'w', encoding='utf-8') as f:
             json.dump(state, f, indent=4, ensure_ascii=False)
 
-    def log_step(self, epoch, step, loss, val_loss=None, memory_mb=None, learning_rate=None):
+    def log_step(self, epoch, step, loss, val_loss=None, memory_mb=None, learning_rate=None, timing=None,
+                 val_subsample_loss=None):
         current_time = time.time()
         elapsed_time = current_time - self.start_time
         
@@ -152,8 +314,16 @@ class MetricsTracker:
         }
         if val_loss is not None:
             metric["val_loss"] = val_loss.item() if hasattr(val_loss, 'item') else val_loss
+        if val_subsample_loss is not None:
+            metric["val_loss_subsample"] = val_subsample_loss
+        if timing:
+            metric.update(timing)
 
         self.metrics_data.append(metric)
+        self.current_epoch = epoch
+        self.current_step = step
+        if not self.is_main:
+            return
         
         # Guardar incrementalmente para evitar perda de dados
         with open(self.metrics_file_json, 'w', encoding='utf-8') as f:
@@ -161,15 +331,14 @@ class MetricsTracker:
 
         # Atualizar CSV
         pd.DataFrame(self.metrics_data).to_csv(self.metrics_file_csv, index=False)
-
-        self.current_epoch = epoch
-        self.current_step = step
         self._save_state()
 
     def save_best_model(self, model, val_loss):
         if val_loss < self.best_val_loss:
             self.best_val_loss = val_loss
             self._save_state()
+            if not self.is_main:
+                return
             
             adapters_dir = self.checkpoint_dir / "adapters"
             adapters_dir.mkdir(parents=True, exist_ok=True)
@@ -178,7 +347,7 @@ class MetricsTracker:
             model.save_weights(str(self.best_model_path))
             print(f"✓ Melhor modelo guardado com Val Loss: {self.best_val_loss:.4f}")
 
-    def save_summary(self, total_time, total_samples):
+    def save_summary(self, total_time, total_samples, performance=None):
         summary = {
             "total_training_time_sec": total_time,
             "total_samples_processed": total_samples,
@@ -189,8 +358,10 @@ class MetricsTracker:
             "qlora_config": qlora_config,
             "model_name": model_name
         }
+        if performance is not None:
+            summary["performance"] = performance
         with open(self.summary_file, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, indent=4, ensure_ascii=False)
+            json.dump(summary, f, indent=4, ensure_ascii=False, default=str)
 
 # --- Classe EarlyStoppingMonitor --- #
 
@@ -265,28 +436,54 @@ class EarlyStoppingMonitor:
 
 # --- Funções de Treino --- #
 
-def loss_fn(model, inputs, targets, lengths):
-    # Máscara para ignorar tokens de preenchimento e prompt
-    mask = mx.arange(inputs.shape[1])[None, :] < lengths[:, None]
+def output_head(model, hidden):
+    """Aplica a projeção de saída do modelo (lm_head ou embeddings partilhados)"""
+    if getattr(model.args, "tie_word_embeddings", False):
+        return model.model.embed_tokens.as_linear(hidden)
+    return model.lm_head(hidden)
+
+def trunk_forward(model, inputs):
+    """Tronco do transformador; aceita tokens (B, L) ou ativações do tronco congelado em cache (B, L, D)"""
+    if inputs.ndim == 3:
+        num_frozen = num_frozen_layers(model, qlora_config["num_layers"])
+        return adapted_trunk_forward(model, inputs.astype(model.model.norm.weight.dtype), num_frozen)
+    return model.model(inputs)
 
-    # Forward pass
-    logits = model(inputs)
+def loss_fn(model, inputs, targets, positions, lengths):
+    # Máscara para ignorar as posições de preenchimento (padding) do batch supervisionado
+    mask = mx.arange(targets.shape[1])[None, :] < lengths[:, None]
+
+    # Forward pass apenas pelo tronco do transformador (sem a projeção de saída)
+    hidden = trunk_forward(model, inputs)
+
+    # Recolher os estados ocultos das posições da resposta (completion) antes do lm_head,
+    # para que a projeção para o vocabulário não corra sobre o prompt e o padding
+    hidden = mx.take_along_axis(hidden, positions[..., None], axis=1)
+    logits = output_head(model, hidden)
 
-    # Calcular a perda apenas para os tokens de resposta (completion)
-    # Assumimos que o prompt já está mascarado ou que a perda é calculada apenas na completion
-    # Para LoRA, a máscara é aplicada na função de perda para ignorar o padding e o prompt
     loss = nn.losses.cross_entropy(logits, targets, reduction='none')
-    loss = mx.sum(loss * mask) / mx.sum(mask)
-    return loss, logits
+    ntoks = mx.sum(mask)
+    loss = mx.sum(loss * mask) / ntoks
+    return loss, ntoks
 
 def create_step_fn(model, optimizer):
     # Criar a função que calcula a perda e os gradientes
     grad_fn = nn.value_and_grad(model, loss_fn)
+    world_size = mx.distributed.init().size()
+
+    # O estado do modelo, do otimizador e do gerador aleatório (dropout) tem de ser
+    # declarado como entrada/saída do mx.compile para que as atualizações persistam
+    state = [model.state, optimizer.state, mx.random.state]
 
-    @mx.compile
-    def step_fn(inputs, targets, lengths):
+    @partial(mx.compile, inputs=state, outputs=state)
+    def step_fn(inputs, targets, positions, lengths):
         # Calcular a perda e os gradientes
-        (loss, logits), grads = grad_fn(model, inputs, targets, lengths)
+        (loss, ntoks), grads = grad_fn(model, inputs, targets, positions, lengths)
+
+        # Treino distribuído: média dos gradientes (só os adaptadores LoRA são treináveis) entre ranks
+        if world_size > 1:
+            grads = nn.average_gradients(grads)
+            loss = mx.distributed.all_sum(loss) / world_size
         
         # Atualizar o modelo usando o otimizador com os gradientes calculados
         optimizer.update(model, grads)
@@ -294,29 +491,186 @@ def create_step_fn(model, optimizer):
         return loss
     return step_fn
 
-def create_eval_fn(model):
-    @mx.compile
-    def eval_fn(inputs, targets, lengths):
-        loss, _ = loss_fn(model, inputs, targets, lengths)
-        return loss
-    return eval_fn
+def create_split_step_fns(model, optimizer):
+    """
+    Variante do passo de treino em duas funções compiladas (gradientes e atualização),
+    para medir separadamente forward/backward e otimizador.
+    """
+    grad_fn = nn.value_and_grad(model, loss_fn)
+    world_size = mx.distributed.init().size()
 
-# --- Main Training Loop --- #
+    @partial(mx.compile, inputs=[model.state, mx.random.state], outputs=[model.state, mx.random.state])
+    def grad_step(inputs, targets, positions, lengths):
+        (loss, ntoks), grads = grad_fn(model, inputs, targets, positions, lengths)
+        if world_size > 1:
+            grads = nn.average_gradients(grads)
+            loss = mx.distributed.all_sum(loss) / world_size
+        return loss, grads
 
-def train(custom_training_config=None, custom_qlora_config=None):
-    print("\n--- A iniciar o processo de treino --- ")
-    
-    # Update configs if provided
-    if custom_qlora_config:
-        qlora_config.update(custom_qlora_config)
-    if custom_training_config:
-        training_config.update(custom_training_config)
+    state = [model.state, optimizer.state]
 
-    print(f"A carregar modelo: {model_name} com QLoRA")
-    print(f"Configuração QLoRA: {qlora_config}")
-    print(f"Configuração de Treino: {training_config}")
+    @partial(mx.compile, inputs=state, outputs=state)
+    def update_step(grads):
+        optimizer.update(model, grads)
 
-    # 1. Carregar Modelo e Tokenizer
+    return grad_step, update_step
+
+def eval_mode(model, fn):
+    """
+    Corre fn com o modelo em modo de avaliação (dropout LoRA desligado) e volta ao modo de
+    treino. Uma função compilada fixa o modo no traçado, por isso fn só é chamada assim.
+    """
+    def wrapped(*args):
+        model.eval()
+        try:
+            return fn(*args)
+        finally:
+            model.train()
+    return wrapped
+
+def create_eval_fn(model):
+    @partial(mx.compile, inputs=model.state)
+    def eval_fn(inputs, targets, positions, lengths):
+        return loss_fn(model, inputs, targets, positions, lengths)
+    return eval_mode(model, eval_fn)
+
+def broadcast_from_main(tree, group):
+    """Copia para todos os ranks os valores do rank 0 (all_sum com zeros nos restantes)"""
+    if group.size() == 1:
+        return tree
+    is_main = group.rank() == 0
+    return tree_map(lambda x: mx.distributed.all_sum(x if is_main else mx.zeros_like(x), group=group), tree)
+
+def barrier(group):
+    """Espera que todos os ranks cheguem a este ponto"""
+    if group.size() > 1:
+        mx.eval(mx.distributed.all_sum(mx.array(1), group=group))
+
+def stratified_subsample(token_samples, size, seed=0):
+    """
+    Subamostra fixa estratificada pelo comprimento das amostras: ordena por número de
+    tokens, divide em `size` estratos iguais e escolhe uma amostra de cada um.
+    """
+    if not size or size >= len(token_samples):
+        return None
+    by_length = sorted(range(len(token_samples)), key=lambda k: len(token_samples[k][0]))
+    rng = random.Random(seed)
+    bounds = np.linspace(0, len(by_length), size + 1).astype(int)
+    return [by_length[rng.randrange(lo, hi)] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+class Validator:
+    """
+    Validação com batches grandes e perda acumulada no dispositivo (uma única
+    sincronização por avaliação). Com val_subsample, as avaliações frequentes usam uma
+    subamostra estratificada fixa; a validação completa só corre quando a subamostra
+    melhora (ou no fim de cada época).
+    """
+
+    def __init__(self, eval_fn, val_tokens, val_cache=None, batch_size=8, subsample_size=None, min_delta=0.0,
+                 group=None):
+        self.eval_fn = eval_fn
+        # Em treino distribuído cada rank avalia uma fatia e as somas são reduzidas no fim
+        self.group = group or mx.distributed.init()
+        self.val_tokens = val_tokens
+        self.val_cache = val_cache
+        self.batch_size = batch_size
+        self.min_delta = min_delta
+        # Ordenar por comprimento reduz o padding dentro de cada batch
+        self.full_indices = sorted(range(len(val_tokens)), key=lambda k: len(val_tokens[k][0]))
+        subsample = stratified_subsample(val_tokens, subsample_size)
+        self.subsample_indices = sorted(subsample, key=lambda k: len(val_tokens[k][0])) if subsample else None
+        self.best_subsample_loss = float('inf')
+
+    @property
+    def subsampled(self):
+        return self.subsample_indices is not None
+
+    def loss(self, indices):
+        """Perda média por token sobre `indices`; só sincroniza no fim"""
+        indices = indices[self.group.rank()::self.group.size()]
+        total_loss = mx.array(0.0)
+        total_tokens = mx.array(0)
+        for start in range(0, len(indices), self.batch_size):
+            batch = load_batch(self.val_tokens, indices[start:start + self.batch_size], self.val_cache)
+            loss, ntoks = self.eval_fn(*batch)
+            total_loss = total_loss + loss * ntoks
+            total_tokens = total_tokens + ntoks
+            mx.async_eval(total_loss, total_tokens)
+        if self.group.size() > 1:
+            total_loss = mx.distributed.all_sum(total_loss, group=self.group)
+            total_tokens = mx.distributed.all_sum(total_tokens, group=self.group)
+        loss = total_loss / total_tokens
+        # Uma perda por adaptador quando eval_fn avalia vários adaptadores (multi_lora.py)
+        return loss.item() if loss.ndim == 0 else loss.tolist()
+
+    def full(self):
+        return self.loss(self.full_indices)
+
+    def check(self):
+        """
+        Avaliação periódica. Devolve (perda de referência, perda completa ou None):
+        a de referência é a da subamostra (ou a completa, sem subamostragem) e serve
+        para o early stopping; a completa só é calculada quando a subamostra melhora.
+        """
+        if not self.subsampled:
+            full_loss = self.full()
+            return full_loss, full_loss
+
+        subsample_loss = self.loss(self.subsample_indices)
+        if subsample_loss < self.best_subsample_loss - self.min_delta:
+            self.best_subsample_loss = subsample_loss
+            return subsample_loss, self.full()
+        return subsample_loss, None
+
+def _checkpointed_call(call):
+    """Envolve o __call__ de um bloco para recalcular as ativações no backward quando o bloco o pede"""
+    def checkpointed(self, x, *args, **kwargs):
+        if not getattr(self, "_grad_checkpoint", False):
+            return call(self, x, *args, **kwargs)
+
+        def inner(params, x):
+            self.update(params)
+            return call(self, x, *args, **kwargs)
+
+        return mx.checkpoint(inner)(self.trainable_parameters(), x)
+
+    checkpointed._is_checkpointed = True
+    return checkpointed
+
+def checkpoint_layer_indices(model, num_lora_layers, policy):
+    """
+    Traduz a política de gradient checkpointing para índices absolutos de blocos.
+
+    policy:
+        "none" / None / False: sem checkpointing
+        "all" / True: todos os blocos com LoRA
+        N (int): 1 em cada N blocos com LoRA, a começar pelo primeiro
+        lista de ints: índices absolutos dos blocos
+    """
+    first_lora = max(len(model.layers) - num_lora_layers, 0)
+    lora_indices = list(range(first_lora, len(model.layers)))
+    if policy in (None, False, "none"):
+        return []
+    if policy in (True, "all"):
+        return lora_indices
+    if isinstance(policy, int):
+        return lora_indices[::max(policy, 1)]
+    if isinstance(policy, (list, tuple)):
+        return sorted(i for i in policy if 0 <= i < len(model.layers))
+    raise ValueError(f"Política de grad_checkpoint inválida: {policy!r}")
+
+def apply_grad_checkpointing(model, num_lora_layers, policy):
+    """Ativa o gradient checkpointing nos blocos escolhidos pela política; devolve os índices"""
+    indices = checkpoint_layer_indices(model, num_lora_layers, policy)
+    for i, layer in enumerate(model.layers):
+        layer_cls = type(layer)
+        if indices and not getattr(layer_cls.__call__, "_is_checkpointed", False):
+            layer_cls.__call__ = _checkpointed_call(layer_cls.__call__)
+        layer._grad_checkpoint = i in indices
+    return indices
+
+def load_lora_model():
+    """Carrega o modelo base e aplica LoRA (e gradient checkpointing) segundo a configuração atual"""
     # NOTA: O modelo base deve ser pré-quantizado usando `python -m mlx_lm.convert`
     # e o `model_name` deve apontar para o diretório do modelo quantizado.
     model, tokenizer = load(model_name)
@@ -327,6 +681,9 @@ def train(custom_training_config=None, custom_qlora_config=None):
     # Criar uma configuração apenas com os parâmetros LoRA
     lora_only_config = {k: v for k, v in qlora_config.items() if k not in ["quantization", "group_size"]}
     
+    # Congelar o modelo base: apenas os pesos LoRA criados a seguir são treináveis
+    model.freeze()
+
     # Aplicar LoRA ao modelo carregado (modifica o modelo in-place)
     linear_to_lora_layers(
         model,
@@ -334,6 +691,36 @@ def train(custom_training_config=None, custom_qlora_config=None):
         lora_only_config["lora_parameters"],
     )
     
+    checkpointed = apply_grad_checkpointing(model, lora_only_config["num_layers"], training_config["grad_checkpoint"])
+    if checkpointed:
+        print(f"Gradient checkpointing ativo em {len(checkpointed)} blocos: {checkpointed}")
+
+    return model, tokenizer
+
+# --- Main Training Loop --- #
+
+def train(custom_training_config=None, custom_qlora_config=None):
+    print("\n--- A iniciar o processo de treino --- ")
+    
+    # Update configs if provided
+    if custom_qlora_config:
+        qlora_config.update(custom_qlora_config)
+    if custom_training_config:
+        training_config.update(custom_training_config)
+
+    print(f"A carregar modelo: {model_name} com QLoRA")
+    print(f"Configuração QLoRA: {qlora_config}")
+    print(f"Configuração de Treino: {training_config}")
+
+    # Treino distribuído (data-parallel): lançar com mlx.launch; sem ele o grupo tem tamanho 1
+    group = mx.distributed.init()
+    rank, world_size = group.rank(), group.size()
+    is_main = rank == 0
+    if world_size > 1:
+        print(f"Treino distribuído: rank {rank} de {world_size}")
+
+    # 1. Carregar Modelo e Tokenizer
+    model, tokenizer = load_lora_model()
     print("Modelo e tokenizer carregados e LoRA aplicado.")
 
     # 2. Carregar e Preparar Dados
@@ -350,9 +737,9 @@ def train(custom_training_config=None, custom_qlora_config=None):
     train_tokens = [tokenize(sample, tokenizer, training_config["max_seq_length"]) for sample in train_dataset]
     val_tokens = [tokenize(sample, tokenizer, training_config["max_seq_length"]) for sample in val_dataset]
 
-    # Filtrar amostras vazias após tokenização
-    train_tokens = [t for t in train_tokens if t]
-    val_tokens = [t for t in val_tokens if t]
+    # Filtrar amostras sem tokens de resposta após tokenização/truncagem
+    train_tokens = [(t, p) for t, p in train_tokens if len(t) > p]
+    val_tokens = [(t, p) for t, p in val_tokens if len(t) > p]
 
     if not train_tokens:
         raise ValueError("Nenhum dado de treino válido após tokenização. Verifique o dataset e max_seq_length.")
@@ -361,94 +748,147 @@ def train(custom_training_config=None, custom_qlora_config=None):
 
     # 3. Configurar Otimizador, Tracker e Early Stopping
     optimizer = AdamW(learning_rate=training_config["learning_rate"])
-    tracker = MetricsTracker(CHECKPOINTS_DIR)
+    tracker = MetricsTracker(CHECKPOINTS_DIR, is_main=is_main)
     early_stopping = EarlyStoppingMonitor(
         patience=training_config["early_stopping_patience"],
         min_delta=training_config["early_stopping_min_delta"]
     )
 
-    # Recuperar estado de treino se existir
+    # Recuperar estado de treino se existir (o do rank 0 vale para todos)
+    tracker.current_epoch, tracker.current_step = broadcast_from_main(
+        mx.array([tracker.current_epoch, tracker.current_step]), group
+    ).tolist()
     start_epoch = tracker.current_epoch
     start_step = tracker.current_step
 
     # Carregar adaptadores se existirem para continuar o treino
-    if tracker.best_model_path.exists():
+    if is_main and tracker.best_model_path.exists():
         print(f"A carregar adaptadores de: {tracker.best_model_path}")
         model.load_weights(str(tracker.best_model_path))
         print("Adaptadores carregados. A retomar treino.")
-    else:
+    elif is_main:
         print("Nenhum adaptador encontrado, a iniciar treino do zero.")
+    # Todos os ranks partem dos mesmos adaptadores (inicialização aleatória ou retoma do rank 0)
+    model.update(broadcast_from_main(model.trainable_parameters(), group))
+
+    # Cache opcional das ativações das camadas congeladas (sem LoRA)
+    train_cache = val_cache = None
+    if training_config["cache_frozen_trunk"]:
+        num_frozen = num_frozen_layers(model, qlora_config["num_layers"])
+        cache_dir = TRUNK_CACHE_DIR / f"rank{rank}" if world_size > 1 else TRUNK_CACHE_DIR
+        train_cache = build_trunk_cache(cache_dir, model, model_name, num_frozen, train_tokens, build_batch)
+        if val_tokens:
+            val_cache = build_trunk_cache(cache_dir, model, model_name, num_frozen, val_tokens, build_batch)
 
     # Compilar funções de treino e avaliação
     train_step_fn = create_step_fn(model, optimizer)
     eval_fn = create_eval_fn(model)
+    validator = Validator(
+        eval_fn, val_tokens, val_cache,
+        batch_size=training_config["eval_batch_size"],
+        subsample_size=training_config["val_subsample"],
+        min_delta=training_config["early_stopping_min_delta"],
+        group=group,
+    )
+    if validator.subsampled:
+        print(f"Validação periódica com subamostra estratificada de {len(validator.subsample_indices)} "
+              f"de {len(val_tokens)} amostras (completa quando melhora e no fim de cada época)")
+    if training_config["detailed_step_timing"]:
+        grad_step_fn, update_step_fn = create_split_step_fns(model, optimizer)
+
+    # Instrumentação do passo de treino (tempos por fase e débito) e perfis a pedido
+    timer = PhaseTimer(window=training_config["timing_window"])
+    profiler = StepProfiler(CHECKPOINTS_DIR, training_config["profile_steps"] if is_main else None)
+    # Cada rank treina uma fatia de cada época; um passo consome batch_size amostras por rank
+    steps_per_epoch = len(train_tokens) // (training_config["batch_size"] * world_size)
+    # Semente comum para que todos os ranks baralhem os dados da mesma forma
+    shuffle_rng = random.Random(broadcast_from_main(mx.array(random.randrange(2 ** 31)), group).item())
 
     # 4. Loop de Treino
     print("\n--- A iniciar o loop de treino --- ")
-    total_train_steps = (len(train_tokens) // training_config["batch_size"]) * training_config["num_epochs"]
+    total_train_steps = steps_per_epoch * training_config["num_epochs"]
     print(f"Total de passos de treino esperados: {total_train_steps}")
+    last_full_step = None
 
     for epoch in range(start_epoch, training_config["num_epochs"]):
-        # Baralhar dados de treino a cada época
-        random.shuffle(train_tokens)
+        # Baralhar a ordem dos dados de treino a cada época (os índices identificam
+        # as amostras na cache do tronco congelado)
+        train_order = list(range(len(train_tokens)))
+        shuffle_rng.shuffle(train_order)
+        train_order = train_order[rank::world_size]
         
         # Resetar o contador de passos para a nova época se não estiver a retomar
         if epoch > start_epoch:
             tracker.current_step = 0
+        # Ao retomar no último passo da época o ciclo seguinte fica vazio
+        global_step = epoch * steps_per_epoch + tracker.current_step
+        loss = None
 
-        for i in tqdm(range(tracker.current_step, len(train_tokens) // training_config["batch_size"]), desc=f"Época {epoch+1}/{{training_config['num_epochs']}}"):
+        for i in tqdm(range(tracker.current_step, steps_per_epoch), desc=f"Época {epoch+1}/{{training_config['num_epochs']}}", disable=not is_main):
             batch_start = i * training_config["batch_size"]
             batch_end = (i + 1) * training_config["batch_size"]
-            batch_tokens = train_tokens[batch_start:batch_end]
+            batch_indices = train_order[batch_start:batch_end]
+            global_step = epoch * steps_per_epoch + i + 1
+            if profiler.scheduled:
+                profiler.step_begin(global_step, timer)
+            step_start = time.perf_counter()
 
             # Padding e criação de tensores
-            max_len = max(len(t) for t in batch_tokens)
-            inputs = mx.array([t + [0] * (max_len - len(t)) for t in batch_tokens])
-            targets = inputs
-            lengths = mx.array([len(t) for t in batch_tokens])
+            with timer.phase("batch"):
+                inputs, targets, positions, lengths = load_batch(train_tokens, batch_indices, train_cache)
 
             # Passo de treino
-            loss = train_step_fn(inputs, targets, lengths)
-            mx.eval(model.parameters(), optimizer.state, loss)
+            if training_config["detailed_step_timing"]:
+                with timer.phase("forward_backward"):
+                    loss, grads = grad_step_fn(inputs, targets, positions, lengths)
+                    mx.eval(loss, grads)
+                with timer.phase("optimizer"):
+                    update_step_fn(grads)
+                    mx.eval(model.parameters(), optimizer.state)
+            else:
+                with timer.phase("step_dispatch"):
+                    loss = train_step_fn(inputs, targets, positions, lengths)
+                with timer.phase("eval_sync"):
+                    mx.eval(model.parameters(), optimizer.state, loss)
+
+            # Tokens reais (sem padding) processados neste passo
+            real_tokens = sum(len(train_tokens[k][0]) - 1 for k in batch_indices)
+            timer.record_step(real_tokens, len(batch_indices), time.perf_counter() - step_start)
+            if profiler.active:
+                profiler.step_end(global_step)
             
             # Logging
             if (i + 1) % training_config["log_steps"] == 0:
                 mem_usage = calculate_memory_usage()
-                tracker.log_step(epoch, i + 1, loss, memory_mb=mem_usage)
-                print(f"[Época {epoch+1}/{{training_config['num_epochs']}}] Passo {i+1}/{{len(train_tokens) // training_config['batch_size']}} - Loss: {loss.item():.4f} - Memória: {mem_usage:.2f} MB")
+                timing = timer.snapshot()
+                with timer.phase("metrics_io"):
+                    tracker.log_step(epoch, i + 1, loss, memory_mb=mem_usage, timing=timing)
+                if is_main:
+                    profiler.poll(global_step)
+                    print(f"[Época {epoch+1}/{{training_config['num_epochs']}}] Passo {i+1}/{{steps_per_epoch}} - Loss: {loss.item():.4f} - Memória: {mem_usage:.2f} MB - {timing['tokens_per_sec']:.0f} tokens/s")
 
             # Avaliação e Guardar Checkpoint
             if (i + 1) % training_config["eval_steps"] == 0 and val_tokens:
-                val_loss_sum = 0
-                num_val_batches = len(val_tokens) // training_config["batch_size"]
-                if num_val_batches == 0 and len(val_tokens) > 0: # Handle case where val_tokens < batch_size
-                    num_val_batches = 1
-
-                for j in range(num_val_batches):
-                    val_batch_start = j * training_config["batch_size"]
-                    val_batch_end = (j + 1) * training_config["batch_size"]
-                    val_batch_tokens = val_tokens[val_batch_start:val_batch_end]
-                    
-                    if not val_batch_tokens: # Skip empty batches
-                        continue
-
-                    val_max_len = max(len(t) for t in val_batch_tokens)
-                    val_inputs = mx.array([t + [0] * (val_max_len - len(t)) for t in val_batch_tokens])
-                    val_targets = val_inputs
-                    val_lengths = mx.array([len(t) for t in val_batch_tokens])
-
-                    val_loss = eval_fn(val_inputs, val_targets, val_lengths)
-                    val_loss_sum += val_loss.item()
-                
-                avg_val_loss = val_loss_sum / num_val_batches if num_val_batches > 0 else float('inf')
-                print(f"[Época {epoch+1}/{{training_config['num_epochs']}}] Val Loss: {avg_val_loss:.4f}")
-                tracker.log_step(epoch, i + 1, loss, val_loss=avg_val_loss, memory_mb=calculate_memory_usage())
-                tracker.save_best_model(model, avg_val_loss)
+                val_start = time.perf_counter()
+                check_loss, full_loss = validator.check()
+                timer.record("validation", time.perf_counter() - val_start)
+                if validator.subsampled:
+                    full_msg = f" | Completa: {full_loss:.4f}" if full_loss is not None else ""
+                    print(f"[Época {epoch+1}/{{training_config['num_epochs']}}] Val Loss (subamostra): {check_loss:.4f}{full_msg}")
+                else:
+                    print(f"[Época {epoch+1}/{{training_config['num_epochs']}}] Val Loss: {full_loss:.4f}")
+                with timer.phase("metrics_io"):
+                    tracker.log_step(epoch, i + 1, loss, val_loss=full_loss, memory_mb=calculate_memory_usage(), timing=timer.snapshot(),
+                                     val_subsample_loss=check_loss if validator.subsampled else None)
+                if full_loss is not None:
+                    last_full_step = global_step
+                    with timer.phase("checkpoint_io"):
+                        tracker.save_best_model(model, full_loss)
 
                 # Verificar Early Stopping e Overfitting
                 print(f"\n📊 Análise de Validação:")
                 should_stop, improved = early_stopping.check(
-                    val_loss=avg_val_loss,
+                    val_loss=check_loss,
                     train_loss=loss.item(),
                     epoch=epoch,
                     step=i + 1
@@ -458,16 +898,36 @@ def train(custom_training_config=None, custom_qlora_config=None):
                     print(f"\n🏁 Treino terminado por Early Stopping")
                     break
 
-            if (i + 1) % training_config["save_steps"] == 0:
+            if (i + 1) % training_config["save_steps"] == 0 and is_main:
                 checkpoint_path = CHECKPOINTS_DIR / f"checkpoint_epoch{epoch}_step{i+1}"
                 checkpoint_path.mkdir(parents=True, exist_ok=True)
-                model.save_weights(str(checkpoint_path / "adapters.safetensors"))
+                with timer.phase("checkpoint_io"):
+                    model.save_weights(str(checkpoint_path / "adapters.safetensors"))
                 print(f"✓ Checkpoint guardado em: {checkpoint_path}")
 
         # Sair do loop de épocas se early stopping foi acionado
         if early_stopping.should_stop:
             break
 
+        # Validação completa no fim da época (as avaliações periódicas usaram a subamostra)
+        if validator.subsampled and loss is not None and last_full_step != global_step:
+            val_start = time.perf_counter()
+            full_loss = validator.full()
+            timer.record("validation", time.perf_counter() - val_start)
+            print(f"[Época {epoch+1}/{{training_config['num_epochs']}}] Val Loss completa (fim da época): {full_loss:.4f}")
+            with timer.phase("metrics_io"):
+                tracker.log_step(epoch, tracker.current_step, loss, val_loss=full_loss, memory_mb=calculate_memory_usage(), timing=timer.snapshot())
+            with timer.phase("checkpoint_io"):
+                tracker.save_best_model(model, full_loss)
+
+    # Fechar uma captura de perfil que não chegou ao fim (treino terminou antes)
+    if profiler.active:
+        profiler.step_end(profiler.current_step, force=True)
+
+    # Relatórios e modelo final apenas no rank 0
+    if not is_main:
+        return
+
     # 5. Análise Final de Overfitting
     print("\n" + "="*80)
     print("🔍 ANÁLISE FINAL DE OVERFITTING")
@@ -499,7 +959,7 @@ def train(custom_training_config=None, custom_qlora_config=None):
     # tokenizer.save_pretrained(str(final_model_path))
 
     print(f"Modelo QLoRA finetunado guardado em: {final_model_path}")
-    tracker.save_summary(time.time() - tracker.start_time, len(train_dataset))
+    tracker.save_summary(time.time() - tracker.start_time, len(train_dataset), performance=timer.summary())
     print("Sumário de treino guardado.")
 
     print("\n--- A gerar relatórios finais --- ")
@@ -508,17 +968,22 @@ def train(custom_training_config=None, custom_qlora_config=None):
     print("Relatórios finais gerados.")
 
 if __name__ == "__main__":
-    # Criar ficheiros de treino e validação a partir do dataset limpo
-    full_dataset = load_dataset(CLEANED_DATA_FILE)
-    split_idx = int(len(full_dataset) * 0.9)
-    train_dataset = full_dataset[:split_idx]
-    val_dataset = full_dataset[split_idx:]
-
-    with open(TRAIN_FILE, 'w', encoding='utf-8') as f:
-        for entry in train_dataset:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
-    with open(VALID_FILE, 'w', encoding='utf-8') as f:
-        for entry in val_dataset:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    # Treino distribuído: mlx.launch -n 4 --backend ring scripts/train_qlora.py (ou --hostfile para várias máquinas)
+    group = mx.distributed.init()
+
+    # Criar ficheiros de treino e validação a partir do dataset limpo (só o rank 0 escreve)
+    if group.rank() == 0:
+        full_dataset = load_dataset(CLEANED_DATA_FILE)
+        split_idx = int(len(full_dataset) * 0.9)
+        train_dataset = full_dataset[:split_idx]
+        val_dataset = full_dataset[split_idx:]
+
+        with open(TRAIN_FILE, 'w', encoding='utf-8') as f:
+            for entry in train_dataset:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        with open(VALID_FILE, 'w', encoding='utf-8') as f:
+            for entry in val_dataset:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    barrier(group)
 
     train()
\ No newline at end of file
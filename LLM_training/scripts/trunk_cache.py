@@ -0,0 +1,137 @@
+"""
+Cache das ativações do tronco congelado do transformador.
+
+Com qlora_config["num_layers"] = 8 apenas os 8 blocos superiores do Mistral
+recebem adaptadores LoRA; os blocos inferiores estão congelados e produzem
+sempre as mesmas ativações para a mesma amostra. Este módulo corre o tronco
+inferior uma única vez por amostra e guarda os estados ocultos num ficheiro
+memory-mapped, para que as épocas seguintes (e sweeps/avaliações com o mesmo
+modelo e dados) corram apenas as camadas adaptadas.
+
+Formato em disco (um par de ficheiros por chave):
+    <chave>.npy   matriz float16 (total_tokens, hidden_size), amostras concatenadas
+    <chave>.json  offsets/comprimentos de cada amostra e metadados
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import mlx.core as mx
+from mlx_lm.models.base import create_attention_mask
+
+CACHE_DTYPE = np.float16
+
+
+def num_frozen_layers(model, num_lora_layers):
+    """Número de blocos inferiores sem adaptadores LoRA"""
+    return max(len(model.layers) - num_lora_layers, 0)
+
+
+def frozen_trunk_forward(model, inputs, num_frozen):
+    """Embeddings + blocos congelados; devolve os estados ocultos (B, L, D)"""
+    hidden = model.model.embed_tokens(inputs)
+    mask = create_attention_mask(hidden, None)
+    for layer in model.layers[:num_frozen]:
+        hidden = layer(hidden, mask)
+    return hidden
+
+
+def adapted_trunk_forward(model, hidden, num_frozen):
+    """Corre apenas os blocos adaptados (LoRA) a partir de ativações do tronco congelado"""
+    mask = create_attention_mask(hidden, None)
+    for layer in model.layers[num_frozen:]:
+        hidden = layer(hidden, mask)
+    return model.model.norm(hidden)
+
+
+def _cache_key(model_name, num_frozen, token_samples):
+    digest = hashlib.sha256()
+    digest.update(f"{model_name}|{num_frozen}".encode("utf-8"))
+    for tokens, _ in token_samples:
+        digest.update(np.asarray(tokens, dtype=np.int32).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()[:24]
+
+
+class TrunkCache:
+    """Ativações do tronco congelado em disco, indexadas pela posição da amostra no dataset"""
+
+    def __init__(self, cache_dir, model_name, num_frozen, token_samples):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.num_frozen = num_frozen
+        self.key = _cache_key(model_name, num_frozen, token_samples)
+        self.data_file = self.cache_dir / f"{self.key}.npy"
+        self.meta_file = self.cache_dir / f"{self.key}.json"
+
+        # Cada amostra contribui len(tokens) - 1 posições de entrada (ver build_batch)
+        self.lengths = [len(tokens) - 1 for tokens, _ in token_samples]
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)]).astype(np.int64)
+        self.hidden = None
+
+    @property
+    def total_tokens(self):
+        return int(self.offsets[-1])
+
+    def is_complete(self):
+        if not (self.meta_file.exists() and self.data_file.exists()):
+            return False
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except json.JSONDecodeError:
+            return False
+        return meta.get("complete", False) and meta.get("total_tokens") == self.total_tokens
+
+    def build(self, model, token_samples, build_batch, batch_size=4):
+        """Calcula (ou reutiliza) as ativações de todas as amostras e abre o memmap"""
+        if self.is_complete():
+            print(f"✓ Cache do tronco congelado reutilizada: {self.data_file}")
+            return self.open()
+
+        hidden_size = model.args.hidden_size
+        size_gb = self.total_tokens * hidden_size * np.dtype(CACHE_DTYPE).itemsize / (1024 ** 3)
+        print(f"A construir cache do tronco congelado ({self.num_frozen} camadas, "
+              f"{self.total_tokens} tokens, {size_gb:.2f} GB) em {self.data_file}")
+
+        data = np.lib.format.open_memmap(
+            self.data_file, mode='w+', dtype=CACHE_DTYPE, shape=(self.total_tokens, hidden_size)
+        )
+        for start in range(0, len(self.lengths), batch_size):
+            indices = range(start, min(start + batch_size, len(self.lengths)))
+            inputs, _, _, _ = build_batch([token_samples[k] for k in indices])
+            hidden = frozen_trunk_forward(model, inputs, self.num_frozen).astype(mx.float16)
+            hidden = np.array(hidden)
+            for row, k in enumerate(indices):
+                data[self.offsets[k]:self.offsets[k + 1]] = hidden[row, :self.lengths[k]]
+        data.flush()
+        del data
+
+        with open(self.meta_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "complete": True,
+                "num_frozen_layers": self.num_frozen,
+                "hidden_size": hidden_size,
+                "total_tokens": self.total_tokens,
+                "num_samples": len(self.lengths),
+            }, f, indent=4)
+        return self.open()
+
+    def open(self):
+        self.hidden = np.load(self.data_file, mmap_mode='r')
+        return self
+
+    def hidden_batch(self, indices, max_len, dtype=mx.float16):
+        """Estados ocultos das amostras `indices` com padding até max_len -> (B, max_len, D)"""
+        batch = np.zeros((len(indices), max_len, self.hidden.shape[1]), dtype=CACHE_DTYPE)
+        for row, k in enumerate(indices):
+            batch[row, :self.lengths[k]] = self.hidden[self.offsets[k]:self.offsets[k + 1]]
+        return mx.array(batch).astype(dtype)
+
+
+def build_trunk_cache(cache_dir, model, model_name, num_frozen, token_samples, build_batch, batch_size=4):
+    """Cria/abre a cache do tronco congelado para um conjunto de amostras tokenizadas"""
+    cache = TrunkCache(cache_dir, model_name, num_frozen, token_samples)
+    return cache.build(model, token_samples, build_batch, batch_size)
@@ -3,11 +3,12 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import threading
 from pathlib import Path
+from typing import Optional
 import json
 
 # Import from new modules
 from .models import TrainingConfig
-from .services.system import get_hardware_info
+from .services.system import get_hardware_info, run_autotune
 from .services.validation import validate_dataset_file, clean_dataset_file
 from .services.training import start_training_process, stop_training_process
 
@@ -29,6 +30,12 @@ app.add_middleware(
 async def get_system_info():
     return get_hardware_info()
 
+@app.post("/autotune")
+async def autotune(force: bool = False):
+    # Probing loads the model and runs training steps in a separate process (see run_autotune);
+    # the result shows up as the "auto" preset in /system-info once cached
+    return {**run_autotune(force), "force": force}
+
 @app.post("/start-training")
 async def start_training(config: TrainingConfig):
     # Start training in a separate thread
@@ -59,6 +66,19 @@ async def get_training_status():
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
+class ProfileRequest(BaseModel):
+    start_step: Optional[int] = None # Defaults to the step right after the trainer picks up the request
+    num_steps: int = 10
+
+@app.post("/profile")
+async def request_profile(request: ProfileRequest):
+    """Asks the running train_qlora.py to profile steps start_step..start_step+num_steps-1"""
+    checkpoints_dir = Path(__file__).parent.parent / "LLM_training" / "checkpoints_qlora"
+    checkpoints_dir.mkdir(parents=True, exist_ok=True)
+    with open(checkpoints_dir / "profile_request.json", "w") as f:
+        json.dump(request.model_dump(), f)
+    return {"status": "requested", "output_dir": str(checkpoints_dir / "profiles")}
+
 @app.post("/stop-training")
 async def stop_training():
     stop_training_process()
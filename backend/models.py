@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Union
 
 class TrainingConfig(BaseModel):
     model: str
@@ -11,4 +11,5 @@ class TrainingConfig(BaseModel):
     quantization: str
     maxSeqLength: int
     framework: str = "MLX" # Default to MLX
+    gradCheckpoint: Optional[Union[str, int, List[int]]] = None # "none", "all", every N-th LoRA block, or block indices
     presets: Optional[Dict[str, Any]] = None
@@ -1,10 +1,64 @@
+import json
 import platform
+import subprocess
+import sys
+import threading
+from pathlib import Path
 import psutil
 try:
     import torch
 except ImportError:
     torch = None
 
+SCRIPTS_DIR = Path(__file__).parent.parent.parent / "LLM_training" / "scripts"
+AUTOTUNE_CACHE = Path(__file__).parent.parent.parent / "LLM_training" / "checkpoints_qlora" / "autotune_cache.json"
+AUTOTUNE_LOG = Path(__file__).parent.parent.parent / "backend_autotune.log"
+
+_autotune_process = None
+_autotune_lock = threading.Lock()
+
+def get_auto_preset():
+    """Returns the newest memory-probing preset cached for this machine, if available.
+
+    Reads autotune_cache.json directly: importing memory_probe/train_qlora to compute the
+    exact fingerprint would pull mlx, pandas and matplotlib into the API server.
+    """
+    if not AUTOTUNE_CACHE.exists():
+        return None
+    try:
+        with open(AUTOTUNE_CACHE, "r", encoding="utf-8") as f:
+            results = json.load(f).values()
+    except (OSError, json.JSONDecodeError):
+        return None
+    ram_gb = round(psutil.virtual_memory().total / (1024 ** 3))
+    matching = [
+        r for r in results
+        if r.get("fingerprint", {}).get("machine") == platform.machine()
+        and r.get("fingerprint", {}).get("system") == platform.system()
+        and r.get("fingerprint", {}).get("ram_gb") == ram_gb
+    ]
+    if not matching:
+        return None
+    return max(matching, key=lambda r: r.get("timestamp", ""))["preset"]
+
+def run_autotune(force: bool = False):
+    """Starts memory_probe.py in its own process (one at a time).
+
+    The probe loads the model and deliberately pushes memory towards the limit, so it must
+    not run inside the API server: an OOM would kill the backend.
+    """
+    global _autotune_process
+    with _autotune_lock:
+        if _autotune_process is not None and _autotune_process.poll() is None:
+            return {"status": "running", "pid": _autotune_process.pid}
+        cmd = [sys.executable, str(SCRIPTS_DIR / "memory_probe.py")]
+        if force:
+            cmd.append("--force")
+        log = open(AUTOTUNE_LOG, "a", encoding="utf-8")
+        _autotune_process = subprocess.Popen(cmd, cwd=str(SCRIPTS_DIR), stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        return {"status": "started", "pid": _autotune_process.pid}
+
 def get_hardware_info():
     """Detects system hardware and recommends framework"""
     system = platform.system()
@@ -45,27 +99,36 @@ def get_hardware_info():
     }
     
     # Base logic based on RAM
+    # grad_checkpoint recomputes activations of the LoRA blocks in the backward pass
+    # ("all" = every block, 2 = every other block), trading compute for memory headroom on
+    # the memory-bound tiers. Sequence lengths / batch sizes are unchanged: larger values
+    # need a measured run on the target machine, not a guess in this table.
     if available_ram_gb < 8:
         # Low RAM (<8GB)
-        presets["conservative"] = { 'batch_size': 1, 'gradient_accumulation': 8, 'max_seq_length': 128, 'learning_rate': 0.00005, 'num_epochs': 1 }
-        presets["balanced"] =     { 'batch_size': 1, 'gradient_accumulation': 4, 'max_seq_length': 256, 'learning_rate': 0.0001,  'num_epochs': 1 }
-        presets["aggressive"] =   { 'batch_size': 2, 'gradient_accumulation': 2, 'max_seq_length': 256, 'learning_rate': 0.0002,  'num_epochs': 2 }
+        presets["conservative"] = { 'batch_size': 1, 'gradient_accumulation': 8, 'max_seq_length': 128, 'learning_rate': 0.00005, 'num_epochs': 1, 'grad_checkpoint': 'all' }
+        presets["balanced"] =     { 'batch_size': 1, 'gradient_accumulation': 4, 'max_seq_length': 256, 'learning_rate': 0.0001,  'num_epochs': 1, 'grad_checkpoint': 'all' }
+        presets["aggressive"] =   { 'batch_size': 2, 'gradient_accumulation': 2, 'max_seq_length': 256, 'learning_rate': 0.0002,  'num_epochs': 2, 'grad_checkpoint': 'all' }
     elif available_ram_gb < 16:
         # Medium RAM (<16GB)
-        presets["conservative"] = { 'batch_size': 1, 'gradient_accumulation': 4, 'max_seq_length': 256, 'learning_rate': 0.0001, 'num_epochs': 1 }
-        presets["balanced"] =     { 'batch_size': 2, 'gradient_accumulation': 4, 'max_seq_length': 512, 'learning_rate': 0.0002, 'num_epochs': 3 }
-        presets["aggressive"] =   { 'batch_size': 4, 'gradient_accumulation': 2, 'max_seq_length': 512, 'learning_rate': 0.0003, 'num_epochs': 3 }
+        presets["conservative"] = { 'batch_size': 1, 'gradient_accumulation': 4, 'max_seq_length': 256, 'learning_rate': 0.0001, 'num_epochs': 1, 'grad_checkpoint': 'none' }
+        presets["balanced"] =     { 'batch_size': 2, 'gradient_accumulation': 4, 'max_seq_length': 512, 'learning_rate': 0.0002, 'num_epochs': 3, 'grad_checkpoint': 2 }
+        presets["aggressive"] =   { 'batch_size': 4, 'gradient_accumulation': 2, 'max_seq_length': 512, 'learning_rate': 0.0003, 'num_epochs': 3, 'grad_checkpoint': 'all' }
     else:
         # High RAM (>16GB)
-        presets["conservative"] = { 'batch_size': 2, 'gradient_accumulation': 4, 'max_seq_length': 512, 'learning_rate': 0.0001, 'num_epochs': 2 }
-        presets["balanced"] =     { 'batch_size': 4, 'gradient_accumulation': 2, 'max_seq_length': 1024, 'learning_rate': 0.0002, 'num_epochs': 3 }
-        presets["aggressive"] =   { 'batch_size': 8, 'gradient_accumulation': 1, 'max_seq_length': 2048, 'learning_rate': 0.0003, 'num_epochs': 3 }
+        presets["conservative"] = { 'batch_size': 2, 'gradient_accumulation': 4, 'max_seq_length': 512, 'learning_rate': 0.0001, 'num_epochs': 2, 'grad_checkpoint': 'none' }
+        presets["balanced"] =     { 'batch_size': 4, 'gradient_accumulation': 2, 'max_seq_length': 1024, 'learning_rate': 0.0002, 'num_epochs': 3, 'grad_checkpoint': 'none' }
+        presets["aggressive"] =   { 'batch_size': 8, 'gradient_accumulation': 1, 'max_seq_length': 2048, 'learning_rate': 0.0003, 'num_epochs': 3, 'grad_checkpoint': 'all' }
 
     # Adjust for GPU
     if has_gpu:
         for key in presets:
             presets[key]['learning_rate'] *= 1.5
 
+    # Measured tier: largest batch/sequence found by memory probing (see /autotune)
+    auto_preset = get_auto_preset()
+    if auto_preset:
+        presets["auto"] = auto_preset
+
     return {
         "os": system,
         "processor": processor,
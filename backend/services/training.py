@@ -70,6 +70,8 @@ def start_training_process(config: TrainingConfig):
             "learning_rate": config.learningRate,
             "max_seq_length": config.maxSeqLength
         }
+        if config.gradCheckpoint is not None:
+            custom_training_config["grad_checkpoint"] = config.gradCheckpoint
         
         custom_qlora_config = {}
         if config.quantization == "4-bit":